@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
-from typing import Union, Optional
-from math import sqrt
+from functools import lru_cache
+from io import BytesIO
+from typing import Union, Optional, BinaryIO, List, Tuple, Iterable, Iterator
+from typing import Any
+from math import sqrt, sin, pi, floor, ceil
 from . import IcnsType, PackBytes, RawData
 try:
     from PIL import Image
@@ -9,8 +12,22 @@ except ImportError:
     PIL_ENABLED = False
 
 
+@lru_cache(maxsize=None)
+def numpy_enabled() -> bool:
+    ''' Probe once if numpy is installed. Imported on first use (slow). '''
+    try:
+        import numpy  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
 class ArgbImage:
-    __slots__ = ['a', 'r', 'g', 'b', 'size', 'channels']
+    '''
+    Image with separate channel planes (row-major). Planes are lists of int
+    or, if created with `from_array()`, uint8 numpy arrays.
+    '''
+    __slots__ = ['a', 'r', 'g', 'b', 'size', 'channels', '_array']
 
     @classmethod
     def from_mono(cls, data: bytes, iType: IcnsType.Media) -> 'ArgbImage':
@@ -23,6 +40,7 @@ class ArgbImage:
             for i in range(7, -1, -1):
                 img.append(255 if byte & (1 << i) else 0)
         self = object.__new__(cls)
+        self._array = None
         self.size = iType.size
         self.channels = iType.channels
         if iType.channels == 2:
@@ -33,6 +51,112 @@ class ArgbImage:
         self.r, self.g, self.b = img, img, img
         return self
 
+    @classmethod
+    def from_indexed(
+        cls,
+        data: bytes,
+        iType: IcnsType.Media,
+        mask: Optional[bytes] = None,
+    ) -> 'ArgbImage':
+        '''
+        Load 4-bit or 8-bit image using the classic Mac OS system palette.
+        - mask : Either 8-bit mask or 1-bit icon with mask (e.g., ICN#).
+        '''
+        assert(iType.is_indexed())
+        assert(iType.size and iType.bits)
+        w, h = iType.size
+        n = w * h
+        if len(data) * 8 // iType.bits < n:
+            raise ValueError('Invalid data size for {}: {} bytes'.format(
+                str(iType.key), len(data)))
+        if iType.bits == 4:
+            indices = bytearray(len(data) * 2)
+            indices[0::2] = data.translate(_HIGH_NIBBLE)
+            indices[1::2] = data.translate(_LOW_NIBBLE)
+            tables = _CLUT4
+        else:
+            indices = bytearray(data)
+            tables = _CLUT8
+        idx = bytes(indices[:n])
+        r, g, b = [list(idx.translate(table)) for table in tables]
+        if mask is None:
+            a = [255] * n
+        elif len(mask) == n:  # 8-bit mask
+            a = list(mask)
+        elif len(mask) * 4 == n:  # 1-bit icon + 1-bit mask
+            a = list(b''.join(_BITS[x] for x in mask[n // 8:]))
+        else:
+            raise ValueError('Invalid mask size: {} bytes'.format(len(mask)))
+        return cls.from_planes((w, h), a, r, g, b)
+
+    @classmethod
+    def from_planes(
+        cls,
+        size: Tuple[int, int],
+        a: List[int],
+        r: List[int],
+        g: List[int],
+        b: List[int],
+    ) -> 'ArgbImage':
+        ''' Create image from uncompressed channel data (row-major). '''
+        assert(len(a) == len(r) == len(g) == len(b) == size[0] * size[1])
+        self = object.__new__(cls)
+        self._array = None
+        self.size = size
+        self.channels = 4
+        self.a, self.r, self.g, self.b = a, r, g, b
+        return self
+
+    @classmethod
+    def from_array(cls, arr: Any) -> 'ArgbImage':
+        '''
+        Create image from HxWx4 (RGBA) or HxWx3 (RGB) uint8 numpy array.
+        Channel planes are views on the (contiguous) array, no copy is made
+        if possible. Requires numpy.
+        '''
+        if not numpy_enabled():
+            raise ImportError('Install numpy to support array conversion.')
+        import numpy
+        arr = numpy.asarray(arr)
+        if arr.dtype != numpy.uint8 or arr.ndim != 3 or \
+                arr.shape[2] not in [3, 4]:
+            raise ValueError('Expected HxWx4 or HxWx3 uint8 array, got {} {}'
+                             .format('x'.join(map(str, arr.shape)),
+                                     arr.dtype))
+        h, w, ch = arr.shape
+        if ch == 3:
+            arr = numpy.dstack([arr, numpy.full((h, w), 255, numpy.uint8)])
+        arr = numpy.ascontiguousarray(arr)
+        r, g, b, a = [arr[:, :, i].reshape(-1) for i in range(4)]
+        self = cls.from_planes((w, h), a, r, g, b)
+        self._array = (arr, (a, r, g, b))
+        return self
+
+    def to_array(self) -> Any:
+        '''
+        Return HxWx4 (RGBA) uint8 numpy array. If the image was created with
+        `from_array()` (and planes were not replaced), the original array is
+        returned without copy. Requires numpy.
+        '''
+        if not numpy_enabled():
+            raise ImportError('Install numpy to support array conversion.')
+        import numpy
+        planes = (self.a, self.r, self.g, self.b)
+        if self._array and all(x is y for x, y in zip(self._array[1], planes)):
+            return self._array[0]
+        w, h = self.size
+        return numpy.stack([numpy.asarray(x, dtype=numpy.uint8)
+                            for x in planes[1:] + planes[:1]],
+                           axis=-1).reshape(h, w, 4)
+
+    def __array__(self, dtype: Any = None, copy: Optional[bool] = None) \
+            -> Any:
+        ''' Support `numpy.asarray(img)`, see `to_array()`. '''
+        arr = self.to_array()
+        if copy or dtype is not None and arr.dtype != dtype:
+            return arr.astype(dtype or arr.dtype)
+        return arr
+
     def __init__(
         self,
         *,
@@ -45,6 +169,7 @@ class ArgbImage:
         Provide either a filename or raw binary data.
         - mask : Optional, may be either binary data or filename
         '''
+        self._array = None  # type: Optional[Tuple[Any, Tuple[Any, ...]]]
         self.size = (0, 0)
         self.channels = 0
         if file:
@@ -77,12 +202,20 @@ class ArgbImage:
         raise type(tmp)('{} File: "{}"'.format(str(tmp), fname))
 
     def load_data(self, data: bytes) -> None:
-        ''' Has support for ARGB and RGB-channels files. '''
+        '''
+        Has support for ARGB and RGB-channels files.
+        PNG and JPEG 2000 data is supported if Pillow is installed.
+        '''
+        if RawData.determine_file_ext(data[:8]) in ['png', 'jp2']:
+            self._load_png(BytesIO(data))
+            return
         is_argb = data[:4] == b'ARGB'
         if is_argb or data[:4] == b'\x00\x00\x00\x00':
             data = data[4:]  # remove ARGB and it32 header
 
-        uncompressed_data = PackBytes.unpack(data)
+        # fail before decoding (allocation) if larger than any icns type
+        uncompressed_data = RawData.unpack(data, IcnsType.max_decoded_size(
+            'argb' if is_argb else 'rgb'))
 
         self.channels = 4 if is_argb else 3
         per_channel = len(uncompressed_data) // self.channels
@@ -116,19 +249,48 @@ class ArgbImage:
         self.a = list(data)
 
     def mask_data(self, bits: int = 8, *, compress: bool = False) -> bytes:
+        alpha = bytes(self.a)  # list or numpy array
         if bits == 8:  # default for rgb and argb
-            return PackBytes.pack(self.a) if compress else bytes(self.a)
-        return bytes(PackBytes.msb_stream(self.a, bits=bits))
+            return PackBytes.pack(alpha) if compress else alpha
+        return bytes(PackBytes.msb_stream(alpha, bits=bits))
 
     def rgb_data(self, *, compress: bool = True) -> bytes:
-        return b''.join(PackBytes.pack(x) if compress else bytes(x)
+        return b''.join(PackBytes.pack(bytes(x)) if compress else bytes(x)
                         for x in (self.r, self.g, self.b))
 
     def argb_data(self, *, compress: bool = True) -> bytes:
         return b'ARGB' + self.mask_data(compress=compress) \
                        + self.rgb_data(compress=compress)
 
-    def _load_png(self, fname: str) -> None:
+    def resize(
+        self, size: Union[int, Tuple[int, int]], filter: str = 'area',
+    ) -> 'ArgbImage':
+        '''
+        Return a new resampled image. Filtering uses premultiplied alpha.
+        - filter : 'area' (box average) or 'lanczos' (Lanczos-3)
+        Vectorized with numpy (if installed), pure python otherwise.
+        '''
+        w, h = (size, size) if isinstance(size, int) else size
+        wx = _resample_weights(self.size[0], w, filter)
+        wy = _resample_weights(self.size[1], h, filter)
+        if numpy_enabled():
+            planes = _resample_numpy(self, (w, h), wx, wy)
+        else:
+            planes = _resample_python(self, (w, h), wx, wy)
+        return ArgbImage.from_planes((w, h), *planes)
+
+    def mipmaps(self, sizes: Iterable[int], filter: str = 'area') \
+            -> Iterator['ArgbImage']:
+        '''
+        Yield resized images, largest first.
+        Each image is derived from the previous (larger) one.
+        '''
+        img = self
+        for size in sorted(set(sizes), reverse=True):
+            img = img.resize(size, filter)
+            yield img
+
+    def _load_png(self, fname: Union[str, BinaryIO]) -> None:
         if not PIL_ENABLED:
             raise ImportError('Install Pillow to support PNG conversion.')
         self._load_pillow_image(Image.open(fname, mode='r'))
@@ -148,8 +310,19 @@ class ArgbImage:
             self.b.append(b)
 
     def write_png(self, fname: str) -> None:
+        self._pillow_image().save(fname)
+
+    def png_data(self) -> bytes:
+        ''' Same as `write_png()` but return the PNG file as bytes. '''
+        fp = BytesIO()
+        self._pillow_image().save(fp, format='PNG')
+        return fp.getvalue()
+
+    def _pillow_image(self) -> 'Image.Image':
         if not PIL_ENABLED:
             raise ImportError('Install Pillow to support PNG conversion.')
+        if numpy_enabled():
+            return Image.fromarray(self.to_array())
         img = Image.new(mode='RGBA', size=self.size)
         w, h = self.size
         for y in range(h):
@@ -157,9 +330,139 @@ class ArgbImage:
                 i = y * w + x
                 img.putpixel(
                     (x, y), (self.r[i], self.g[i], self.b[i], self.a[i]))
-        img.save(fname)
+        return img
 
     def __repr__(self) -> str:
         typ = ['', 'Mono', 'Mono with Mask', 'RGB', 'RGBA'][self.channels]
         return '<{}: {}x{} {}>'.format(
             type(self).__name__, self.size[0], self.size[1], typ)
+
+
+# Classic Mac OS system palettes (translation table per channel)
+
+def _clut_tables(colors: List[int]) -> List[bytes]:
+    return [bytes((colors[i] >> shift) & 0xFF if i < len(colors) else 0
+                  for i in range(256)) for shift in (16, 8, 0)]
+
+
+_CLUT4 = _clut_tables([
+    0xFFFFFF, 0xFCF305, 0xFF6402, 0xDD0806, 0xF20884, 0x4600A5, 0x0000D4,
+    0x02ABEA, 0x1FB714, 0x006411, 0x562C05, 0x90713A, 0xC0C0C0, 0x808080,
+    0x404040, 0x000000])
+_CLUT8 = _clut_tables(
+    # 6x6x6 color cube without black
+    [r << 16 | g << 8 | b for r in range(0xFF, -1, -0x33)
+     for g in range(0xFF, -1, -0x33) for b in range(0xFF, -1, -0x33)][:-1]
+    # red, green, blue, and gray ramps without multiples of 0x33
+    + [x << 16 for x in range(0xEE, 0, -0x11) if x % 0x33]
+    + [x << 8 for x in range(0xEE, 0, -0x11) if x % 0x33]
+    + [x for x in range(0xEE, 0, -0x11) if x % 0x33]
+    + [x * 0x010101 for x in range(0xEE, 0, -0x11) if x % 0x33]
+    + [0x000000])
+_HIGH_NIBBLE = bytes(x >> 4 for x in range(256))
+_LOW_NIBBLE = bytes(x & 0x0F for x in range(256))
+_BITS = [bytes(255 if x & (1 << i) else 0 for i in range(7, -1, -1))
+         for x in range(256)]
+
+
+# Resampling helper
+
+_Weights = List[List[Tuple[int, float]]]
+
+
+def _resample_weights(src: int, dst: int, filter: str) -> _Weights:
+    ''' For each destination pixel, list of (source index, weight). '''
+    if dst < 1:
+        raise ValueError('Invalid image size: {}'.format(dst))
+    scale = src / dst
+    ret = []
+    for i in range(dst):
+        taps = []  # type: List[Tuple[int, float]]
+        if filter == 'area':
+            start, end = i * scale, (i + 1) * scale
+            if scale < 1:  # upscaling, nearest neighbor
+                start, end = floor(start), floor(start) + 1
+            for j in range(floor(start), min(ceil(end), src)):
+                overlap = min(end, j + 1) - max(start, j)
+                if overlap > 0:
+                    taps.append((j, overlap))
+        elif filter == 'lanczos':
+            support = 3 * max(scale, 1)
+            center = (i + 0.5) * scale
+            for j in range(floor(center - support), ceil(center + support)):
+                x = (j + 0.5 - center) / max(scale, 1)
+                weight = _lanczos3(x)
+                if weight != 0:
+                    taps.append((min(max(j, 0), src - 1), weight))
+        else:
+            raise NotImplementedError('Unknown filter "{}"'.format(filter))
+        total = sum(x for _, x in taps)
+        ret.append([(j, x / total) for j, x in taps])
+    return ret
+
+
+def _lanczos3(x: float) -> float:
+    if x == 0:
+        return 1.0
+    if -3 < x < 3:
+        return 3 * sin(pi * x) * sin(pi * x / 3) / (pi * pi * x * x)
+    return 0.0
+
+
+def _resample_python(
+    img: ArgbImage, size: Tuple[int, int], wx: _Weights, wy: _Weights,
+) -> List[List[int]]:
+    sw, sh = img.size
+    w, h = size
+    # premultiply alpha
+    planes = [[float(x) for x in img.a]] + [
+        [c * a / 255 for c, a in zip(ch, img.a)]
+        for ch in (img.r, img.g, img.b)]
+    ret = []
+    for plane in planes:
+        # horizontal pass
+        tmp = []  # type: List[float]
+        for y in range(sh):
+            row = plane[y * sw:(y + 1) * sw]
+            tmp.extend(sum(row[j] * x for j, x in taps) for taps in wx)
+        # vertical pass
+        out = [0.0] * (w * h)
+        for y, taps in enumerate(wy):
+            for j, weight in taps:
+                off = j * w
+                for x in range(w):
+                    out[y * w + x] += tmp[off + x] * weight
+        ret.append(out)
+    # unpremultiply
+    alpha = [min(max(int(round(x)), 0), 255) for x in ret[0]]
+    res = [alpha]
+    for plane in ret[1:]:
+        res.append([min(max(int(round(c * 255 / pa)), 0), 255) if a else 0
+                    for c, pa, a in zip(plane, ret[0], alpha)])
+    return res
+
+
+def _resample_numpy(
+    img: ArgbImage, size: Tuple[int, int], wx: _Weights, wy: _Weights,
+) -> List[List[int]]:
+    import numpy as np
+    sw, sh = img.size
+    w, h = size
+    mx = np.zeros((w, sw), dtype=np.float64)
+    for i, taps in enumerate(wx):
+        for j, x in taps:
+            mx[i, j] += x
+    my = np.zeros((h, sh), dtype=np.float64)
+    for i, taps in enumerate(wy):
+        for j, x in taps:
+            my[i, j] += x
+    a = np.asarray(img.a, dtype=np.float64).reshape(sh, sw)
+    planes = np.stack([a] + [
+        np.asarray(ch, dtype=np.float64).reshape(sh, sw) * a / 255
+        for ch in (img.r, img.g, img.b)])
+    out = my @ planes @ mx.T  # (4, h, w)
+    alpha = np.clip(np.rint(out[0]), 0, 255)
+    safe = np.where(out[0] > 0, out[0], 1)
+    rgb = np.clip(np.rint(out[1:] * 255 / safe), 0, 255)
+    rgb[:, alpha == 0] = 0
+    return [x.astype(np.uint8).ravel().tolist() for x in [alpha] + list(rgb)]
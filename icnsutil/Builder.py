@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+'''
+Build many icns files from a manifest in a single process.
+
+Manifest format (JSON, paths are relative to the manifest file):
+{
+  "outputs": {
+    "App.icns": {
+      "sources": ["icon.iconset", "16x16.argb"],
+      "dark": ["dark.iconset"],
+      "selected": [...],
+      "template": [...],
+      "toc": true,
+      "layout": "small-first"
+    }
+  }
+}
+'''
+import os  # path, listdir, makedirs, replace, stat
+import json  # load, dump
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import sha256
+from threading import Lock, get_ident
+from time import perf_counter, sleep
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from typing import Callable
+from . import IcnsType, RawData, __version__
+from .IcnsFile import IcnsFile
+
+# Nested icns files which can be composed from their own source list
+NESTED_KEYS = ['dark', 'selected', 'template']
+
+
+class BuildError(Exception):
+    pass
+
+
+class BuildResult:
+    __slots__ = ['target', 'keys', 'duration', 'error', 'skipped']
+
+    def __init__(self, target: str) -> None:
+        self.target = target
+        self.keys = []  # type: List[IcnsType.Media.KeyT]
+        self.duration = 0.0
+        self.error = None  # type: Optional[str]
+        self.skipped = False
+
+    def __str__(self) -> str:
+        if self.error:
+            return 'error: {} ({})'.format(self.target, self.error)
+        if self.skipped:
+            return 'up-to-date: {}'.format(self.target)
+        return '{} ({} entries) in {:.1f} ms'.format(
+            self.target, len(self.keys), self.duration * 1000)
+
+
+class BuildCache:
+    '''
+    Persistent, content-addressed build cache (a local directory).
+    Stores the type-guess result and payload of every source file, keyed by
+    content hash and filename (filename is relevant for type-guessing).
+    Also stores the combined source hash of every written output file.
+    '''
+    VERSION = '1'
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        os.makedirs(os.path.join(path, 'src'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'out'), exist_ok=True)
+        try:
+            with open(os.path.join(path, 'stat.json'), 'r') as fp:
+                self._stat = json.load(fp)  # type: Dict[str, List[Any]]
+        except (OSError, ValueError):
+            self._stat = {}
+        self._stat_changed = False
+
+    def __enter__(self) -> 'BuildCache':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.save()
+
+    def save(self) -> None:
+        ''' Persist file-stat memo. Content hashes are stored immediately. '''
+        with self._lock:
+            if not self._stat_changed:
+                return
+            _atomic_write(os.path.join(self.path, 'stat.json'),
+                          json.dumps(self._stat).encode('utf8'))
+            self._stat_changed = False
+
+    def digest(self, fname: str) -> str:
+        '''
+        Content hash of file. Unchanged files (same size and modification
+        time) are not read again.
+        '''
+        st = os.stat(fname)
+        path = os.path.abspath(fname)
+        with self._lock:
+            memo = self._stat.get(path)
+        if memo and memo[:2] == [st.st_size, st.st_mtime_ns]:
+            return memo[2]  # type: ignore[no-any-return]
+        with open(fname, 'rb') as fp:
+            digest = sha256(fp.read()).hexdigest()
+        with self._lock:
+            self._stat[path] = [st.st_size, st.st_mtime_ns, digest]
+            self._stat_changed = True
+        return digest
+
+    def load(
+        self,
+        fname: str,
+        fn: Callable[[str], Tuple[IcnsType.Media.KeyT, bytes]],
+    ) -> Tuple[IcnsType.Media.KeyT, bytes]:
+        ''' Returns cached (key, data) or stores result of `fn(fname)`. '''
+        h = self._hash(os.path.basename(fname), self.digest(fname))
+        entry = os.path.join(self.path, 'src', h[:2], h)
+        try:
+            with open(entry, 'rb') as fp:
+                key, _ = RawData.icns_header_read(fp.read(8))
+                data = fp.read()
+            with self._lock:
+                self.hits += 1
+            return key, data
+        except OSError:
+            pass
+        key, data = fn(fname)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        _atomic_write(entry, RawData.icns_header_w_len(key, len(data)) + data)
+        with self._lock:
+            self.misses += 1
+        return key, data
+
+    def output_digest(self, opts: Dict[str, Any]) -> str:
+        ''' Combined hash of all sources and options of a single output. '''
+        parts = [self.VERSION, __version__, str(bool(opts.get('toc'))),
+                 opts.get('layout') or 'as-is']
+        for field in ['sources'] + NESTED_KEYS:
+            parts.append(field)
+            for fname in opts.get(field) or []:
+                parts.append(os.path.basename(fname))
+                parts.append(self.digest(fname))
+        return self._hash(*parts)
+
+    def is_up_to_date(self, target: str, digest: str) -> bool:
+        ''' Returns True if target was written with identical sources. '''
+        try:
+            st = os.stat(target)
+            with open(self._output_entry(target), 'r') as fp:
+                prev = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        return prev == [digest, st.st_size, st.st_mtime_ns]
+
+    def record(self, target: str, digest: str) -> None:
+        st = os.stat(target)
+        _atomic_write(self._output_entry(target), json.dumps(
+            [digest, st.st_size, st.st_mtime_ns]).encode('utf8'))
+
+    def _output_entry(self, target: str) -> str:
+        return os.path.join(
+            self.path, 'out', self._hash(os.path.abspath(target)))
+
+    @staticmethod
+    def _hash(*parts: str) -> str:
+        return sha256('\0'.join(parts).encode('utf8')).hexdigest()
+
+
+class SourcePool:
+    '''
+    Load and type-guess every source file exactly once.
+    Thread-safe; concurrent requests for the same file wait for each other.
+    If a `BuildCache` is provided, unchanged files are not guessed again.
+    '''
+
+    def __init__(self, cache: Optional[BuildCache] = None) -> None:
+        self.cache = cache
+        self._lock = Lock()
+        self._sources = {}  # type: Dict[str, Future]
+        self._nested = {}  # type: Dict[Tuple[str, ...], Future]
+        self.loaded = 0  # number of files read and type-guessed
+
+    def get(self, fname: str) -> Tuple[IcnsType.Media.KeyT, bytes]:
+        ''' Returns (icns key, data). Nested icns data is without header. '''
+        return self._once(self._sources, os.path.normpath(fname),
+                          self._load)  # type: ignore[no-any-return]
+
+    def nested(self, sources: Iterable[str]) -> bytes:
+        ''' Compose (shared) nested icns data. Without icns header. '''
+        key = tuple(os.path.normpath(x) for x in sources)
+        return self._once(self._nested, key, lambda x: self.compose(
+            x).icns_data()[8:])  # type: ignore[no-any-return]
+
+    def compose(self, sources: Iterable[str]) -> IcnsFile:
+        img = IcnsFile()
+        for fname in sources:
+            key, data = self.get(fname)
+            if key in img.media:
+                raise BuildError('Image with identical key "{}". File: {}'
+                                 .format(str(key), fname))
+            img.media[key] = data
+        return img
+
+    def _once(self, cache: Dict[Any, Future], key: Any, fn: Any) -> Any:
+        with self._lock:
+            future = cache.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = cache[key] = Future()
+        if is_owner:
+            try:
+                future.set_result(fn(key))  # type: ignore[union-attr]
+            except Exception as e:
+                future.set_exception(e)  # type: ignore[union-attr]
+        return future.result()  # type: ignore[union-attr]
+
+    def _load(self, fname: str) -> Tuple[IcnsType.Media.KeyT, bytes]:
+        if self.cache:
+            return self.cache.load(fname, self._read)
+        return self._read(fname)
+
+    def _read(self, fname: str) -> Tuple[IcnsType.Media.KeyT, bytes]:
+        with self._lock:
+            self.loaded += 1
+        return load_source(fname)
+
+
+class Watcher:
+    '''
+    Keep an icns file in sync with its sources.
+    Each `poll()` re-enumerates the sources (incl. `.iconset` directories)
+    and only re-loads files which were added or modified since last poll.
+    '''
+
+    def __init__(
+        self,
+        target: str,
+        sources: List[str],
+        *,
+        toc: bool = False,
+        layout: str = 'as-is',
+        cache: Optional[BuildCache] = None,
+    ) -> None:
+        self.target = target
+        self.sources = sources
+        self.toc = toc
+        self.layout = layout
+        self.cache = cache
+        self.img = IcnsFile()
+        # {fname: ((size, mtime), key)}
+        self._state = {}  # type: Dict[str, Tuple[Tuple[int, int], Any]]
+
+    def poll(self) -> List[str]:
+        '''
+        Update media of changed sources and rewrite target (atomically).
+        Returns list of added, modified, or removed files.
+        :raises:
+            BuildError: if two source files map to the same icns key
+        '''
+        changed = {}  # type: Dict[str, Tuple[Tuple[int, int], Any, bytes]]
+        current = set()
+        for fname in enum_sources(self.sources):
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue  # treat as removed
+            current.add(fname)
+            sig = (st.st_size, st.st_mtime_ns)
+            prev = self._state.get(fname)
+            if not prev or prev[0] != sig:
+                if self.cache:
+                    key, data = self.cache.load(fname, load_source)
+                else:
+                    key, data = load_source(fname)
+                changed[fname] = (sig, key, data)
+        removed = [x for x in self._state if x not in current]
+        if not changed and not removed:
+            return []
+
+        # Verify new state before modifying media
+        new_state = {k: v for k, v in self._state.items() if k in current}
+        new_state.update({k: (v[0], v[1]) for k, v in changed.items()})
+        owner = {}  # type: Dict[Any, str]
+        for fname, (_, key) in sorted(new_state.items()):
+            if key in owner:
+                raise BuildError('Image with identical key "{}". File: {}'
+                                 .format(str(key), fname))
+            owner[key] = fname
+
+        for fname in removed + list(changed):
+            if fname in self._state:
+                del self.img.media[self._state[fname][1]]
+        for fname, (_, key, data) in changed.items():
+            self.img.media[key] = data
+        self._state = new_state
+        _atomic_write(self.target, self.img.icns_data(
+            toc=self.toc, layout=self.layout))
+        return sorted(removed + list(changed))
+
+    def run(
+        self,
+        interval: float = 0.5,
+        callback: Optional[Callable[[List[str]], None]] = None,
+        on_error: Optional[Callable[[Exception], None]] = None,
+    ) -> None:
+        '''
+        Poll forever (until KeyboardInterrupt).
+        Identical consecutive errors are reported only once.
+        '''
+        prev_error = None
+        try:
+            while True:
+                try:
+                    files = self.poll()
+                    prev_error = None
+                    if files and callback:
+                        callback(files)
+                except (OSError, BuildError, IcnsType.CanNotDetermine) as e:
+                    if not on_error:
+                        raise
+                    if str(e) != prev_error:
+                        on_error(e)
+                    prev_error = str(e)
+                sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+def load_source(fname: str) -> Tuple[IcnsType.Media.KeyT, bytes]:
+    ''' Read file and guess icns key. Nested icns data is without header. '''
+    with open(fname, 'rb') as fp:
+        data = fp.read()
+    iType = IcnsType.guess(data, fname)
+    # Nested icns files must omit the icns header
+    if iType.is_type('icns') and data[:4] == b'icns':
+        data = data[8:]
+    return iType.key, data
+
+
+def enum_sources(sources: Iterable[str]) -> Iterator[str]:
+    ''' Expand `.iconset` directories to all supported media files. '''
+    allowed_ext = IcnsType.supported_extensions()
+    for x in sources:
+        if x.lower().endswith('.iconset'):  # enum directory content
+            for fname in sorted(os.listdir(x)):
+                if os.path.splitext(fname)[1][1:].lower() in allowed_ext:
+                    yield os.path.join(x, fname)
+        else:
+            yield x
+
+
+def load_manifest(fname: str) -> Dict[str, Dict[str, Any]]:
+    '''
+    Read manifest file and return {target: options} with all paths
+    resolved relative to the manifest location.
+    '''
+    with open(fname, 'r', encoding='utf-8') as fp:
+        try:
+            manifest = json.load(fp)
+        except ValueError as e:
+            raise BuildError('Invalid manifest "{}": {}'.format(fname, e))
+    outputs = manifest.get('outputs') if isinstance(manifest, dict) else None
+    if not isinstance(outputs, dict):
+        raise BuildError('Manifest is missing "outputs" object.')
+
+    root = os.path.dirname(fname)
+    ret = {}
+    for target, opts in outputs.items():
+        if isinstance(opts, list):
+            opts = {'sources': opts}
+        if not isinstance(opts, dict):
+            raise BuildError('Invalid output "{}"'.format(target))
+        layout = opts.get('layout') or 'as-is'
+        if layout not in IcnsFile.LAYOUTS:
+            raise BuildError('Invalid layout "{}" of output "{}"'.format(
+                layout, target))
+        resolved = {'toc': bool(opts.get('toc')),
+                    'layout': layout}  # type: Dict[str, Any]
+        for field in ['sources'] + NESTED_KEYS:
+            paths = opts.get(field) or []
+            if isinstance(paths, str):
+                paths = [paths]
+            resolved[field] = list(enum_sources(
+                os.path.join(root, x) for x in paths))
+        ret[os.path.join(root, target)] = resolved
+    return ret
+
+
+def build(
+    outputs: Dict[str, Dict[str, Any]],
+    *,
+    jobs: Optional[int] = None,
+    pool: Optional[SourcePool] = None,
+) -> List[BuildResult]:
+    '''
+    Build all outputs in parallel. Sources are shared between outputs.
+    - outputs : {target: {sources, dark, selected, template, toc, layout}}
+    - pool : Provide a `SourcePool(cache)` to skip unchanged outputs.
+    Errors are reported per output and do not stop other builds.
+    '''
+    src_pool = pool or SourcePool()
+    cache = src_pool.cache
+
+    def fn(target: str) -> BuildResult:
+        ret = BuildResult(target)
+        start = perf_counter()
+        try:
+            if cache:
+                digest = cache.output_digest(outputs[target])
+                ret.skipped = cache.is_up_to_date(target, digest)
+            if not ret.skipped:
+                build_single(target, outputs[target], src_pool, ret)
+                if cache:
+                    cache.record(target, digest)
+        except (OSError, KeyError, BuildError, IcnsType.CanNotDetermine) \
+                as e:
+            ret.error = str(e)
+        ret.duration = perf_counter() - start
+        return ret
+
+    with ThreadPoolExecutor(jobs or os.cpu_count() or 1) as executor:
+        return list(executor.map(fn, outputs.keys()))
+
+
+def build_single(
+    target: str,
+    opts: Dict[str, Any],
+    pool: SourcePool,
+    result: Optional[BuildResult] = None,
+) -> None:
+    img = pool.compose(opts.get('sources') or [])
+    for name in NESTED_KEYS:
+        if opts.get(name):
+            img.media[IcnsType.key_from_readable(name)] = \
+                pool.nested(opts[name])
+    if not img.media:
+        raise BuildError('No sources provided.')
+    outdir = os.path.dirname(target)
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+    img.write(target, toc=opts.get('toc', False),
+              layout=opts.get('layout') or 'as-is')
+    if result:
+        result.keys = list(img.media.keys())
+
+
+def _atomic_write(fname: str, data: bytes) -> None:
+    # unique per thread, build() may write the same cache entry twice
+    tmp = '{}.{}-{}.tmp'.format(fname, os.getpid(), get_ident())
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp, fname)
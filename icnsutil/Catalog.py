@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+'''
+Queryable catalog (SQLite database) of icns files and their media entries.
+
+Tables:
+  files   (path, size, mtime_ns, error)
+  entries (path, idx, key, offset, length, ext, width, height, sha256)
+
+Only entry headers (and the first bytes of each payload) are parsed.
+Files are re-indexed only if size or modification time have changed.
+'''
+import os  # path, stat, walk
+import sqlite3
+import struct  # error
+from hashlib import sha256
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from typing import Tuple
+from . import IcnsType, RawData
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    ext TEXT,
+    width INTEGER,
+    height INTEGER,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (path, idx)
+);
+CREATE INDEX IF NOT EXISTS entries_key ON entries (key);
+CREATE INDEX IF NOT EXISTS entries_sha256 ON entries (sha256);
+'''
+
+# name: (description, SQL). Use `?` for positional parameters.
+QUERIES = {
+    'summary': ('number of files, entries, and total payload size', '''
+        SELECT (SELECT COUNT(*) FROM files) AS files,
+               COUNT(*) AS entries, COALESCE(SUM(length), 0) AS bytes
+        FROM entries'''),
+    'keys': ('number of entries and payload size per key', '''
+        SELECT key, COUNT(*) AS entries, SUM(length) AS bytes
+        FROM entries GROUP BY key ORDER BY key'''),
+    'ext': ('number of entries and payload size per data type', '''
+        SELECT ext, COUNT(*) AS entries, SUM(length) AS bytes
+        FROM entries GROUP BY ext ORDER BY bytes DESC'''),
+    'with': ('files which contain KEY', '''
+        SELECT DISTINCT path FROM entries WHERE key = ? ORDER BY path'''),
+    'missing': ('files which do not contain KEY', '''
+        SELECT path FROM files WHERE error IS NULL AND path NOT IN (
+            SELECT path FROM entries WHERE key = ?) ORDER BY path'''),
+    'duplicates': ('payloads which occur in more than one file', '''
+        SELECT sha256, length, COUNT(DISTINCT path) AS files
+        FROM entries GROUP BY sha256 HAVING files > 1
+        ORDER BY length * files DESC'''),
+    'errors': ('files which could not be parsed', '''
+        SELECT path, error FROM files WHERE error IS NOT NULL
+        ORDER BY path'''),
+}  # type: Dict[str, Tuple[str, str]]
+
+_HEAD = 512  # enough for PNG and JPEG 2000 image headers
+
+
+class UpdateResult:
+    __slots__ = ['indexed', 'unchanged', 'removed', 'failed']
+
+    def __init__(self) -> None:
+        self.indexed = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.failed = 0
+
+    def __str__(self) -> str:
+        return '{} indexed, {} unchanged, {} removed, {} failed'.format(
+            self.indexed, self.unchanged, self.removed, self.failed)
+
+
+class Catalog:
+    def __init__(self, path: str, *, readonly: bool = False) -> None:
+        '''
+        Open (or create) catalog database.
+        - readonly : Open existing database in read-only mode (ad-hoc SQL).
+        '''
+        self.path = path
+        if readonly:
+            if not os.path.isfile(path):
+                raise OSError('Catalog "{}" does not exist.'.format(path))
+            self.db = sqlite3.connect(
+                'file:{}?mode=ro'.format(os.path.abspath(path)), uri=True)
+        else:
+            self.db = sqlite3.connect(path)
+            self.db.executescript(_SCHEMA)
+
+    def __enter__(self) -> 'Catalog':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def update(self, paths: Iterable[str], *, prune: bool = True) \
+            -> UpdateResult:
+        '''
+        Index all icns files (directories are searched recursively).
+        - prune : Remove catalog entries of deleted files within directories.
+        '''
+        res = UpdateResult()
+        known = {path: (size, mtime) for path, size, mtime in self.db.execute(
+            'SELECT path, size, mtime_ns FROM files')}
+        for root in paths:
+            seen = set()
+            for fname in enum_icns_files(root):
+                path = os.path.abspath(fname)
+                try:
+                    st = os.stat(path)
+                except OSError:  # deleted or replaced while indexing
+                    res.failed += 1
+                    continue
+                seen.add(path)
+                if known.get(path) == (st.st_size, st.st_mtime_ns):
+                    res.unchanged += 1
+                    continue
+                with self.db:  # one transaction per file
+                    if self._index_file(path, st.st_size, st.st_mtime_ns):
+                        res.indexed += 1
+                    else:
+                        res.failed += 1
+            if prune and os.path.isdir(root):
+                prefix = os.path.join(os.path.abspath(root), '')
+                gone = [x for x in known if x.startswith(prefix)
+                        and x not in seen]
+                with self.db:
+                    for path in gone:
+                        self._remove(path)
+                res.removed += len(gone)
+        return res
+
+    def query(self, sql: str, params: Iterable[Any] = ()) \
+            -> Tuple[List[str], List[Tuple[Any, ...]]]:
+        '''
+        Run canned query (see `QUERIES`) or SQL statement.
+        Returns (column names, rows).
+        '''
+        if sql in QUERIES:
+            sql = QUERIES[sql][1]
+        cur = self.db.execute(sql, tuple(params))
+        columns = [x[0] for x in cur.description or []]
+        return columns, cur.fetchall()
+
+    def _index_file(self, path: str, size: int, mtime_ns: int) -> bool:
+        self._remove(path)
+        rows = []
+        error = None  # type: Optional[str]
+        try:
+            with RawData.FileReader(path) as reader:
+                for i, (key, offset, length) in enumerate(
+                        RawData.parse_icns_index(reader)):
+                    ext, dim, digest = probe_entry(
+                        reader, key, offset, length)
+                    rows.append((path, i, IcnsType.key_to_readable(key),
+                                 offset, length, ext, dim and dim[0],
+                                 dim and dim[1], digest))
+        except (OSError, RawData.ParserError) as e:
+            error = str(e) or type(e).__name__
+            rows = []
+        self.db.execute('INSERT INTO files VALUES (?, ?, ?, ?)',
+                        (path, size, mtime_ns, error))
+        self.db.executemany('INSERT INTO entries VALUES '
+                            '(?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return error is None
+
+    def _remove(self, path: str) -> None:
+        self.db.execute('DELETE FROM entries WHERE path = ?', (path,))
+        self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+
+def enum_icns_files(path: str) -> Iterator[str]:
+    ''' Yield path if it is a file or all .icns files in directory. '''
+    if not os.path.isdir(path):
+        yield path
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fname in sorted(files):
+            if fname.lower().endswith('.icns'):
+                yield os.path.join(root, fname)
+
+
+def probe_entry(
+    reader: RawData.ReaderAt, key: IcnsType.Media.KeyT, offset: int,
+    length: int,
+) -> Tuple[Optional[str], Optional[Tuple[int, int]], str]:
+    '''
+    Determine (ext, image size, sha256) of a single payload.
+    Type and size are read from the first few bytes (or derived from key).
+    The hash is calculated in chunks.
+    '''
+    head = reader.read_at(offset, min(length, _HEAD))
+    ext = RawData.determine_file_ext(head)
+    try:
+        iType = IcnsType.get(key)  # type: Optional[IcnsType.Media]
+    except NotImplementedError:
+        iType = None
+    if not ext and iType:  # same fallback as export
+        if iType.is_type('icns'):
+            ext = 'icns'
+        else:
+            ext = 'rgb' if iType.compressable else 'bin'
+
+    size = None  # type: Optional[Tuple[int, int]]
+    if ext in ['png', 'jp2']:
+        try:
+            size = RawData.determine_image_size(head, ext)
+        except struct.error:
+            pass  # header beyond probed bytes or invalid
+    elif iType and iType.size and ext != 'icns':
+        size = iType.size
+
+    h = sha256(head)
+    for chunk in RawData.read_payload(
+            reader, offset + len(head), length - len(head)):
+        h.update(chunk)
+    return ext, size, h.hexdigest()
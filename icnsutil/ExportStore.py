@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+'''
+Content-addressed storage for exported media files.
+
+Every distinct payload is written once (`objects/<hash[:2]>/<hash>.<ext>`)
+and all export filenames are links to that object. The manifest
+(`manifest.json`) maps each extracted icns file to {key: hash}.
+Nested icns files (recursive export) are stored as nested objects.
+
+Note: hardlinked exports share their data. Editing one of them will
+modify all other exports with the same content (copy before editing).
+'''
+import os  # link, makedirs, path, remove, symlink
+import json  # load, dumps
+from hashlib import sha256
+from threading import Lock
+from typing import Any, Dict, Union
+from . import IcnsType
+
+ManifestEntry = Dict[str, Union[str, Dict[str, Any]]]
+
+
+class ExportStore:
+    '''
+    Deduplicating export target. Pass to `IcnsFile.export(store=...)`.
+    - link : 'hard' (default) or 'sym'. Falls back to symlinks if
+             hardlinks are not supported (e.g., different devices).
+    '''
+
+    def __init__(self, path: str, *, link: str = 'hard') -> None:
+        if link not in ['hard', 'sym']:
+            raise ValueError('Unknown link type "{}"'.format(link))
+        self.path = path
+        self.link = link
+        self.written = 0  # number of new objects
+        self.written_bytes = 0
+        self.deduplicated = 0  # number of links to existing objects
+        self.deduplicated_bytes = 0
+        self._names = {}  # type: Dict[str, str] # export path: hash
+        self._lock = Lock()
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        try:
+            with open(self.manifest_path, 'r') as fp:
+                self.manifest = json.load(fp)  # type: Dict[str, Any]
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def __enter__(self) -> 'ExportStore':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.save()
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.path, 'manifest.json')
+
+    def put(self, fname: str, data: bytes) -> str:
+        '''
+        Store data (if not already stored) and link `fname` to the object.
+        Existing files at `fname` are replaced. Returns the content hash.
+        '''
+        digest = sha256(data).hexdigest()
+        obj = self.object_path(digest, os.path.splitext(fname)[1])
+        with self._lock:
+            if os.path.exists(obj):
+                self.deduplicated += 1
+                self.deduplicated_bytes += len(data)
+            else:
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                tmp = '{}.{}.tmp'.format(obj, os.getpid())
+                with open(tmp, 'wb') as fp:
+                    fp.write(data)
+                os.replace(tmp, obj)
+                self.written += 1
+                self.written_bytes += len(data)
+            self._names[os.path.abspath(fname)] = digest
+        self._link(obj, fname)
+        return digest
+
+    def object_path(self, digest: str, ext: str = '') -> str:
+        return os.path.join(self.path, 'objects', digest[:2], digest + ext)
+
+    def record(self, export_files: Dict[Any, Any]) -> ManifestEntry:
+        '''
+        Add the result of `IcnsFile.export()` to the manifest.
+        Returns the manifest entry {key: hash} of the extracted file.
+        '''
+        entry = self._entry(export_files)
+        infile = export_files.get('_')
+        if infile:
+            with self._lock:
+                self.manifest[os.path.abspath(infile)] = entry
+        return entry
+
+    def save(self) -> None:
+        tmp = '{}.{}.tmp'.format(self.manifest_path, os.getpid())
+        with self._lock:
+            with open(tmp, 'w') as fp:
+                fp.write(json.dumps(self.manifest, indent=2, sort_keys=True))
+        os.replace(tmp, self.manifest_path)
+
+    def _entry(self, export_files: Dict[Any, Any]) -> ManifestEntry:
+        ret = {}  # type: ManifestEntry
+        for key, value in export_files.items():
+            if key == '_':  # source filename
+                continue
+            readable = IcnsType.key_to_readable(key)
+            if isinstance(value, dict):  # recursive export
+                ret[readable] = self._entry(value)
+            else:
+                ret[readable] = self._names[os.path.abspath(value)]
+        return ret
+
+    def _link(self, obj: str, fname: str) -> None:
+        if os.path.lexists(fname):
+            if os.path.exists(fname) and os.path.samefile(obj, fname):
+                return  # already linked (e.g., repeated export)
+            os.remove(fname)
+        if self.link == 'hard':
+            try:
+                os.link(obj, fname)
+                return
+            except OSError:
+                pass  # fallback to symlink
+        os.symlink(os.path.relpath(obj, os.path.dirname(fname) or '.'), fname)
+
+    def __str__(self) -> str:
+        return '{} new ({} bytes), {} deduplicated ({} bytes saved)'.format(
+            self.written, self.written_bytes,
+            self.deduplicated, self.deduplicated_bytes)
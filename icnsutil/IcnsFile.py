@@ -1,25 +1,41 @@
 #!/usr/bin/env python3
 import os  # path, makedirs, remove
 import struct  # unpack float in _description()
+from hashlib import sha256
+from io import BytesIO
 from sys import stderr
+from concurrent.futures import Executor, wait
 from typing import Iterator, Iterable, Tuple, Optional, List, Dict, Union
-from . import RawData, IcnsType
+from typing import BinaryIO, Set, TYPE_CHECKING
+from . import RawData, IcnsType, SharedPayload
 from .ArgbImage import ArgbImage
+if TYPE_CHECKING:
+    from .ExportStore import ExportStore
+
+_METADATA_KEYS = ['icnV', 'name', 'info']  # see IcnsFile.LAYOUTS
 
 
 class IcnsFile:
     __slots__ = ['media', 'infile']
+    # Order of entries when writing. TOC is always first.
+    # as-is : insertion order of media
+    # small-first : ascending payload size
+    # tiles-first : ascending image size (rendering priority)
+    LAYOUTS = ('as-is', 'small-first', 'tiles-first')
 
     @staticmethod
-    def verify(fname: str) -> Iterator[str]:
+    def verify(fname: Optional[str] = None, *, data: Optional[bytes] = None) \
+            -> Iterator[str]:
         '''
         Yields an error message for each issue.
         You can check for validity with `is_invalid = any(obj.verify())`
+        Provide either a filename or the raw binary data of an icns file.
         '''
+        raw = data
         all_keys = set()
         bin_keys = set()
         try:
-            for key, data in RawData.parse_icns_file(fname):
+            for key, data in IcnsFile._parse(fname, raw):
                 all_keys.add(key)
                 # Check if icns type is known
                 try:
@@ -44,7 +60,12 @@ class IcnsFile:
                 if key == 'it32' and data[:4] != b'\x00\x00\x00\x00':
                     # TODO: check whether other it32 headers exist
                     yield 'Unexpected it32 data header: ' + str(data[:4])
-                udata = iType.decompress(data, ext) or data
+                try:
+                    udata = iType.decompress(data, ext) or data
+                except RawData.ParserError as e:
+                    yield 'Invalid data length for {}: {}'.format(
+                        str(key), e)
+                    continue
 
                 # Check expected uncompressed maxsize
                 if iType.maxsize and len(udata) != iType.maxsize:
@@ -56,9 +77,15 @@ class IcnsFile:
             return
 
         # Check total size after enum. Enum may raise exception and break early
-        with open(fname, 'rb') as fp:
-            _, header_size = RawData.icns_header_read(fp.read(8))
-        actual_size = os.path.getsize(fname)
+        if raw is not None:  # same precedence as _parse()
+            head = raw[:8]
+            actual_size = len(raw)
+        else:
+            assert(fname)  # or _parse() would have raised
+            with open(fname, 'rb') as fp:
+                head = fp.read(8)
+            actual_size = os.path.getsize(fname)
+        _, header_size = RawData.icns_header_read(head)
         if header_size != actual_size:
             yield 'header file-size != actual size: {} != {}'.format(
                 header_size, actual_size)
@@ -79,14 +106,85 @@ class IcnsFile:
                     x, y)
 
     @staticmethod
-    def description(fname: str, *, verbose: bool = False, indent: int = 0) \
-            -> str:
+    def description(
+        fname: Optional[str] = None,
+        *,
+        data: Optional[bytes] = None,
+        reader: Optional[RawData.ReaderAt] = None,
+        verbose: bool = False,
+        indent: int = 0,
+    ) -> str:
+        '''
+        - reader : Read entry headers and the first bytes of each payload
+                   only (e.g., remote files). Takes precedence.
+        '''
+        if reader:
+            enumerator = IcnsFile._parse_heads(reader)
+        else:
+            enumerator = ((key, len(data), data)
+                          for key, data in IcnsFile._parse(fname, data))
         return IcnsFile._description(
-            RawData.parse_icns_file(fname), verbose=verbose, indent=indent)
+            enumerator, verbose=verbose, indent=indent)
+
+    @staticmethod
+    def diff(file_a: str, file_b: str, *, pixels: bool = False) \
+            -> Iterator[str]:
+        '''
+        Compare two icns files by key, length, and content hash.
+        Only entry headers are parsed, pixel data is not decoded.
+        Yields one line per difference (no output if files are equal):
+          - key: N bytes            (only in file_a)
+          + key: N bytes            (only in file_b)
+          ~ key: N -> M bytes       (content changed)
+          @ key: offset N -> M      (same content, different position)
+        - pixels : Decode changed RGB, ARGB, and mask entries and
+                   report the number of differing pixels.
+        '''
+        with open(file_a, 'rb') as fa, open(file_b, 'rb') as fb:
+            index_a = {k: (o, n) for k, o, n in RawData.parse_icns_index(fa)}
+            index_b = {k: (o, n) for k, o, n in RawData.parse_icns_index(fb)}
+            for key, (off_a, len_a) in index_a.items():
+                name = IcnsType.key_to_readable(key)
+                if key not in index_b:
+                    yield '- {}: {} bytes'.format(name, len_a)
+                    continue
+                off_b, len_b = index_b[key]
+                if len_a == len_b and _payload_hash(fa, off_a, len_a) == \
+                        _payload_hash(fb, off_b, len_b):
+                    if off_a != off_b:
+                        yield '@ {}: offset {} -> {}'.format(
+                            name, off_a, off_b)
+                    continue
+                txt = '~ {}: {} -> {} bytes'.format(name, len_a, len_b)
+                if pixels:
+                    fa.seek(off_a)
+                    fb.seek(off_b)
+                    txt += _pixel_diff(key, fa.read(len_a), fb.read(len_b))
+                yield txt
+            for key, (_, len_b) in index_b.items():
+                if key not in index_a:
+                    yield '+ {}: {} bytes'.format(
+                        IcnsType.key_to_readable(key), len_b)
+
+    @staticmethod
+    def _parse(fname: Optional[str], data: Optional[bytes]) \
+            -> Iterator[Tuple[IcnsType.Media.KeyT, bytes]]:
+        if data is not None:
+            return RawData.parse_icns_data(data)
+        if not fname:
+            raise AttributeError('Neither data nor file provided.')
+        return RawData.parse_icns_file(fname)
+
+    @staticmethod
+    def _parse_heads(reader: RawData.ReaderAt) \
+            -> Iterator[Tuple[IcnsType.Media.KeyT, int, bytes]]:
+        for key, offset, length in RawData.parse_icns_index(reader):
+            n = length if key in ['name', 'icnV'] else min(length, 8)
+            yield key, length, reader.read_at(offset, n)
 
     @staticmethod
     def _description(
-        enumerator: Iterable[Tuple[IcnsType.Media.KeyT, bytes]],
+        enumerator: Iterable[Tuple[IcnsType.Media.KeyT, int, bytes]],
         *,
         verbose: bool = False,
         indent: int = 0,
@@ -95,8 +193,7 @@ class IcnsFile:
         txt = ''
         offset = 8  # already with icns header
         try:
-            for key, data in enumerator:
-                size = len(data)
+            for key, size, data in enumerator:
                 txt += os.linesep + ' ' * indent
                 txt += '{}: {} bytes'.format(str(key), size)
                 if verbose:
@@ -121,13 +218,26 @@ class IcnsFile:
         except RawData.ParserError as e:
             return ' ' * indent + str(e)
 
-    def __init__(self, file: Optional[str] = None) -> None:
-        ''' Read .icns file and load bundled media files into memory. '''
+    def __init__(
+        self,
+        file: Optional[str] = None,
+        *,
+        data: Union[bytes, memoryview, None] = None,
+    ) -> None:
+        '''
+        Read .icns file and load bundled media files into memory.
+        If data is provided, parse in-memory icns data instead. Data may be
+        the payload of a nested icns entry (without icns header).
+        '''
         self.media = {}  # type: Dict[IcnsType.Media.KeyT, bytes]
         self.infile = file
-        if not file:  # create empty image
+        if not file and data is None:  # create empty image
             return
-        for key, data in RawData.parse_icns_file(file):
+        if data is not None:
+            entries = RawData.parse_icns_data(data, nested=True)
+        else:
+            entries = IcnsFile._parse(file, None)
+        for key, data in entries:
             self.media[key] = data
             try:
                 IcnsType.get(key)
@@ -184,16 +294,33 @@ class IcnsFile:
         del self.media[key]
         return True
 
-    def write(self, fname: str, *, toc: bool = False) -> None:
-        ''' Create a new ICNS file from stored media. '''
+    def write(
+        self, fname: str, *, toc: bool = False, layout: str = 'as-is',
+    ) -> None:
+        '''
+        Create a new ICNS file from stored media.
+        - layout : Order of entries, one of `IcnsFile.LAYOUTS`.
+                   Metadata (icnV, name, info) is written last unless as-is.
+        '''
+        self._layout_order(layout)  # fail before creating file
+        with open(fname, 'wb') as fp:
+            self._write_stream(fp, toc=toc, layout=layout)
+
+    def icns_data(self, *, toc: bool = False, layout: str = 'as-is') \
+            -> bytes:
+        ''' Same as `write()` but return the icns file as bytes. '''
+        fp = BytesIO()
+        self._write_stream(fp, toc=toc, layout=layout)
+        return fp.getvalue()
+
+    def _write_stream(self, fp: BinaryIO, *, toc: bool, layout: str) -> None:
         # Rebuild TOC to ensure soundness
-        order = self._make_toc(enabled=toc)
+        order = self._make_toc(enabled=toc, layout=layout)
         # Total file size has always +8 for media header (after _make_toc)
         total = sum(len(x) + 8 for x in self.media.values())
-        with open(fname, 'wb') as fp:
-            fp.write(RawData.icns_header_w_len(b'icns', total))
-            for key in order:
-                RawData.icns_header_write_data(fp, key, self.media[key])
+        fp.write(RawData.icns_header_w_len(b'icns', total))
+        for key in order:
+            RawData.icns_header_write_data(fp, key, self.media[key])
 
     def export(
         self,
@@ -204,9 +331,14 @@ class IcnsFile:
         convert_png: bool = False,
         decompress: bool = False,
         recursive: bool = False,
+        store: Optional['ExportStore'] = None,
+        executor: Optional[Executor] = None,
+        io_executor: Optional[Executor] = None,
     ) -> Dict[IcnsType.Media.KeyT, Union[str, Dict]]:
         '''
         Write all bundled media files to output directory.
+        All filenames are determined before any file is written. Names which
+        would overwrite each other get the icns type as suffix.
 
         - outdir : If none provided, use same directory as source file.
         - allowed_ext : Export only data with matching extension(s).
@@ -214,7 +346,14 @@ class IcnsFile:
         - convert_png : If True, convert rgb and argb images to png.
         - decompress : Only relevant for ARGB and 24-bit binary images.
         - recursive : Repeat export for all attached icns files.
+                      Nested files are parsed from memory and exported
+                      into "<name>.icns.export" (next to "<name>.icns").
                       Incompatible with png_only flag.
+        - store : Write each distinct payload once into `ExportStore` and
+                  link export filenames to it.
+        - executor : Run PNG conversions in parallel. Payloads are passed to
+                     worker processes via shared memory.
+        - io_executor : Write files in parallel (e.g., ThreadPoolExecutor).
         '''
         if not outdir:  # aka, determine by input file
             # Determine filename and prepare output directory
@@ -223,58 +362,75 @@ class IcnsFile:
         elif not os.path.isdir(outdir):
             raise OSError('"{}" is not a directory. Abort.'.format(outdir))
 
+        plan = _ExportPlan(outdir)
         export_files = {}  # type: Dict[IcnsType.Media.KeyT, Union[str, Dict]]
         if self.infile:
             export_files['_'] = self.infile
         keys = list(self.media.keys())
         # Convert to PNG
+        tasks = []  # type: List[_PngTask]
         if convert_png:
-            for imgk, maskk in IcnsType.enum_png_convertable(keys):
-                fname = self._export_to_png(outdir, imgk, maskk, key_suffix)
-                if not fname:
+            # masks can be shared (e.g., ICN# for icl4, icl8, and itself)
+            for imgk, maskk in list(IcnsType.enum_png_convertable(keys)):
+                name = self._png_filename(imgk, key_suffix,
+                                          plan.case_sensitive)
+                if not name:
                     continue
+                fname = plan.add(name, imgk)
+                tasks.append((fname, imgk, maskk))
                 export_files[imgk] = fname
                 if maskk:
-                    export_files[maskk] = fname
+                    export_files.setdefault(maskk, fname)
                     if maskk in keys:
                         keys.remove(maskk)
-                keys.remove(imgk)
+                if imgk in keys:
+                    keys.remove(imgk)
 
         # prepare filter
         allowed = [] if allowed_ext == '*' else allowed_ext.split(',')
-        if recursive:
-            cleanup = allowed and 'icns' not in allowed
-            if cleanup:
-                allowed.append('icns')
+        skip_icns = recursive and bool(allowed) and 'icns' not in allowed
+        if skip_icns:
+            allowed.append('icns')  # export contents but do not write file
 
         # Export remaining
+        files = []  # type: List[Tuple[str, bytes]]
+        nested = []  # type: List[Tuple[IcnsType.Media.KeyT, str]]
         for key in keys:
-            fname = self._export_single(outdir, key, key_suffix,
-                                        decompress, allowed)
-            if fname:
-                export_files[key] = fname
-
-        # repeat for all icns
-        if recursive:
-            for old_key, old_name in export_files.items():
-                assert(isinstance(old_name, str))
-                if not old_name.endswith('.icns') or old_key == '_':
+            entry = self._export_single(key, key_suffix, decompress, allowed,
+                                        plan.case_sensitive)
+            if not entry:
+                continue
+            fname = plan.add(entry[0], key)
+            export_files[key] = fname
+            if recursive and fname.endswith('.icns'):
+                nested.append((key, fname))
+                if skip_icns:
                     continue
-                export_files[old_key] = IcnsFile(old_name).export(
-                    allowed_ext=allowed_ext, key_suffix=key_suffix,
-                    convert_png=convert_png, decompress=decompress,
-                    recursive=True)
-                if cleanup:
-                    os.remove(old_name)
+            files.append((fname, entry[1]))
+
+        # Write all files
+        files = self._convert_png(tasks, executor) + files
+        IcnsFile._write_exports(files, store, io_executor)
+
+        # repeat for all icns (parsed from memory, not the exported file)
+        for key, fname in nested:
+            icns = IcnsFile(data=self.media[key])
+            icns.infile = fname  # outdir and '_' in result
+            export_files[key] = icns.export(
+                allowed_ext=allowed_ext, key_suffix=key_suffix,
+                convert_png=convert_png, decompress=decompress,
+                recursive=True, store=store, executor=executor,
+                io_executor=io_executor)
         return export_files
 
-    def _make_toc(self, *, enabled: bool) -> List[IcnsType.Media.KeyT]:
+    def _make_toc(self, *, enabled: bool, layout: str = 'as-is') \
+            -> List[IcnsType.Media.KeyT]:
         # Rebuild TOC to ensure soundness
+        order = self._layout_order(layout)
         if self.has_toc():
             del self.media['TOC ']
         # We loop two times over the keys; so, make sure order is identical.
         # By default this will be the same order as read/written.
-        order = list(self.media.keys())
         if enabled:
             self.media['TOC '] = b''.join(
                 RawData.icns_header_w_len(x, len(self.media[x]))
@@ -284,15 +440,34 @@ class IcnsFile:
 
         return order
 
+    def _layout_order(self, layout: str) -> List[IcnsType.Media.KeyT]:
+        ''' Keys in write order (without TOC). '''
+        keys = [x for x in self.media.keys() if x != 'TOC ']
+        if layout == 'as-is':
+            return keys
+        if layout not in self.LAYOUTS:
+            raise ValueError('Unknown layout "{}", use one of: {}'.format(
+                layout, ', '.join(self.LAYOUTS)))
+        meta = [x for x in keys if x in _METADATA_KEYS]
+        keys = [x for x in keys if x not in meta]
+        if layout == 'small-first':
+            keys.sort(key=lambda x: len(self.media[x]))
+        else:
+            keys.sort(key=lambda x: _render_rank(x, self.media[x]))
+        return keys + meta
+
     def _export_single(
         self,
-        outdir: str,
         key: IcnsType.Media.KeyT,
         key_suffix: bool,
         decompress: bool,
         allowed: List[str],
-    ) -> Optional[str]:
-        ''' You must ensure that keys exist in self.media '''
+        case_sensitive: bool,
+    ) -> Optional[Tuple[str, bytes]]:
+        '''
+        Returns (filename, data) or None if extension is not allowed.
+        You must ensure that keys exist in self.media
+        '''
         data = self.media[key]
         ext = RawData.determine_file_ext(data)
         if ext == 'icns' and data[:4] != b'icns':
@@ -300,7 +475,8 @@ class IcnsFile:
             data = header + data  # Add missing icns header
         try:
             iType = IcnsType.get(key)
-            fname = iType.filename(key_only=key_suffix)
+            fname = iType.filename(key_only=key_suffix,
+                                   case_sensitive=case_sensitive)
             if decompress:
                 data = iType.decompress(data, ext) or data  # type: ignore
             if not ext:  # overwrite ext after (decompress requires None)
@@ -312,31 +488,63 @@ class IcnsFile:
 
         if allowed and ext not in allowed:
             return None
-        fname = os.path.join(outdir, fname + '.' + ext)
-        with open(fname, 'wb') as fp:
-            fp.write(data)
-        return fname
+        return fname + '.' + ext, data
 
-    def _export_to_png(
+    def _png_filename(
         self,
-        outdir: str,
         img_key: IcnsType.Media.KeyT,
-        mask_key: Optional[IcnsType.Media.KeyT],
         key_suffix: bool,
+        case_sensitive: bool,
     ) -> Optional[str]:
-        ''' You must ensure key and mask_key exists! '''
-        data = self.media[img_key]
-        if RawData.determine_file_ext(data) not in ['argb', None]:
+        ''' Returns None if media is not convertable. '''
+        if RawData.determine_file_ext(self.media[img_key]) not in [
+                'argb', None]:
             return None  # icp4 and icp5 can have png or jp2 data
         iType = IcnsType.get(img_key)
-        fname = iType.filename(key_only=key_suffix, size_only=True)
-        fname = os.path.join(outdir, fname + '.png')
-        if iType.bits == 1:
-            ArgbImage.from_mono(data, iType).write_png(fname)
+        return iType.filename(key_only=key_suffix, size_only=True,
+                              case_sensitive=case_sensitive) + '.png'
+
+    def _convert_png(
+        self, tasks: List['_PngTask'], executor: Optional[Executor],
+    ) -> List[Tuple[str, bytes]]:
+        ''' Returns [(filename, png-data)]. You must ensure keys exist! '''
+        if not executor or len(tasks) < 2:
+            return [(fname, _png_data(imgk, self.media[imgk],
+                                      self.media[maskk] if maskk else None))
+                    for fname, imgk, maskk in tasks]
+        used = {k for _, imgk, maskk in tasks for k in (imgk, maskk) if k}
+        with SharedPayload.SharedPayloads(
+                {k: self.media[k] for k in used}) as shm:
+            futures = [(fname, executor.submit(
+                _png_job, imgk, shm[imgk], shm[maskk] if maskk else None))
+                for fname, imgk, maskk in tasks]
+            wait([x for _, x in futures])  # before shared memory is removed
+            return [(fname, x.result()) for fname, x in futures]
+
+    @staticmethod
+    def _write_exports(
+        files: List[Tuple[str, bytes]],
+        store: Optional['ExportStore'],
+        executor: Optional[Executor],
+    ) -> None:
+        if not executor or len(files) < 2:
+            for fname, data in files:
+                IcnsFile._write_export(fname, data, store)
+            return
+        futures = [executor.submit(IcnsFile._write_export, fname, data, store)
+                   for fname, data in files]
+        for x in futures:
+            x.result()  # raise first error
+
+    @staticmethod
+    def _write_export(
+        fname: str, data: bytes, store: Optional['ExportStore'],
+    ) -> None:
+        if store:
+            store.put(fname, data)
         else:
-            mask_data = self.media[mask_key] if mask_key else None
-            ArgbImage(data=data, mask=mask_data).write_png(fname)
-        return fname
+            with open(fname, 'wb') as fp:
+                fp.write(data)
 
     def __repr__(self) -> str:
         lst = ', '.join(str(k) for k in self.media.keys())
@@ -345,4 +553,107 @@ class IcnsFile:
 
     def __str__(self) -> str:
         return 'File: ' + (self.infile or '-mem-') + os.linesep \
-            + IcnsFile._description(self.media.items(), indent=2)
+            + IcnsFile._description(
+                ((k, len(v), v) for k, v in self.media.items()), indent=2)
+
+
+_PngTask = Tuple[str, IcnsType.Media.KeyT, Optional[IcnsType.Media.KeyT]]
+
+
+class _ExportPlan:
+    ''' Unique filenames within a single export directory. '''
+    __slots__ = ['outdir', 'case_sensitive', '_used']
+
+    def __init__(self, outdir: str) -> None:
+        self.outdir = outdir
+        self.case_sensitive = IcnsType.is_case_sensitive(outdir)
+        self._used = set()  # type: Set[str]
+
+    def add(self, name: str, key: IcnsType.Media.KeyT) -> str:
+        '''
+        Returns path in outdir. If name is already used, append icns type
+        (and a counter if still not unique).
+        '''
+        base, ext = os.path.splitext(name)
+        i = 1
+        while self._normalize(name) in self._used:
+            name = '{}-{}{}{}'.format(
+                base, IcnsType.key_to_readable(key),
+                '-{}'.format(i) if i > 1 else '', ext)
+            i += 1
+        self._used.add(self._normalize(name))
+        return os.path.join(self.outdir, name)
+
+    def _normalize(self, name: str) -> str:
+        return name if self.case_sensitive else name.lower()
+
+
+def _png_data(key: IcnsType.Media.KeyT, data: bytes, mask: Optional[bytes]) \
+        -> bytes:
+    iType = IcnsType.get(key)
+    if iType.bits == 1:
+        return ArgbImage.from_mono(data, iType).png_data()
+    if iType.is_indexed():
+        return ArgbImage.from_indexed(data, iType, mask).png_data()
+    return ArgbImage(data=data, mask=mask).png_data()
+
+
+def _png_job(
+    key: IcnsType.Media.KeyT,
+    desc: SharedPayload.Descriptor,
+    mask_desc: Optional[SharedPayload.Descriptor],
+) -> bytes:
+    ''' Worker process entry. '''
+    mask = SharedPayload.load(mask_desc) if mask_desc else None
+    return _png_data(key, SharedPayload.load(desc), mask)
+
+
+def _render_rank(key: IcnsType.Media.KeyT, data: bytes) \
+        -> Tuple[int, int, bool, bool, int]:
+    '''
+    Sort key for tiles-first layout: images by pixel count (1x before @2x,
+    masks after their image), then nested icns files, then unknown keys.
+    '''
+    try:
+        iType = IcnsType.get(key)
+    except NotImplementedError:
+        return (2, 0, False, False, len(data))
+    if not iType.size or iType.is_type('icns'):
+        return (1 if iType.is_type('icns') else 2, 0, False, False, len(data))
+    w, h = iType.size
+    return (0, w * h, iType.retina, iType.desc == 'mask', len(data))
+
+
+def _payload_hash(fp: BinaryIO, offset: int, length: int) -> bytes:
+    h = sha256()
+    for chunk in RawData.read_payload(fp, offset, length):
+        h.update(chunk)
+    return h.digest()
+
+
+def _pixel_diff(key: IcnsType.Media.KeyT, data_a: bytes, data_b: bytes) \
+        -> str:
+    ''' Returns ", N pixels differ" or empty string if not decodable. '''
+    try:
+        iType = IcnsType.get(key)
+    except NotImplementedError:
+        return ''
+    ext = RawData.determine_file_ext(data_a)
+    try:
+        if iType.is_type('argb') and ext in ['argb', None] or \
+                iType.is_type('rgb') and ext is None:
+            img_a, img_b = ArgbImage(data=data_a), ArgbImage(data=data_b)
+            if img_a.size != img_b.size:
+                return ', size {}x{} -> {}x{}'.format(*img_a.size, *img_b.size)
+            count = sum(1 for px in zip(img_a.a, img_b.a, img_a.r, img_b.r,
+                                        img_a.g, img_b.g, img_a.b, img_b.b)
+                        if px[0::2] != px[1::2])
+        elif iType.desc == 'mask' and iType.bits == 8:
+            if len(data_a) != len(data_b):
+                return ''
+            count = sum(1 for a, b in zip(data_a, data_b) if a != b)
+        else:
+            return ''
+    except (NotImplementedError, ValueError, IndexError):
+        return ''
+    return ', {} pixels differ'.format(count)
@@ -3,9 +3,11 @@
 Namespace for the ICNS format.
 @see https://en.wikipedia.org/wiki/Apple_Icon_Image_format
 '''
-import os  # path
+import os  # close, path
+import tempfile  # mkstemp
 from typing import Union, Optional, Tuple, Iterator, List, Iterable, Set
-from . import PackBytes, RawData
+from typing import Dict
+from . import RawData
 
 
 class CanNotDetermine(Exception):
@@ -56,6 +58,10 @@ class Media:
     def is_binary(self) -> bool:
         return any(x in self.types for x in ['rgb', 'bin'])
 
+    def is_indexed(self) -> bool:
+        ''' 4-bit and 8-bit icons (classic Mac OS system palette). '''
+        return self.desc == 'icon' and self.bits in [4, 8]
+
     def fallback_ext(self) -> str:
         if self.channels in [1, 2]:
             return self.desc  # guaranteed to be icon, mask, or iconmask
@@ -63,22 +69,39 @@ class Media:
 
     def decompress(self, data: bytes, ext: Optional[str] = '-?-') \
             -> Optional[List[int]]:
-        ''' Returns None if media is not decompressable. '''
+        '''
+        Returns None if media is not decompressable.
+        :raises:
+            RawData.ParserError: if data would decode to more than maxsize
+        '''
         if self.compressable:
             if ext == '-?-':
                 ext = RawData.determine_file_ext(data)
             if ext == 'argb':
-                return PackBytes.unpack(data[4:])  # remove ARGB header
-            if ext is None or ext == 'rgb':  # RGB files dont have magic number
+                data = data[4:]  # remove ARGB header
+            elif ext is None or ext == 'rgb':  # RGB files dont have magic num
                 if self.key == 'it32':
                     data = data[4:]
-                return PackBytes.unpack(data)
+            else:
+                return None
+            return RawData.unpack(data, self.maxsize)
         return None
 
-    def filename(self, *, key_only: bool = False, size_only: bool = False) \
-            -> str:
+    def filename(
+        self,
+        *,
+        key_only: bool = False,
+        size_only: bool = False,
+        case_sensitive: Optional[bool] = None,
+    ) -> str:
+        '''
+        - case_sensitive : File system of target directory, see
+                           `is_case_sensitive()` (default: package dir).
+        '''
         if key_only:
-            if os.path.exists(__file__.upper()):  # check case senstive
+            if case_sensitive is None:
+                case_sensitive = _package_case_sensitive()
+            if not case_sensitive:
                 if self.key in ['sb24', 'icsb']:
                     return self.key + '-a'  # type: ignore
                 elif self.key in ['SB24', 'icsB']:
@@ -98,6 +121,8 @@ class Media:
             if size_only:
                 if self.bits == 1:
                     suffix += '-mono'
+                elif self.is_indexed():
+                    suffix += '-{}bit'.format(self.bits)
             else:
                 if self.desc in ['icon', 'iconmask']:
                     suffix += '-icon{}b'.format(self.bits)
@@ -122,6 +147,7 @@ class Media:
             str(self.key), T, self.availability or '?')
 
 
+_CASE_SENSITIVE = {}  # type: Dict[str, bool] # by directory
 _TYPES = {x.key: x for x in (
     # Read support for these:
     Media('ICON', ['bin'], 32, ch=1, bits=1, os=1.0, desc='icon'),
@@ -202,14 +228,57 @@ def enum_png_convertable(available_keys: Iterable[Media.KeyT]) \
         if img.is_type('argb') or img.bits == 1:  # allow mono icons
             yield img.key, None
         elif img.is_type('rgb'):
-            mask_key = None
-            for mask in _TYPES.values():
-                if mask.key not in available_keys:
-                    continue
-                if mask.desc == 'mask' and mask.size == img.size:
-                    mask_key = mask.key
-                    break
-            yield img.key, mask_key
+            yield img.key, find_mask(img.size, ['mask'], available_keys)
+        elif img.is_indexed():  # prefer 1-bit mask of same era
+            yield img.key, find_mask(
+                img.size, ['iconmask', 'mask'], available_keys)
+
+
+def find_mask(
+    size: Optional[Tuple[int, int]],
+    desc: Iterable[str] = ('mask',),
+    available_keys: Optional[Iterable[Media.KeyT]] = None,
+) -> Optional[Media.KeyT]:
+    '''
+    Returns key of first mask with matching size and description.
+    - available_keys : Limit search to these keys (default: all types)
+    '''
+    for typ in desc:
+        for mask in _TYPES.values():
+            if available_keys is not None and \
+                    mask.key not in available_keys:
+                continue
+            if mask.desc == typ and mask.size == size:
+                return mask.key
+    return None
+
+
+def is_case_sensitive(path: str) -> bool:
+    '''
+    Probe file system of directory with a temporary file.
+    Result is cached per directory.
+    '''
+    path = os.path.realpath(path)
+    if path not in _CASE_SENSITIVE:
+        try:
+            fd, tmp = tempfile.mkstemp(prefix='.icnsutil-case-', dir=path)
+        except OSError:  # read-only, use directory name instead
+            _CASE_SENSITIVE[path] = path == path.swapcase() or \
+                not os.path.exists(path.swapcase())
+            return _CASE_SENSITIVE[path]
+        os.close(fd)
+        try:
+            _CASE_SENSITIVE[path] = not os.path.exists(os.path.join(
+                path, os.path.basename(tmp).upper()))
+        finally:
+            os.remove(tmp)
+    return _CASE_SENSITIVE[path]
+
+
+def _package_case_sensitive() -> bool:
+    if '' not in _CASE_SENSITIVE:  # '' = package directory
+        _CASE_SENSITIVE[''] = not os.path.exists(__file__.upper())
+    return _CASE_SENSITIVE['']
 
 
 def supported_extensions() -> Set[str]:
@@ -234,12 +303,25 @@ def key_from_readable(key: str) -> Media.KeyT:
     return key_mapping.get(key.lower(), key)  # type: ignore[return-value]
 
 
+def key_to_readable(key: Media.KeyT) -> str:
+    ''' Printable key. Reverse of `key_from_readable()` for binary keys. '''
+    if key == b'\xFD\xD9\x2F\xA8':
+        return 'dark'
+    return str(key)
+
+
 def match_maxsize(total: int, typ: str) -> Media:
     assert(typ == 'argb' or typ == 'rgb')
     ret = [x for x in _TYPES.values() if x.is_type(typ) and x.maxsize == total]
     return _best_option(ret, typ)
 
 
+def max_decoded_size(typ: str) -> int:
+    ''' Largest uncompressed size of any argb or rgb type (e.g., it32). '''
+    assert(typ == 'argb' or typ == 'rgb')
+    return max(x.maxsize or 0 for x in _TYPES.values() if x.is_type(typ))
+
+
 def guess(data: bytes, filename: Optional[str] = None) -> Media:
     '''
     Guess icns media type by analyzing the raw data + file naming convention.
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+'''
+Read and write Windows icon (ico) files and convert from and to icns.
+
+PNG images are copied byte for byte in both directions. Only ARGB and RGB
+media are decoded (stored as 32-bit BMP in ico files). BMP images and PNG
+images without matching icns type are decoded on import.
+'''
+import struct  # pack, unpack, error
+from sys import stderr
+from typing import Dict, Iterable, List, Optional, Tuple
+from . import IcnsType, RawData, pngcodec
+from .ArgbImage import ArgbImage
+from .IcnsFile import IcnsFile
+
+_MAX_SIZE = 256  # ico directory stores width and height in a single byte
+_DEPRECATED = ['icp4', 'icp5']  # use only if there is no other PNG type
+KeyT = IcnsType.Media.KeyT
+
+
+class IcoFile:
+    __slots__ = ['entries']
+
+    def __init__(
+        self, file: Optional[str] = None, *, data: Optional[bytes] = None,
+    ) -> None:
+        ''' Read ico file if provided. Either filename or raw data. '''
+        self.entries = []  # type: List[Tuple[Tuple[int, int], bytes]]
+        if file:
+            with open(file, 'rb') as fp:
+                data = fp.read()
+        if data:
+            self.load(data)
+
+    def load(self, data: bytes) -> None:
+        ''' Append all images of ico file (PNG or BMP data). '''
+        try:
+            reserved, typ, count = struct.unpack('<HHH', data[:6])
+            if reserved != 0 or typ != 1:
+                raise RawData.ParserError('Not an ICO file.')
+            for i in range(count):
+                w, h, _, _, _, _, length, offset = struct.unpack(
+                    '<BBBBHHII', data[6 + i * 16:22 + i * 16])
+                if offset + length > len(data):
+                    raise RawData.ParserError(
+                        'Invalid length {} of entry {} at offset {}.'.format(
+                            length, i, offset))
+                img = data[offset:offset + length]
+                if RawData.determine_file_ext(img) == 'png':
+                    size = RawData.determine_image_size(img, 'png')
+                else:
+                    size = struct.unpack('<ii', img[4:12])
+                    size = (size[0], abs(size[1]) // 2)  # image + AND mask
+                self.entries.append((size or (w or 256, h or 256), img))
+        except struct.error:
+            raise RawData.ParserError('Truncated ICO file.')
+
+    def add_image(self, size: Tuple[int, int], data: bytes) -> None:
+        ''' Data must be either a PNG file or BMP image (without header). '''
+        if max(size) > _MAX_SIZE:
+            raise ValueError('Image too large for ico file: {}x{}'.format(
+                *size))
+        self.entries.append((size, data))
+
+    def write(self, fname: str) -> None:
+        with open(fname, 'wb') as fp:
+            fp.write(self.ico_data())
+
+    def ico_data(self) -> bytes:
+        ''' Same as `write()` but return the ico file as bytes. '''
+        head = struct.pack('<HHH', 0, 1, len(self.entries))
+        offset = len(head) + 16 * len(self.entries)
+        for (w, h), data in self.entries:
+            head += struct.pack('<BBBBHHII', w % 256, h % 256, 0, 0, 1, 32,
+                                len(data), offset)
+            offset += len(data)
+        return head + b''.join(data for _, data in self.entries)
+
+    @classmethod
+    def from_icns(cls, icns: IcnsFile) -> 'IcoFile':
+        '''
+        Create ico file with one image per size (up to 256x256).
+        PNG media is preferred over ARGB, ARGB over RGB + mask.
+        Nested icns files (e.g., dark or selected) are ignored.
+        '''
+        pairs = dict(IcnsType.enum_png_convertable(icns.media))
+        best = {}  # type: Dict[Tuple[int, int], Tuple[int, KeyT]]
+        for key, data in icns.media.items():
+            try:
+                iType = IcnsType.get(key)
+            except NotImplementedError:
+                continue
+            ext = RawData.determine_file_ext(data)
+            if ext == 'png':
+                rank, size = 0, RawData.determine_image_size(data, 'png')
+            elif key in pairs and iType.compressable and ext in [None, 'argb']:
+                rank, size = (1 if ext == 'argb' else 2), iType.size
+            else:
+                continue  # mono, indexed, jp2, and nested icns
+            if not size or max(size) > _MAX_SIZE:
+                continue
+            if size not in best or rank < best[size][0]:
+                best[size] = (rank, key)
+
+        ico = cls()
+        for size, (rank, key) in sorted(best.items()):
+            if rank == 0:
+                ico.add_image(size, icns.media[key])
+            else:
+                maskk = pairs[key]
+                img = ArgbImage(data=icns.media[key],
+                                mask=icns.media[maskk] if maskk else None)
+                ico.add_image(size, dib_data(img))
+        return ico
+
+    def to_icns(self) -> IcnsFile:
+        '''
+        Create icns file. PNG images are copied if `IcnsType.guess()` finds
+        a matching type. Other images are stored as ARGB, PNG, or RGB + mask
+        (in that order). Images with unsupported size are skipped.
+        '''
+        icns = IcnsFile()
+        for size, data in self.entries:
+            is_png = RawData.determine_file_ext(data) == 'png'
+            if is_png:
+                key = _png_key(data, icns.media)
+                if key:
+                    icns.media[key] = data
+                    continue
+            try:
+                if is_png:
+                    img = pngcodec.decode_png(data)
+                else:
+                    img = from_dib(data)
+            except (ValueError, NotImplementedError) as e:
+                print('Warning: skipped {}x{} image: {}'.format(*size, e),
+                      file=stderr)
+                continue
+            if not _store_decoded(icns, img):
+                print('Warning: skipped {}x{} image: no icns type'.format(
+                    *size), file=stderr)
+        return icns
+
+
+def _png_key(data: bytes, used: Iterable[KeyT]) -> Optional[KeyT]:
+    ''' Non-retina type first, deprecated types last. '''
+    keys = []
+    for fname in [None, 'image@2x.png']:
+        try:
+            keys.append(IcnsType.guess(data, fname).key)
+        except IcnsType.CanNotDetermine:
+            pass
+    keys.sort(key=lambda x: x in _DEPRECATED)
+    return next((x for x in keys if x not in used), None)
+
+
+def _store_decoded(icns: IcnsFile, img: ArgbImage) -> bool:
+    ''' Add decoded image as ARGB, PNG, or RGB + mask. '''
+    w, h = img.size
+    try:
+        key = IcnsType.match_maxsize(w * h * 4, 'argb').key
+        if key not in icns.media:
+            icns.media[key] = img.argb_data()
+            return True
+    except IcnsType.CanNotDetermine:
+        pass
+    png = pngcodec.encode_png(img)
+    pngk = _png_key(png, icns.media)
+    if pngk:
+        icns.media[pngk] = png
+        return True
+    try:
+        key = IcnsType.match_maxsize(w * h * 3, 'rgb').key
+    except IcnsType.CanNotDetermine:
+        return False
+    maskk = IcnsType.find_mask(img.size)
+    if key in icns.media or maskk in icns.media:
+        return False
+    icns.media[key] = (b'\x00' * 4 if key == 'it32' else b'') + img.rgb_data()
+    if maskk:
+        icns.media[maskk] = img.mask_data()
+    return True
+
+
+def dib_data(img: ArgbImage) -> bytes:
+    ''' Encode 32-bit BMP image with AND mask (as used in ico files). '''
+    w, h = img.size
+    bgra = bytearray(w * h * 4)
+    for i, ch in enumerate((img.b, img.g, img.r, img.a)):
+        bgra[i::4] = bytes(ch)
+    stride = (w + 31) // 32 * 4
+    mask = bytearray(stride * h)
+    for y in range(h):
+        row = (h - 1 - y) * stride  # bottom-up
+        for x, alpha in enumerate(img.a[y * w:(y + 1) * w]):
+            if alpha == 0:
+                mask[row + x // 8] |= 0x80 >> (x % 8)
+    header = struct.pack('<IiiHHIIiiII', 40, w, h * 2, 1, 32, 0,
+                         len(bgra) + len(mask), 0, 0, 0, 0)
+    return header + b''.join(bgra[y * w * 4:(y + 1) * w * 4]
+                             for y in range(h - 1, -1, -1)) + bytes(mask)
+
+
+def from_dib(data: bytes) -> ArgbImage:
+    ''' Decode BMP image of ico file (1, 4, 8, 24, or 32 bit). '''
+    try:
+        hsize, w, h, _, bits, compression = struct.unpack(
+            '<IiiHHI', data[:20])
+        colors = struct.unpack('<I', data[32:36])[0]
+    except struct.error:
+        raise ValueError('Truncated BMP header.')
+    if bits not in [1, 4, 8, 24, 32] or compression not in [0, 3]:
+        raise NotImplementedError('Unsupported BMP format: {} bit, type {}'
+                                  .format(bits, compression))
+    h = abs(h) // 2  # image + AND mask
+    offset = hsize + (12 if compression == 3 and hsize == 40 else 0)
+    palette = b''
+    if bits <= 8:
+        palette = data[offset:offset + 4 * (colors or 1 << bits)]
+        offset += len(palette)
+        palette = palette.ljust(4 << bits, b'\x00')  # invalid indices
+    stride = (w * bits + 31) // 32 * 4
+    mstride = (w + 31) // 32 * 4
+    if len(data) < offset + (stride + (mstride if bits < 32 else 0)) * h:
+        raise ValueError('Truncated BMP data.')
+
+    a = []  # type: List[int]
+    r = []  # type: List[int]
+    g = []  # type: List[int]
+    b = []  # type: List[int]
+    for y in range(h - 1, -1, -1):  # bottom-up
+        row = data[offset + y * stride:offset + (y + 1) * stride]
+        if bits >= 24:
+            step = bits // 8
+            b += row[0:w * step:step]
+            g += row[1:w * step:step]
+            r += row[2:w * step:step]
+            if bits == 32:
+                a += row[3:w * 4:4]
+        else:
+            for x in range(w):
+                i = (row[x * bits // 8] >> (8 - bits - x * bits % 8)) \
+                    & ((1 << bits) - 1)
+                b.append(palette[i * 4])
+                g.append(palette[i * 4 + 1])
+                r.append(palette[i * 4 + 2])
+    offset += stride * h
+    if bits == 32 and (any(a) or len(data) < offset + mstride * h):
+        pass  # use alpha channel (AND mask is optional)
+    else:
+        a = []
+        for y in range(h - 1, -1, -1):
+            row = data[offset + y * mstride:offset + (y + 1) * mstride]
+            a += [0 if row[x // 8] & (0x80 >> (x % 8)) else 255
+                  for x in range(w)]
+    return ArgbImage.from_planes((w, h), a, r, g, b)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+'''
+Reduce the size of icns files without changing how they are rendered.
+
+- Remove redundant and legacy entries (see `POLICIES`).
+- Re-pack RGB and ARGB images, keep whichever encoding is smaller.
+- Optionally store ic04, ic05, and icsb as ARGB or PNG (smaller wins).
+
+Nested icns files (e.g., dark) are optimized as well.
+'''
+import os  # getpid, replace
+import shutil  # copymode
+import struct  # error
+import zlib  # error
+from typing import List, Optional, Tuple
+from . import IcnsType, RawData, pngcodec
+from .ArgbImage import ArgbImage, PIL_ENABLED
+from .IcnsFile import IcnsFile
+
+POLICIES = {
+    'none': 'keep all entries, only re-pack images',
+    'redundant': 'remove icp4, icp5, and it32 if another entry has the '
+                 'same size (as reported by test)',
+    'legacy': 'like redundant, also remove 1-bit, 4-bit, and 8-bit icons',
+}
+
+# (obsolete key, keys with identical image size)
+_OBSOLETE = [
+    ('icp4', ['is32', 'ic04']),
+    ('icp5', ['il32', 'ic05']),
+    ('it32', ['ic07']),
+]
+_ARGB_OR_PNG = ['ic04', 'ic05', 'icsb']
+_COLOR_CHUNKS = [b'iCCP', b'gAMA', b'cHRM']  # not representable in ARGB
+
+
+class OptimizeResult:
+    __slots__ = ['fname', 'before', 'after', 'removed', 'error']
+
+    def __init__(self, fname: str) -> None:
+        self.fname = fname
+        self.before = 0
+        self.after = 0
+        self.removed = []  # type: List[str]
+        self.error = None  # type: Optional[str]
+
+    @property
+    def saved(self) -> int:
+        return self.before - self.after
+
+    def __str__(self) -> str:
+        if self.error:
+            return 'error: {} ({})'.format(self.fname, self.error)
+        txt = '{}: {} -> {} bytes ({} saved)'.format(
+            self.fname, self.before, self.after, self.saved)
+        if self.removed:
+            txt += ', removed: ' + ', '.join(self.removed)
+        return txt
+
+
+def optimize(
+    icns: IcnsFile, *, policy: str = 'redundant', argb_png: bool = False,
+) -> List[str]:
+    '''
+    Modify media in place. Returns readable names of removed keys.
+    - policy : One of `POLICIES`.
+    - argb_png : Store ic04, ic05, and icsb as ARGB or PNG (smaller wins).
+    '''
+    if policy not in POLICIES:
+        raise ValueError('Unknown policy "{}", use one of: {}'.format(
+            policy, ', '.join(POLICIES)))
+    removed = []  # type: List[str]
+    for key in _obsolete_keys(list(icns.media.keys()), policy):
+        del icns.media[key]
+        removed.append(IcnsType.key_to_readable(key))
+    for key, data in list(icns.media.items()):
+        if RawData.determine_file_ext(data) == 'icns':
+            icns.media[key], nested = _optimize_nested(data, policy, argb_png)
+            removed += ['{}/{}'.format(IcnsType.key_to_readable(key), x)
+                        for x in nested]
+        else:
+            icns.media[key] = _smallest(key, data, argb_png)
+    return removed
+
+
+def optimize_file(
+    fname: str, *, policy: str = 'redundant', argb_png: bool = False,
+    dry_run: bool = False,
+) -> OptimizeResult:
+    '''
+    Optimize and rewrite file atomically (only if smaller).
+    Errors are reported in the result. Can be used as worker process entry.
+    '''
+    res = OptimizeResult(fname)
+    try:
+        with open(fname, 'rb') as fp:
+            data = fp.read()
+        icns = IcnsFile(data=data)
+        res.removed = optimize(icns, policy=policy, argb_png=argb_png)
+        new_data = icns.icns_data(toc=icns.has_toc())
+        res.before = res.after = len(data)
+        if len(new_data) < len(data):
+            res.after = len(new_data)
+            if not dry_run:
+                _atomic_write(fname, new_data)
+    except Exception as e:  # one broken file must not abort a batch
+        res.error = str(e) or type(e).__name__
+    return res
+
+
+def _obsolete_keys(keys: List[IcnsType.Media.KeyT], policy: str) \
+        -> List[IcnsType.Media.KeyT]:
+    drop = []  # type: List[IcnsType.Media.KeyT]
+    if policy != 'none':
+        for obsolete, others in _OBSOLETE:
+            if obsolete in keys and any(x in keys for x in others):
+                drop.append(obsolete)
+    if policy == 'legacy':
+        for key in keys:
+            try:
+                iType = IcnsType.get(key)
+            except NotImplementedError:
+                continue
+            if iType.desc in ['icon', 'iconmask'] and iType.bits in [1, 4, 8]:
+                drop.append(key)
+    # remove masks whose images were removed
+    orphans = set(m for i, m in IcnsType.enum_img_mask_pairs(keys) if not i)
+    rest = [x for x in keys if x not in drop]
+    drop += [m for i, m in IcnsType.enum_img_mask_pairs(rest)
+             if not i and m and m not in orphans]
+    return drop
+
+
+def _optimize_nested(data: bytes, policy: str, argb_png: bool) \
+        -> Tuple[bytes, List[str]]:
+    nested = IcnsFile(data=data)  # icns header is optional
+    removed = optimize(nested, policy=policy, argb_png=argb_png)
+    new_data = nested.icns_data(toc=nested.has_toc())
+    if data[:4] != b'icns':
+        new_data = new_data[8:]
+    return (new_data if len(new_data) < len(data) else data), removed
+
+
+def _smallest(key: IcnsType.Media.KeyT, data: bytes, argb_png: bool) \
+        -> bytes:
+    ''' Return smallest (lossless) encoding of image. '''
+    try:
+        iType = IcnsType.get(key)
+    except NotImplementedError:
+        return data
+    ext = RawData.determine_file_ext(data)
+    candidates = [data]
+    img = None
+    if iType.compressable and ext in [None, 'argb']:
+        img = _decode_packed(iType, data, ext)
+        if img and ext == 'argb':
+            candidates.append(img.argb_data())
+        elif img:
+            header = b'\x00\x00\x00\x00' if key == 'it32' else b''
+            candidates.append(header + img.rgb_data())
+    if argb_png and key in _ARGB_OR_PNG:
+        if ext == 'png':
+            img = _decode_png(data)
+            if img and img.size != iType.size:
+                img = None  # wrong size, ARGB would be invalid
+            if img:
+                candidates.append(img.argb_data())
+        if img:
+            candidates.append(pngcodec.encode_png(img))
+            if PIL_ENABLED:
+                candidates.append(img.png_data())
+    return min(candidates, key=len)  # original, if equal size
+
+
+def _decode_packed(iType: IcnsType.Media, data: bytes, ext: Optional[str]) \
+        -> Optional[ArgbImage]:
+    ''' Returns None if data does not match expected size. '''
+    try:
+        udata = iType.decompress(data, ext)
+    except RawData.ParserError:
+        return None
+    if not udata or len(udata) != iType.maxsize or not iType.size:
+        return None
+    n = iType.size[0] * iType.size[1]
+    planes = [udata[i * n:(i + 1) * n] for i in range(len(udata) // n)]
+    if len(planes) == 3:
+        planes.insert(0, [255] * n)
+    return ArgbImage.from_planes(iType.size, *planes)
+
+
+def _decode_png(data: bytes) -> Optional[ArgbImage]:
+    ''' Only 8-bit images without color information (lossless). '''
+    if len(data) < 25 or data[24] != 8:
+        return None  # bit depth
+    if any(x in data for x in _COLOR_CHUNKS):
+        return None
+    try:
+        return pngcodec.decode_png(data)
+    except (ValueError, NotImplementedError, RawData.ParserError,
+            zlib.error, struct.error):
+        return None
+
+
+def _atomic_write(fname: str, data: bytes) -> None:
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+    shutil.copymode(fname, tmp)
+    os.replace(tmp, fname)
@@ -2,7 +2,7 @@
 from typing import List, Iterator, Union
 
 
-def pack(data: List[int]) -> bytes:
+def pack(data: Union[bytes, List[int]]) -> bytes:
     ret = []  # type: List[int]
     buf = []  # type: List[int]
     i = 0
@@ -53,7 +53,7 @@ def unpack(data: bytes) -> List[int]:
             ret += data[i + 1:i + n + 2]
             i += n + 2
         else:
-            ret += [data[i + 1]] * (n - 0x7D)
+            ret += data[i + 1:i + 2] * (n - 0x7D)  # empty if truncated
             i += 2
     return ret
 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import struct  # pack, unpack
-from typing import Optional, Tuple, Iterator, BinaryIO
+from typing import Any, Optional, Tuple, Iterator, BinaryIO, List, Union
 from . import IcnsType, PackBytes
 
 
@@ -8,6 +8,43 @@ class ParserError(Exception):
     pass
 
 
+class Limits:
+    '''
+    Upper bounds for untrusted input (None: unlimited). Checks are done on
+    header values, a `ParserError` is raised before data is read or decoded.
+    - max_entry_size : Payload length of a single entry.
+    - max_file_size : Length of icns file.
+    - max_decoded_size : Uncompressed length of PackBytes and PNG data.
+                         Also, RGB / ARGB data may not exceed `Media.maxsize`.
+    - max_depth : Nesting level of icns files (e.g., 1 for dark in icns).
+    '''
+    __slots__ = ['max_entry_size', 'max_file_size', 'max_decoded_size',
+                 'max_depth']
+
+    def __init__(
+        self,
+        *,
+        max_entry_size: Optional[int] = 64 << 20,
+        max_file_size: Optional[int] = 256 << 20,
+        max_decoded_size: Optional[int] = 64 << 20,
+        max_depth: Optional[int] = 4,
+    ) -> None:
+        self.max_entry_size = max_entry_size
+        self.max_file_size = max_file_size
+        self.max_decoded_size = max_decoded_size
+        self.max_depth = max_depth
+
+    def check(self, name: str, value: int, what: str) -> None:
+        ''' Raise `ParserError` if value exceeds limit `max_<name>`. '''
+        limit = getattr(self, 'max_' + name)
+        if limit is not None and value > limit:
+            raise ParserError('{} exceeds limit: {} > {}'.format(
+                what, value, limit))
+
+
+LIMITS = Limits()  # used by all parsers, assign attributes to change
+
+
 def determine_file_ext(data: bytes) -> Optional[str]:
     '''
     Data should be at least 8 bytes long.
@@ -41,6 +78,8 @@ def _determine_jp2_size(data: bytes) -> Optional[Tuple[int, int]]:
 
     while off < filesize:
         box_size, box_type = struct.unpack('>I4s', data[off:off+8])
+        if box_size < 8:
+            break  # extends to end of file or invalid
         # find JP2 Header box
         if box_type == b'jp2h':
             child = off + 8  # skip parent header
@@ -50,7 +89,10 @@ def _determine_jp2_size(data: bytes) -> Optional[Tuple[int, int]]:
                     h, w = struct.unpack('>II', data[child+8:child+16])
                     return w, h
 
-                child += struct.unpack('>I', data[child:child+4])[0]
+                child_size = struct.unpack('>I', data[child:child+4])[0]
+                if child_size < 8:
+                    break
+                child += child_size
         off += box_size
     return None
 
@@ -75,11 +117,11 @@ def determine_image_size(data: bytes, ext: Optional[str] = None) \
     return None  # icns does not support other image types except binary
 
 
-def is_icns_without_header(data: bytes) -> bool:
+def is_icns_without_header(data: Union[bytes, memoryview]) -> bool:
     ''' Returns True even if icns header is missing. '''
     offset = 0
     for i in range(2):  # test n keys if they exist
-        key, size = icns_header_read(data[offset:offset + 8])
+        key, size = icns_header_read(bytes(data[offset:offset + 8]))
         try:
             IcnsType.get(key)
         except NotImplementedError:
@@ -92,6 +134,20 @@ def is_icns_without_header(data: bytes) -> bool:
     return True
 
 
+def unpack(data: bytes, maxsize: Optional[int] = None) -> List[int]:
+    '''
+    Same as `PackBytes.unpack()` but check the decoded size before decoding.
+    :raises:
+        ParserError: if larger than maxsize or `LIMITS.max_decoded_size`
+    '''
+    size = PackBytes.get_size(data)
+    if maxsize is not None and size > maxsize:
+        raise ParserError('Decoded size exceeds expected size: {} > {}'
+                          .format(size, maxsize))
+    LIMITS.check('decoded_size', size, 'Decoded size')
+    return PackBytes.unpack(data)
+
+
 def icns_header_read(data: bytes) -> Tuple[IcnsType.Media.KeyT, int]:
     ''' Returns icns type name and data length (incl. +8 for header) '''
     assert(isinstance(data, bytes))
@@ -119,20 +175,250 @@ def icns_header_w_len(key: IcnsType.Media.KeyT, length: int) -> bytes:
     return name + struct.pack('>I', length + 8)
 
 
+class ReaderAt:
+    '''
+    Random access reader, e.g., for local files, memory, or remote objects
+    (HTTP range requests). Subclasses implement `read_at()` and `size()`.
+    '''
+
+    def read_at(self, offset: int, n: int) -> bytes:
+        ''' Read up to n bytes at offset (fewer bytes at end of file). '''
+        raise NotImplementedError
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+
+class FileReader(ReaderAt):
+    def __init__(self, file: Union[str, BinaryIO]) -> None:
+        ''' Filename or seekable file object (will not be closed). '''
+        self._owner = isinstance(file, str)
+        self.fp = open(file, 'rb') if isinstance(file, str) else file
+
+    def __enter__(self) -> 'FileReader':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._owner:
+            self.fp.close()
+
+    def read_at(self, offset: int, n: int) -> bytes:
+        self.fp.seek(offset)
+        return self.fp.read(n)
+
+    def size(self) -> int:
+        return self.fp.seek(0, 2)
+
+
+class BytesReader(ReaderAt):
+    def __init__(self, data: Union[bytes, memoryview]) -> None:
+        ''' A memoryview (e.g., of a nested icns entry) is not copied. '''
+        self.data = data
+
+    def read_at(self, offset: int, n: int) -> bytes:
+        return bytes(self.data[offset:offset + max(n, 0)])
+
+    def size(self) -> int:
+        return len(self.data)
+
+
+class CachedReader(ReaderAt):
+    '''
+    Keep all read data in memory and coalesce small reads. Each request
+    reads at least `min_read` bytes and fills gaps up to `max_gap` bytes to
+    the previous cached range. Thus, most header reads of an icns file are
+    served from few larger requests.
+    '''
+
+    def __init__(
+        self, reader: ReaderAt, *, min_read: int = 1 << 16,
+        max_gap: int = 1 << 12,
+    ) -> None:
+        self.reader = reader
+        self.min_read = min_read
+        self.max_gap = max_gap
+        self.requests = 0  # number of reads of underlying reader
+        self._size = None  # type: Optional[int]
+        self._ranges = []  # type: List[Tuple[int, bytes]] # sorted, disjoint
+
+    def size(self) -> int:
+        if self._size is None:
+            self._size = self.reader.size()
+        return self._size
+
+    def read_at(self, offset: int, n: int) -> bytes:
+        end = min(offset + n, self.size())
+        if end <= offset:
+            return b''
+        start = offset
+        for pos, data in self._ranges:
+            if pos <= offset and end <= pos + len(data):
+                return data[offset - pos:end - pos]  # cache hit
+            if pos <= start <= pos + len(data) + self.max_gap:
+                start = pos + len(data)  # skip cached part or fill gap
+        stop = min(max(end, start + self.min_read), self.size())
+        self.requests += 1
+        self._insert(start, self.reader.read_at(start, stop - start))
+        for pos, data in self._ranges:
+            if pos <= offset < pos + len(data):
+                return data[offset - pos:end - pos]
+        return b''  # underlying reader returned less than size()
+
+    def _insert(self, start: int, chunk: bytes) -> None:
+        ''' Add range and merge with adjacent or overlapping ranges. '''
+        ranges = []
+        for pos, data in self._ranges:
+            if pos + len(data) < start or start + len(chunk) < pos:
+                ranges.append((pos, data))
+                continue
+            if pos < start:
+                chunk = data[:start - pos] + chunk
+                start = pos
+            if pos + len(data) > start + len(chunk):
+                chunk += data[start + len(chunk) - pos:]
+        ranges.append((start, chunk))
+        self._ranges = sorted(ranges, key=lambda x: x[0])
+
+
+def as_reader(src: Union[ReaderAt, BinaryIO, bytes]) -> ReaderAt:
+    ''' Wrap file object or bytes (if not already a `ReaderAt`). '''
+    if isinstance(src, ReaderAt):
+        return src
+    if isinstance(src, (bytes, memoryview)):
+        return BytesReader(src)
+    if isinstance(src, bytearray):
+        return BytesReader(bytes(src))
+    return FileReader(src)
+
+
 def parse_icns_file(fname: str) -> Iterator[Tuple[IcnsType.Media.KeyT, bytes]]:
     '''
     Parse file and yield media entries: (key, data)
     :raises:
         ParserError: if file is not an icns file ("icns" header missing)
     '''
-    with open(fname, 'rb') as fp:
-        # Check whether it is an actual ICNS file
-        magic_num, _ = icns_header_read(fp.read(8))  # ignore total size
-        if magic_num != 'icns':
-            raise ParserError('Not an ICNS file, missing "icns" header.')
-        # Read media entries as long as there is something to read
-        while True:
-            key, size = icns_header_read(fp.read(8))
-            if not key:
-                break  # EOF
-            yield key, fp.read(size - 8)  # -8 header
+    with FileReader(fname) as reader:
+        yield from parse_icns_reader(reader)
+
+
+def parse_icns_data(
+    data: Union[bytes, memoryview], *, nested: bool = False,
+) -> Iterator[Tuple[IcnsType.Media.KeyT, bytes]]:
+    '''
+    Same as `parse_icns_file()` but for in-memory data.
+    - nested : Allow missing icns header (payload of nested icns entry).
+    '''
+    reader = BytesReader(data)
+    if nested and data[:4] != b'icns' and is_icns_without_header(data):
+        yield from _parse_entries(reader, 0)
+    else:
+        yield from parse_icns_reader(reader)
+
+
+def parse_icns_reader(reader: ReaderAt) \
+        -> Iterator[Tuple[IcnsType.Media.KeyT, bytes]]:
+    ''' Same as `parse_icns_file()` but for any `ReaderAt`. '''
+    # Check whether it is an actual ICNS file
+    magic_num, _ = icns_header_read(reader.read_at(0, 8))  # ignore size
+    if magic_num != 'icns':
+        raise ParserError('Not an ICNS file, missing "icns" header.')
+    yield from _parse_entries(reader, 8)
+
+
+def _parse_entries(reader: ReaderAt, offset: int) \
+        -> Iterator[Tuple[IcnsType.Media.KeyT, bytes]]:
+    total = reader.size()
+    LIMITS.check('file_size', total, 'File size')
+    # Read media entries as long as there is something to read
+    while True:
+        key, size = icns_header_read(reader.read_at(offset, 8))
+        if not key:
+            break  # EOF
+        if size < 8:  # invalid length, treat remaining data as payload
+            size = total - offset
+        LIMITS.check('entry_size', size - 8,
+                     'Size of entry "{}"'.format(str(key)))
+        # never read (allocate) beyond end of file, -8 header
+        data = reader.read_at(offset + 8, min(size, total - offset) - 8)
+        check_nesting(key, data)
+        yield key, data
+        offset += size
+
+
+def check_nesting(
+    key: IcnsType.Media.KeyT, data: Union[bytes, memoryview], depth: int = 1,
+) -> None:
+    '''
+    Raise `ParserError` if nested icns files exceed `LIMITS.max_depth`.
+    Only entry headers are read, data is not copied.
+    '''
+    try:
+        is_icns = IcnsType.get(key).is_type('icns')
+    except NotImplementedError:
+        is_icns = False
+    if not is_icns and data[:4] != b'icns':
+        return
+    LIMITS.check('depth', depth, 'Nesting depth')
+    view = memoryview(data)
+    offset = 8 if data[:4] == b'icns' else 0
+    while offset + 8 <= len(view):
+        key, size = icns_header_read(bytes(view[offset:offset + 8]))
+        if size < 8:
+            break  # invalid length, not a (valid) icns
+        check_nesting(key, view[offset + 8:offset + size], depth + 1)
+        offset += size
+
+
+def parse_icns_index(src: Union[ReaderAt, BinaryIO, bytes]) \
+        -> Iterator[Tuple[IcnsType.Media.KeyT, int, int]]:
+    '''
+    Read entry headers only and yield (key, offset, length) of each payload.
+    Payload data is skipped, file objects must be seekable.
+    A table of contents is not used, it may be stale or out of order.
+    Use `CachedReader` to coalesce the header reads.
+    :raises:
+        ParserError: if file is not an icns file or an entry is truncated
+    '''
+    reader = as_reader(src)
+    magic_num, _ = icns_header_read(reader.read_at(0, 8))
+    if magic_num != 'icns':
+        raise ParserError('Not an ICNS file, missing "icns" header.')
+    total = reader.size()
+    LIMITS.check('file_size', total, 'File size')
+    offset = 8
+    while offset + 8 <= total:
+        key, size = icns_header_read(reader.read_at(offset, 8))
+        if size < 8 or offset + size > total:
+            raise ParserError('Invalid length {} of entry "{}" at offset {}.'
+                              .format(size, str(key), offset))
+        LIMITS.check('entry_size', size - 8,
+                     'Size of entry "{}"'.format(str(key)))
+        yield key, offset + 8, size - 8
+        offset += size
+
+
+def read_payload(src: Union[ReaderAt, BinaryIO, bytes], offset: int,
+                 length: int, *, chunk_size: int = 1 << 20) \
+        -> Iterator[bytes]:
+    ''' Read `length` bytes at `offset` in chunks (e.g., for hashing). '''
+    reader = as_reader(src)
+    while length > 0:
+        chunk = reader.read_at(offset, min(length, chunk_size))
+        if not chunk:
+            break  # EOF
+        offset += len(chunk)
+        length -= len(chunk)
+        yield chunk
+
+
+def read_entry(src: Union[ReaderAt, BinaryIO, bytes],
+               key: IcnsType.Media.KeyT) -> Optional[bytes]:
+    ''' Read payload of a single entry without reading other payloads. '''
+    reader = as_reader(src)
+    for k, offset, length in parse_icns_index(reader):
+        if k == key:
+            return reader.read_at(offset, length)
+    return None
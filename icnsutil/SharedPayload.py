@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+'''
+Pass binary payloads to worker processes without pickling the data.
+
+The owner copies all payloads into a single shared memory segment once.
+Workers receive small (segment, offset, length) descriptors and read the
+data directly from the segment. The segment is removed when the owner
+context exits, even if a worker process crashed.
+
+Requires Python 3.8+ (`multiprocessing.shared_memory`). On older versions
+descriptors contain the payload itself (regular pickling).
+'''
+from typing import Any, Dict, Hashable, Mapping, Tuple, Union
+try:
+    from multiprocessing import shared_memory
+    SHM_ENABLED = True
+except ImportError:
+    SHM_ENABLED = False
+
+# (segment name, offset, length) or the payload itself (fallback)
+Descriptor = Union[Tuple[str, int, int], bytes]
+
+
+class SharedPayloads:
+    '''
+    Owner side. Usage:
+    with SharedPayloads({key: data, ...}) as shm:
+        pool.submit(fn, shm[key])  # fn calls `SharedPayload.load(desc)`
+    '''
+
+    def __init__(self, payloads: Mapping[Hashable, bytes]) -> None:
+        self.descriptors = {}  # type: Dict[Hashable, Descriptor]
+        self._shm = None  # type: Any
+        total = sum(len(x) for x in payloads.values())
+        if not SHM_ENABLED or total == 0:
+            self.descriptors = dict(payloads)
+            return
+        self._shm = shared_memory.SharedMemory(create=True, size=total)
+        offset = 0
+        for key, data in payloads.items():
+            self._shm.buf[offset:offset + len(data)] = data
+            self.descriptors[key] = (self._shm.name, offset, len(data))
+            offset += len(data)
+
+    def __getitem__(self, key: Hashable) -> Descriptor:
+        return self.descriptors[key]
+
+    def __enter__(self) -> 'SharedPayloads':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        ''' Release and remove segment. Workers must have finished. '''
+        if self._shm is None:
+            return
+        shm, self._shm = self._shm, None
+        shm.close()
+        shm.unlink()
+
+
+def load(desc: Descriptor) -> bytes:
+    ''' Worker side. Return the payload of descriptor. '''
+    if isinstance(desc, bytes):
+        return desc
+    name, offset, length = desc
+    try:
+        shm = shared_memory.SharedMemory(  # Python 3.13+
+            name, track=False)  # type: ignore[call-arg]
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)  # shares owner's tracker
+    try:
+        return bytes(shm.buf[offset:offset + length])  # type: ignore[index]
+    finally:
+        shm.close()
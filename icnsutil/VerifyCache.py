@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+'''
+Persistent cache (SQLite database) for results of `IcnsFile.verify()`.
+
+Results are stored per file and keyed by size, modification time, content
+hash, and icnsutil version. Unchanged files (same size and mtime) are not
+read at all. Changed files are hashed and their issues are reused if the
+same content was verified before (e.g., copies of the same file).
+'''
+import os  # path, stat
+import json  # dumps, loads
+import sqlite3
+from hashlib import sha256
+from time import time
+from typing import Any, List, Optional
+from . import __version__
+from .IcnsFile import IcnsFile
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    version TEXT NOT NULL,
+    issues TEXT NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_sha256 ON results (sha256, version);
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+'''
+
+
+class VerifyCache:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def __enter__(self) -> 'VerifyCache':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+    def verify(self, fname: str) -> List[str]:
+        ''' Same as `list(IcnsFile.verify(fname))` but cached. '''
+        issues = self.cached(fname)
+        if issues is not None:
+            return issues
+        st = os.stat(fname)  # before reading, in case file is modified
+        with open(fname, 'rb') as fp:
+            data = fp.read()
+        digest = sha256(data).hexdigest()
+        row = self.db.execute(
+            'SELECT issues FROM results WHERE sha256 = ? AND version = ? '
+            'LIMIT 1', (digest, __version__)).fetchone()
+        if row:
+            self.hits += 1
+            issues = json.loads(row[0])
+        else:
+            self.misses += 1
+            issues = list(IcnsFile.verify(data=data))
+        self._insert(fname, st, digest, issues)
+        return issues
+
+    def cached(self, fname: str) -> Optional[List[str]]:
+        ''' Returns issues if file is unchanged (same size and mtime). '''
+        st = os.stat(fname)
+        path = os.path.abspath(fname)
+        row = self.db.execute(
+            'SELECT size, mtime_ns, issues FROM results '
+            'WHERE path = ? AND version = ?', (path, __version__)).fetchone()
+        if row and row[:2] == (st.st_size, st.st_mtime_ns):
+            self.hits += 1
+            self.db.execute('UPDATE results SET used = ? WHERE path = ?',
+                            (time(), path))
+            return json.loads(row[2])  # type: ignore[no-any-return]
+        return None
+
+    def store(self, fname: str, issues: List[str]) -> None:
+        ''' Add result of verification done elsewhere (e.g., in parallel). '''
+        self.misses += 1
+        st = os.stat(fname)
+        with open(fname, 'rb') as fp:
+            digest = sha256(fp.read()).hexdigest()
+        self._insert(fname, st, digest, issues)
+
+    def _insert(
+        self, fname: str, st: os.stat_result, digest: str, issues: List[str],
+    ) -> None:
+        self.db.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (os.path.abspath(fname), st.st_size, st.st_mtime_ns, digest,
+             __version__, json.dumps(issues), time()))
+
+    def evict(
+        self,
+        *,
+        max_age: Optional[float] = None,
+        max_entries: Optional[int] = None,
+    ) -> int:
+        '''
+        Remove results of other icnsutil versions and least recently used
+        results. Returns the number of removed results.
+        - max_age : Remove results not used within the last seconds.
+        - max_entries : Keep only the N most recently used results.
+        '''
+        removed = self.db.execute('DELETE FROM results WHERE version != ?',
+                                  (__version__,)).rowcount
+        if max_age is not None:
+            removed += self.db.execute('DELETE FROM results WHERE used < ?',
+                                       (time() - max_age,)).rowcount
+        if max_entries is not None:
+            removed += self.db.execute(
+                'DELETE FROM results WHERE path IN (SELECT path FROM results '
+                'ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                (max(max_entries, 0),)).rowcount
+        self.db.commit()
+        return removed
+
+    def __len__(self) -> int:
+        return self.db.execute(  # type: ignore[no-any-return]
+            'SELECT COUNT(*) FROM results').fetchone()[0]
@@ -6,4 +6,7 @@ __version__ = '1.1.0'
 
 from .IcnsFile import IcnsFile
 from .ArgbImage import ArgbImage, PIL_ENABLED
-from . import IcnsType, PackBytes, RawData
+from .ExportStore import ExportStore
+from .IcoFile import IcoFile
+from . import IcnsType, PackBytes, RawData, SharedPayload
+from . import Builder, Catalog, Optimizer, VerifyCache
@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
-from typing import Tuple, Optional, List, Type, TypeVar
+import os  # path
+import struct  # unpack
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+from typing import Tuple, Optional, List, Type, TypeVar, BinaryIO
+from .. import RawData
 
 ResizerT = TypeVar('ResizerT', bound='Type[ImageResizer]')
 
@@ -42,16 +48,170 @@ class ImageResizer:
         return min(self.preferred_size, self.actual_size)
 
     def calculateSize(self) -> Tuple[int, int]:
-        assert 0, 'Missing implementation for calculateSize() method'
+        ''' Read size from file header. Use external tool as fallback. '''
+        return probeImageSize(self.fname) or self.toolSize()
+
+    def toolSize(self) -> Tuple[int, int]:
+        assert 0, 'Missing implementation for toolSize() method'
 
     def resize(self, size: int, fname_out: str) -> None:
         assert 0, 'Missing implementation for resize() method'
 
+    def resizeData(self, size: int) -> bytes:
+        ''' Resize and return PNG data. Uses a temporary file by default. '''
+        tmpdir = mkdtemp(prefix='icnsutil-')
+        try:
+            fname = os.path.join(tmpdir, 'resized.png')
+            self.resize(size, fname)
+            with open(fname, 'rb') as fp:
+                return fp.read()
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
+    def close(self) -> None:
+        ''' Called after all resize operations. Remove temporary files. '''
+        pass
+
+
+# --------------------------------------------------------------------
+#  Image size from file header
+# --------------------------------------------------------------------
+
+def probeImageSize(fname: str) -> Optional[Tuple[int, int]]:
+    '''
+    Read image dimensions from file header (without decoding).
+    Supports PNG, JPEG 2000, GIF, BMP, TIFF, and JPEG.
+    Returns None if format is unknown or header is malformed.
+    '''
+    with open(fname, 'rb') as fp:
+        head = fp.read(1024)
+        try:
+            if head[:3] == b'\xFF\xD8\xFF':
+                return _probeJpeg(fp)
+            if head[:4] in (b'II*\x00', b'MM\x00*'):
+                return _probeTiff(fp, head[:2] == b'II')
+        except struct.error:
+            return None
+    try:
+        return _probeHeader(head)
+    except struct.error:
+        return None
+
+
+def _probeHeader(head: bytes) -> Optional[Tuple[int, int]]:
+    ext = RawData.determine_file_ext(head[:8])
+    if ext in ('png', 'jp2'):
+        return RawData.determine_image_size(head, ext)
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', head[6:10])  # type: ignore
+    if head[:2] == b'BM':
+        if struct.unpack('<I', head[14:18])[0] == 12:  # BITMAPCOREHEADER
+            return struct.unpack('<HH', head[18:22])  # type: ignore
+        w, h = struct.unpack('<ii', head[18:26])
+        return w, abs(h)  # negative height for top-down bitmaps
+    return None
+
+
+def _probeTiff(fp: BinaryIO, little: bool) -> Optional[Tuple[int, int]]:
+    end = '<' if little else '>'
+    fp.seek(4)
+    fp.seek(struct.unpack(end + 'I', fp.read(4))[0])  # first IFD
+    count = struct.unpack(end + 'H', fp.read(2))[0]
+    w = h = None
+    for _ in range(count):
+        tag, typ, _, value = struct.unpack(end + 'HHI4s', fp.read(12))
+        if tag in (256, 257):  # ImageWidth, ImageLength
+            val = struct.unpack(end + ('H' if typ == 3 else 'I'),
+                                value[:2] if typ == 3 else value)[0]
+            if tag == 256:
+                w = val
+            else:
+                h = val
+    return (w, h) if w and h else None
+
+
+def _probeJpeg(fp: BinaryIO) -> Optional[Tuple[int, int]]:
+    fp.seek(2)
+    while True:
+        marker = fp.read(2)
+        if len(marker) != 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+            continue  # markers without length
+        length = struct.unpack('>H', fp.read(2))[0]
+        # SOF0 - SOF15, except DHT, JPG, DAC
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack('>xHH', fp.read(5))
+            return w, h
+        fp.seek(length - 2, 1)
+
+
+# --------------------------------------------------------------------
+#  Resizer types
+# --------------------------------------------------------------------
 
 class SVGResizer(ImageResizer):
+    '''
+    Vector images are rendered only once (at the largest requested size).
+    All smaller sizes are downscaled from that raster with a pixel resizer.
+    Sizes below `vector_threshold` are rendered individually (hinting).
+    Set `render_once = False` to render every size from vector data.
+    Without sips or Pillow, every size is rendered individually (rendering
+    is faster than the built-in pure-python resampler).
+    '''
+    render_once = True
+    vector_threshold = 0
+
+    def __init__(self, fname: str, preferred_size: int):
+        super().__init__(fname, preferred_size)
+        self._lock = Lock()
+        self._raster = None  # type: Optional[PixelResizer]
+        self._tmpdir = None  # type: Optional[str]
+
     def calculateSize(self) -> Tuple[int, int]:
         return 999999, 999999
 
+    def resize(self, size: int, fname_out: str) -> None:
+        if self.isVector(size):
+            self.render(size, fname_out)
+        else:
+            self.rasterized().resize(size, fname_out)
+
+    def resizeData(self, size: int) -> bytes:
+        if self.isVector(size):
+            return super().resizeData(size)
+        return self.rasterized().resizeData(size)
+
+    def isVector(self, size: int) -> bool:
+        ''' Returns True if size should be rendered from vector data. '''
+        if not self.render_once or size < self.vector_threshold:
+            return True
+        from .helper import hasNativePixelResizer  # circular import
+        return not hasNativePixelResizer()
+
+    def render(self, size: int, fname_out: str) -> None:
+        assert 0, 'Missing implementation for render() method'
+
+    def rasterized(self) -> 'PixelResizer':
+        ''' Render image at largest (retina) size. Reused for all sizes. '''
+        with self._lock:
+            if not self._raster:
+                from .helper import bestPixelResizer  # circular import
+                self._tmpdir = mkdtemp(prefix='icnsutil-')
+                fname = os.path.join(self._tmpdir, 'render.png')
+                self.render(self.size * 2, fname)
+                self._raster = bestPixelResizer(fname, self.size)
+            return self._raster
+
+    def close(self) -> None:
+        with self._lock:
+            if self._raster:
+                self._raster.close()
+                self._raster = None
+            if self._tmpdir:
+                rmtree(self._tmpdir, ignore_errors=True)
+                self._tmpdir = None
+
 
 class PixelResizer(ImageResizer):
     pass
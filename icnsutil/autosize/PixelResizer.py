@@ -2,11 +2,17 @@
 import re
 from shutil import which
 from subprocess import run, PIPE, DEVNULL
-from typing import Tuple
+from io import BytesIO
+from threading import Lock
+from typing import Tuple, Dict, Optional
 from .ImageResizer import PixelResizer
+from .. import pngcodec
+from ..ArgbImage import ArgbImage
 try:
     from PIL import Image
     PILLOW_ENABLED = True
+    _LANCZOS = getattr(Image, 'Resampling', Image).LANCZOS
+    _BOX = getattr(Image, 'Resampling', Image).BOX
 except ImportError:
     PILLOW_ENABLED = False
 
@@ -26,7 +32,7 @@ class Sips(PixelResizer):
     _regex = re.compile(
         rb'.*pixelWidth:([\s0-9]+).*pixelHeight:([\s0-9]+)', re.DOTALL)
 
-    def calculateSize(self) -> Tuple[int, int]:
+    def toolSize(self) -> Tuple[int, int]:
         res = run(['sips', '-g', 'pixelWidth', '-g', 'pixelHeight',
                    self.fname], stdout=PIPE)
         match = Sips._regex.match(res.stdout)
@@ -45,8 +51,95 @@ class Pillow(PixelResizer):
     def isSupported() -> bool:
         return PILLOW_ENABLED
 
-    def calculateSize(self) -> Tuple[int, int]:
-        return Image.open(self.fname, mode='r').size  # type: ignore
+    def __init__(self, fname: str, preferred_size: int):
+        super().__init__(fname, preferred_size)
+        self._lock = Lock()
+        self._pyramid = {}  # type: Dict[int, Image.Image]
+
+    def toolSize(self) -> Tuple[int, int]:
+        return self.image().size  # type: ignore
+
+    def resize(self, size: int, fname_out: str) -> None:
+        # encode outside of lock. save() modifies the image (encoderinfo),
+        # and the same cached size can be requested by multiple threads.
+        self.image(size).copy().save(fname_out)
+
+    def resizeData(self, size: int) -> bytes:
+        fp = BytesIO()
+        self.image(size).copy().save(fp, format='PNG')
+        return fp.getvalue()
+
+    def image(self, size: Optional[int] = None) -> 'Image.Image':
+        '''
+        Decode source image once and derive all other sizes from a cached
+        pyramid. Exact halvings use `reduce()`, other sizes use Lanczos.
+        If size is None, return the source image.
+        '''
+        with self._lock:
+            if not self._pyramid:
+                img = Image.open(self.fname, mode='r')  # type: Image.Image
+                if img.mode not in ('RGB', 'RGBA'):
+                    img = img.convert('RGBA')
+                img.load()
+                self._pyramid[img.width] = img
+            if size is None:
+                return self._pyramid[max(self._pyramid)]
+            if size in self._pyramid:
+                return self._pyramid[size]
+            # start with smallest level which is larger than requested size
+            larger = [x for x in self._pyramid if x > size]
+            base = self._pyramid[min(larger) if larger else max(self._pyramid)]
+            while base.width >= size * 2 and base.width % 2 == 0:
+                base = _halve(base)
+                self._pyramid[base.width] = base
+            if base.width != size:
+                base = base.resize((size, size), _LANCZOS)
+                self._pyramid[size] = base
+            return base
+
+
+class ArgbResizer(PixelResizer):
+    ''' icnsutil (built-in, slow) '''
+
+    @staticmethod
+    def isSupported() -> bool:
+        return True
+
+    def __init__(self, fname: str, preferred_size: int):
+        super().__init__(fname, preferred_size)
+        self._lock = Lock()
+        self._cache = {}  # type: Dict[int, ArgbImage]
+
+    def toolSize(self) -> Tuple[int, int]:
+        return self.image().size
 
     def resize(self, size: int, fname_out: str) -> None:
-        Image.open(self.fname, mode='r').resize((size, size)).save(fname_out)
+        pngcodec.write_png(self.image(size), fname_out)
+
+    def resizeData(self, size: int) -> bytes:
+        return pngcodec.encode_png(self.image(size))
+
+    def image(self, size: Optional[int] = None) -> ArgbImage:
+        '''
+        Decode source image once. Every size is derived from the smallest
+        cached image which is larger than the requested size.
+        If size is None, return the source image.
+        '''
+        with self._lock:
+            if not self._cache:
+                img = pngcodec.read_png(self.fname)
+                self._cache[img.size[0]] = img
+            if size is None:
+                return self._cache[max(self._cache)]
+            if size not in self._cache:
+                larger = [x for x in self._cache if x > size]
+                base = self._cache[min(larger) if larger else
+                                   max(self._cache)]
+                self._cache[size] = base.resize(size)
+            return self._cache[size]
+
+
+def _halve(img: 'Image.Image') -> 'Image.Image':
+    if hasattr(img, 'reduce'):  # Pillow 7.0+
+        return img.reduce(2)
+    return img.resize((img.width // 2, img.height // 2), _BOX)
@@ -18,7 +18,7 @@ class ReSVG(SVGResizer):
         ReSVG._exe = which('resvg')
         return True if ReSVG._exe else False
 
-    def resize(self, size: int, fname_out: str) -> None:
+    def render(self, size: int, fname_out: str) -> None:
         run([self.exe, '-w', str(size), self.fname, fname_out])
 
 
@@ -37,7 +37,7 @@ class ChromeSVG(SVGResizer):
                 return True
         return False
 
-    def resize(self, size: int, fname_out: str) -> None:
+    def render(self, size: int, fname_out: str) -> None:
         run([self.exe, '--headless', '--disable-gpu', '--hide-scrollbars',
              '--force-device-scale-factor=1', '--default-background-color=000000',
              '--window-size={0},{0}'.format(size),
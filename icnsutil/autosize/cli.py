@@ -4,21 +4,35 @@ Auto-downscale images to generate an iconset (`.iconset`) for `.icns` files.
 '''
 import os
 import sys
-from typing import TYPE_CHECKING, List, Tuple, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Tuple, Optional, Dict, Callable
 if __name__ == '__main__':
     sys.path[0] = os.path.dirname(os.path.dirname(sys.path[0]))
 from icnsutil.autosize.helper import bestImageResizer
+from icnsutil.autosize.ImageResizer import SVGResizer
 if TYPE_CHECKING:
     from icnsutil.autosize.ImageResizer import ImageResizer
 try:
-    from icnsutil import ArgbImage
+    from icnsutil import ArgbImage, IcnsFile, PIL_ENABLED, pngcodec
 except ImportError:
     pass
 
 
 def main() -> None:
+    icns_out = _pop_option('--icns', has_value=True)
+    write_iconset = _pop_option('--iconset')
     images, err = parse_input_args()
-    if images:
+    if images and icns_out:
+        pngs = downscale_to_memory(images)
+        if write_iconset:
+            iconset_out = os.path.splitext(icns_out)[0] + '.iconset'
+            os.makedirs(iconset_out, exist_ok=True)
+            for name, data in pngs.items():
+                with open(os.path.join(iconset_out, name), 'wb') as fp:
+                    fp.write(data)
+        build_icns(pngs).write(icns_out)
+        print('Finished. Created "{}"'.format(icns_out))
+    elif images:
         # TODO: should iconset be created at image source or CWD?
         iconset_out = images[0].fname + '.iconset'
         os.makedirs(iconset_out, exist_ok=True)
@@ -30,6 +44,7 @@ def main() -> None:
         print()
         print('Usage: icnsutil-autosize icon.svg -16 small.svg')
         print('       icnsutil-autosize 1024.png img32px.png')
+        print('       icnsutil-autosize --icns out.icns [--iconset] 1024.png')
         if err:
             print()
             print(err, file=sys.stderr)
@@ -38,19 +53,46 @@ def main() -> None:
         exit(1 if err else 0)
 
 
+def _pop_option(name: str, *, has_value: bool = False) -> Optional[str]:
+    ''' Remove option from sys.argv. Supports `--opt VAL` and `--opt=VAL`. '''
+    for i, arg in enumerate(sys.argv):
+        if has_value and arg.startswith(name + '='):
+            del sys.argv[i]
+            return arg.split('=', 1)[1]
+        if arg == name:
+            del sys.argv[i]
+            if not has_value:
+                return arg
+            if i < len(sys.argv):
+                return sys.argv.pop(i)
+            return None
+    return None
+
+
 def parse_input_args() -> Tuple[Optional[List['ImageResizer']], Optional[str]]:
     '''
     List of image files sorted by resolution in descending order.
     Manually overwrite resolution by prepending `-X` before image-name,
     where `X` is one of: [16, 32, 128, 256, 512].
     `X` applies for both, normal and retina size (`img_X.png`, `img_X@2x.png`)
+
+    Use `--icns OUT` to create the icns file directly (in memory).
+    Add `--iconset` to write the intermediate iconset nevertheless.
+
+    SVG images are rendered once and downscaled with a pixel resizer.
+      --svg-per-size         Render every size from vector data instead.
+      --svg-vector-below=X   Render sizes below X px from vector data.
     '''
     if len(sys.argv) == 1 or '-h' in sys.argv or '--help' in sys.argv:
         return None, None  # just print help
     size = 512  # assume first icon is 1024x1024 (512@2x)
     ret = []
     for arg in sys.argv[1:]:
-        if arg.startswith('-'):  # size indicator (-<int>)
+        if arg == '--svg-per-size':
+            SVGResizer.render_once = False
+        elif arg.startswith('--svg-vector-below='):
+            SVGResizer.vector_threshold = int(arg.split('=', 1)[1])
+        elif arg.startswith('-'):  # size indicator (-<int>)
             new_size = int(arg[1:])
             if new_size >= size:
                 return None, 'Icons must be sorted by size, largest first.'
@@ -62,26 +104,100 @@ def parse_input_args() -> Tuple[Optional[List['ImageResizer']], Optional[str]]:
     return ret, None
 
 
-def downscale_images(images: List['ImageResizer'], outdir: str) -> None:
-    ''' Go through all files and apply resizer one by one. '''
+def downscale_images(
+    images: List['ImageResizer'], outdir: str, *, jobs: Optional[int] = None,
+) -> None:
+    '''
+    Go through all files and apply resizer.
+    Resize jobs run in parallel (`jobs` threads), output remains ordered.
+    Jobs are scheduled largest-first (resizers may reuse larger results).
+    '''
+    _schedule(images, lambda img, size, name: img.resize(
+        size, os.path.join(outdir, name)), jobs=jobs)
+
+
+def downscale_to_memory(
+    images: List['ImageResizer'], *, jobs: Optional[int] = None,
+) -> Dict[str, bytes]:
+    ''' Same as `downscale_images()` but return {iconset-filename: PNG}. '''
+    ret = {}  # type: Dict[str, bytes]
+
+    def fn(img: 'ImageResizer', size: int, name: str) -> None:
+        ret[name] = img.resizeData(size)
+    _schedule(images, fn, jobs=jobs)
+    return ret
+
+
+def _schedule(
+    images: List['ImageResizer'],
+    fn: Callable[['ImageResizer', int, str], None],
+    *,
+    jobs: Optional[int] = None,
+) -> None:
+    ''' Run `fn(img, size, iconset-filename)` for all required sizes. '''
     all_sizes = [x.size for x in images[1:]] + [0]
-    for img, nextsize in zip(images, all_sizes):
-        maxsize = img.size
-        if nextsize >= maxsize:
-            print('SKIP: "{}" (next image is larger, {}px <= {}px)'.format(
-                img.fname, maxsize, nextsize), file=sys.stderr)
-            continue
+    queue = []  # type: List[Tuple[ImageResizer, int, List[Future]]]
+    with ThreadPoolExecutor(jobs or os.cpu_count() or 1) as pool:
+        for img, nextsize in zip(images, all_sizes):
+            maxsize = img.size
+            if nextsize >= maxsize:
+                queue.append((img, nextsize, []))
+                continue
+            futures = []
+            for s in (512, 256, 128, 32, 16):
+                if nextsize < s <= maxsize:
+                    base = 'icon_{0}x{0}'.format(s)
+                    futures.append(
+                        pool.submit(fn, img, s * 2, base + '@2x.png'))
+                    futures.append(pool.submit(fn, img, s, base + '.png'))
+            queue.append((img, nextsize, futures))
+
+        for img, nextsize, futures in queue:
+            if not futures:
+                print('SKIP: "{}" (next image is larger, {}px <= {}px)'.format(
+                    img.fname, img.size, nextsize), file=sys.stderr)
+                continue
+            print('downscaling from {}@2x ({}): '.format(
+                img.size, type(img).__name__), end='', flush=True)
+            try:
+                for future in futures:
+                    future.result()  # re-raise exceptions
+                    print('.', end='', flush=True)
+            finally:
+                img.close()
+            print(' done.')  # finishes "...." line
+
+
+def build_icns(images: Dict[str, bytes]) -> 'IcnsFile':
+    '''
+    Create icns from in-memory PNG images (see `downscale_to_memory()`).
+    16px and 32px images are converted to ARGB (with Pillow or pngcodec).
+    '''
+    icns = IcnsFile()
+    use_argb = True
+    for name, data in sorted(images.items(), key=lambda x: len(x[1])):
+        if use_argb and name in ('icon_16x16.png', 'icon_32x32.png'):
+            print('converting {} to argb (icnsutil): ... '.format(name),
+                  end='')
+            try:
+                icns.add_media(data=_decode_png(data).argb_data())
+                print('done.')  # finishes "..." line
+                continue
+            except Exception as e:
+                use_argb = False
+                print('error.')  # finishes "..." line
+                print(' E:', e, file=sys.stderr)
+                print(' E: Proceeding without ARGB images ...',
+                      file=sys.stderr)
+        icns.add_media(data=data, file=name)
+    return icns
+
 
-        print('downscaling from {}@2x ({}): '.format(
-            maxsize, type(img).__name__), end='')
-        for s in (16, 32, 128, 256, 512):
-            if nextsize < s <= maxsize:
-                base = os.path.join(outdir, 'icon_{0}x{0}'.format(s))
-                print('.', end='')
-                img.resize(s, base + '.png')
-                print('.', end='')
-                img.resize(s * 2, base + '@2x.png')
-        print(' done.')  # finishes "...." line
+def _decode_png(data: bytes) -> 'ArgbImage':
+    ''' Use Pillow if installed, built-in PNG decoder otherwise. '''
+    if PIL_ENABLED:
+        return ArgbImage(data=data)
+    return pngcodec.decode_png(data)
 
 
 def convert_icnsutil(iconset_dir: str, icns_file: str) -> None:
@@ -93,7 +209,8 @@ def convert_icnsutil(iconset_dir: str, icns_file: str) -> None:
             continue
         print('converting {0}x{0}.argb (icnsutil): ... '.format(x), end='')
         try:
-            argb_image = ArgbImage(file=src)
+            with open(src, 'rb') as fp:
+                argb_image = _decode_png(fp.read())
             with open(dst, 'wb') as fp:
                 fp.write(argb_image.argb_data())
             print('done.')  # finishes "..." line
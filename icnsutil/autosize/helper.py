@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import os
 from .ImageResizer import firstSupportedResizer
-from .PixelResizer import Sips, Pillow
+from .PixelResizer import Sips, Pillow, ArgbResizer
 from .SVGResizer import ReSVG, ChromeSVG
 from typing import TYPE_CHECKING, List, Optional, Type
 if TYPE_CHECKING:
@@ -16,6 +16,7 @@ SVG_RESIZERS = [
 PX_RESIZERS = [
     Sips,
     Pillow,
+    ArgbResizer,
 ]  # type: List[Type[PixelResizer]]
 
 BEST_SVG = None  # type: Optional[Type[SVGResizer]]
@@ -23,13 +24,26 @@ BEST_PX = None  # type: Optional[Type[PixelResizer]]
 
 
 def bestImageResizer(fname: str, preferred_size: int) -> 'ImageResizer':
-    global BEST_SVG, BEST_PX
+    global BEST_SVG
     ext = os.path.splitext(fname)[1].lower()
     if ext == '.svg':
         BEST_SVG = BEST_SVG or firstSupportedResizer(SVG_RESIZERS)
         assert BEST_SVG, 'No supported image resizer found for ' + ext
         return BEST_SVG(fname, preferred_size)
     else:
-        BEST_PX = BEST_PX or firstSupportedResizer(PX_RESIZERS)
-        assert BEST_PX, 'No supported image resizer found for ' + ext
-        return BEST_PX(fname, preferred_size)
+        return bestPixelResizer(fname, preferred_size)
+
+
+def bestPixelResizer(fname: str, preferred_size: int) -> 'PixelResizer':
+    global BEST_PX
+    BEST_PX = BEST_PX or firstSupportedResizer(PX_RESIZERS)
+    assert BEST_PX, 'No supported image resizer found for raster images'
+    return BEST_PX(fname, preferred_size)
+
+
+def hasNativePixelResizer() -> bool:
+    '''
+    Returns True if a raster image resizer other than the built-in (slow)
+    `ArgbResizer` is supported, e.g., sips or Pillow.
+    '''
+    return any(x.isSupported() for x in PX_RESIZERS if x is not ArgbResizer)
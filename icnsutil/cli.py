@@ -4,27 +4,45 @@ Export existing icns files or compose new ones.
 '''
 import os  # path, makedirs
 import sys  # path, stderr
-from typing import Iterator, Optional, Callable, List
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Iterator, Iterable, Optional, Callable, List, Tuple, Dict
 from argparse import ArgumentParser, ArgumentTypeError, Namespace as ArgParams
 if __name__ == '__main__':
     sys.path[0] = os.path.dirname(sys.path[0])
-from icnsutil import __version__, IcnsFile, IcnsType, ArgbImage
+from icnsutil import __version__, IcnsFile, IcnsType, ArgbImage, Builder
+from icnsutil import RawData
+from icnsutil import ExportStore, Catalog, VerifyCache, IcoFile, Optimizer
 
 
 def cli_extract(args: ArgParams) -> None:
     ''' Read and extract contents of icns file(s). '''
     multiple = len(args.file) > 1 or '-' in args.file
-    for i, fname in enumerate(enum_with_stdin(args.file)):
-        # PathExist ensures that all files and directories exist
-        out = args.export_dir
-        if out and multiple:
-            out = os.path.join(out, str(i))
-            os.makedirs(out, exist_ok=True)
-
-        IcnsFile(fname).export(
-            out, allowed_ext='png' if args.png_only else '*',
-            recursive=args.recursive, convert_png=args.convert,
-            key_suffix=args.keys)
+    store = ExportStore(args.store, link=args.link) if args.store else None
+    pool = None  # type: Optional[ProcessPoolExecutor]
+    if args.convert and args.jobs != 1:
+        pool = ProcessPoolExecutor(args.jobs or None)
+    try:
+        for i, fname in enumerate(enum_with_stdin(args.file)):
+            # PathExist ensures that all files and directories exist
+            out = args.export_dir
+            if out and multiple:
+                out = os.path.join(out, str(i))
+                os.makedirs(out, exist_ok=True)
+
+            exported = IcnsFile(fname).export(
+                out, allowed_ext='png' if args.png_only else '*',
+                recursive=args.recursive, convert_png=args.convert,
+                key_suffix=args.keys, store=store, executor=pool)
+            if store:
+                store.record(exported)
+    finally:
+        if pool:
+            pool.shutdown()
+    if store:
+        store.save()
+        print('store: {}'.format(store))
 
 
 def cli_compose(args: ArgParams) -> None:
@@ -32,15 +50,59 @@ def cli_compose(args: ArgParams) -> None:
     dest = args.target
     if not os.path.splitext(dest)[1]:
         dest += '.icns'  # for the lazy people
-    if not args.force and os.path.exists(dest):
+    if args.watch:
+        cli_compose_watch(dest, args)
+        return
+    if args.cache:
+        sources = list(enum_with_stdin(args.source))
+        opts = {'sources': sources, 'toc': args.toc, 'layout': args.layout}
+        with Builder.BuildCache(args.cache) as cache:
+            digest = cache.output_digest(opts)
+            if cache.is_up_to_date(dest, digest):
+                print('File "{}" is up-to-date.'.format(dest))
+                return
+            _compose_check_force(dest, args.force)
+            Builder.build_single(dest, opts, Builder.SourcePool(cache))
+            cache.record(dest, digest)
+        return
+    _compose_check_force(dest, args.force)
+    img = IcnsFile()
+    for x in enum_with_stdin(args.source):
+        img.add_media(file=x)
+    img.write(dest, toc=args.toc, layout=args.layout)
+
+
+def cli_compose_watch(dest: str, args: ArgParams) -> None:
+    ''' Rebuild icns file whenever a source file changes. '''
+    if '-' in args.source:
+        print('Watch mode does not support stdin.', file=sys.stderr)
+        exit(1)
+    _compose_check_force(dest, args.force)
+    cache = Builder.BuildCache(args.cache) if args.cache else None
+    watcher = Builder.Watcher(dest, args.source, toc=args.toc,
+                              layout=args.layout, cache=cache)
+
+    def on_change(files: List[str]) -> None:
+        print('updated "{}" ({} changed)'.format(dest, len(files)))
+        for x in files:
+            print(' ', x)
+        if cache:
+            cache.save()
+
+    def on_error(e: Exception) -> None:
+        print('error:', e, file=sys.stderr)
+
+    print('Watching {} source(s). Press Ctrl+C to stop.'.format(
+        len(args.source)))
+    watcher.run(args.interval, callback=on_change, on_error=on_error)
+
+
+def _compose_check_force(dest: str, force: bool) -> None:
+    if not force and os.path.exists(dest):
         print(
             'File "{}" already exists. Force overwrite with -f.'.format(dest),
             file=sys.stderr)
         exit(1)
-    img = IcnsFile()
-    for x in enum_with_stdin(args.source):
-        img.add_media(file=x)
-    img.write(dest, toc=args.toc)
 
 
 def cli_update(args: ArgParams) -> None:
@@ -72,8 +134,9 @@ def cli_update(args: ArgParams) -> None:
 
         icns.add_media(IcnsType.key_from_readable(key), file=val, force=True)
     # write file
-    if has_changes or args.output:
-        icns.write(args.output or args.file, toc=icns.has_toc())
+    if has_changes or args.output or args.layout != 'as-is':
+        icns.write(args.output or args.file, toc=icns.has_toc(),
+                   layout=args.layout)
 
 
 def cli_print(args: ArgParams) -> None:
@@ -89,31 +152,223 @@ def cli_print(args: ArgParams) -> None:
 
 def cli_verify(args: ArgParams) -> None:
     ''' Test if icns file is valid. '''
-    for fname in enum_with_stdin(args.file):
-        is_valid = True  # type: Optional[bool]
-        if not args.quiet:
+    cache = VerifyCache.VerifyCache(args.cache) if args.cache else None
+    try:
+        if args.jobs == 1:
+            for fname in enum_with_stdin(args.file):
+                _print_verify(fname, cache.verify(fname) if cache else
+                              IcnsFile.verify(fname), quiet=args.quiet)
+        else:
+            cli_verify_parallel(list(enum_with_stdin(args.file)), cache,
+                                jobs=args.jobs or None, quiet=args.quiet)
+    finally:
+        if cache:
+            cache.evict(max_age=args.max_age and args.max_age * 86400,
+                        max_entries=args.max_entries)
+            cache.close()
+
+
+def cli_verify_parallel(
+    files: List[str],
+    cache: Optional[VerifyCache.VerifyCache],
+    *,
+    jobs: Optional[int],
+    quiet: bool,
+) -> None:
+    '''
+    Verify files in worker processes, output remains ordered.
+    Workers read the files themselves, only filenames are transferred.
+    '''
+    results = {}  # type: Dict[str, List[str]]
+    if cache:
+        for fname in files:
+            cached = cache.cached(fname)
+            if cached is not None:
+                results[fname] = cached
+    todo = [x for x in files if x not in results]
+    with ProcessPoolExecutor(jobs) as pool:
+        for fname, issues in zip(todo, pool.map(_verify_job, todo)):
+            results[fname] = issues
+            if cache:
+                cache.store(fname, issues)
+    for fname in files:
+        _print_verify(fname, results[fname], quiet=quiet)
+
+
+def _verify_job(fname: str) -> List[str]:
+    ''' Worker process entry. '''
+    return list(IcnsFile.verify(fname))
+
+
+def _print_verify(fname: str, issues: Iterable[str], *, quiet: bool) -> None:
+    is_valid = True  # type: Optional[bool]
+    if not quiet:
+        print('File:', fname)
+        is_valid = None
+    for issue in issues:
+        if is_valid:
             print('File:', fname)
-            is_valid = None
-        for issue in IcnsFile.verify(fname):
-            if is_valid:
-                print('File:', fname)
-            is_valid = False
-            print(' ', issue)
-        if not args.quiet and is_valid is not False:
-            print('OK')
+        is_valid = False
+        print(' ', issue)
+    if not quiet and is_valid is not False:
+        print('OK')
+
+
+def cli_diff(args: ArgParams) -> None:
+    ''' Compare two icns files. Exit code 1 if files differ. '''
+    try:
+        changes = list(IcnsFile.diff(args.file_a, args.file_b,
+                                     pixels=args.pixels))
+    except RawData.ParserError as e:
+        print('error:', e, file=sys.stderr)
+        exit(2)
+    if not args.quiet:
+        for line in changes:
+            print(line)
+    if changes:
+        exit(1)
+
+
+def cli_ico(args: ArgParams) -> None:
+    ''' Convert icns file to Windows ico file (or vice versa). '''
+    _compose_check_force(args.target, args.force)
+    with open(args.source, 'rb') as fp:
+        data = fp.read()
+    try:
+        if RawData.determine_file_ext(data[:8]) == 'icns':
+            IcoFile.from_icns(IcnsFile(data=data)).write(args.target)
+        else:
+            IcoFile(data=data).to_icns().write(args.target, toc=args.toc)
+    except RawData.ParserError as e:
+        print('error:', e, file=sys.stderr)
+        exit(1)
+
+
+def cli_optimize(args: ArgParams) -> None:
+    ''' Remove redundant entries and re-pack images (in place). '''
+    job = partial(Optimizer.optimize_file, policy=args.policy,
+                  argb_png=args.png, dry_run=args.dry_run)
+    files = list(enum_with_stdin(args.file))
+    pool = None  # type: Optional[ProcessPoolExecutor]
+    if args.jobs != 1:
+        pool = ProcessPoolExecutor(args.jobs or None)
+    before = after = 0
+    failed = False
+    try:
+        for res in (pool.map(job, files) if pool else map(job, files)):
+            failed |= res.error is not None
+            before += res.before
+            after += res.after
+            print(res, file=sys.stderr if res.error else sys.stdout)
+    finally:
+        if pool:
+            pool.shutdown()
+    if len(files) > 1:
+        print('total: {} -> {} bytes ({} saved)'.format(
+            before, after, before - after))
+    if failed:
+        exit(1)
 
 
 def cli_convert(args: ArgParams) -> None:
     ''' Convert images between PNG, ARGB, or RGB + alpha mask. '''
-    img = ArgbImage(file=args.source)
-    if args.mask:
-        img.load_mask(file=args.mask)
+    if args.output_dir:
+        cli_convert_batch(args)
+        return
+    if len(args.source) > 2:
+        print('Multiple sources require an output directory (-o).',
+              file=sys.stderr)
+        exit(1)
+    for x in args.source:
+        if not os.path.isfile(x):
+            print('File "{}" does not exist.'.format(x), file=sys.stderr)
+            exit(1)
+    source, *mask = args.source
 
     dest = args.target
     if args.target in ['png', 'argb', 'rgb']:
-        dest = args.source + '.' + args.target
+        dest = source + '.' + args.target
+
+    if not convert_image(source, dest, mask[0] if mask else None,
+                         raw=args.raw):
+        print('Could not determine target image-type for file "{}".'.format(
+            dest), file=sys.stderr)
+        exit(1)
+
+
+def cli_convert_batch(args: ArgParams) -> None:
+    ''' Convert many images in parallel. Skip up-to-date targets. '''
+    if args.target not in ['png', 'argb', 'rgb']:
+        print('Batch conversion requires one of: png, argb, rgb. Got "{}".'
+              .format(args.target), file=sys.stderr)
+        exit(1)
+    jobs = []  # type: List[Tuple[str, str, Optional[str], bool]]
+    planned = {}  # type: Dict[str, str]
+    for src in enum_images(args.source):
+        dest = os.path.join(
+            args.output_dir, os.path.basename(src) + '.' + args.target)
+        if dest in planned:
+            if os.path.samefile(planned[dest], src):
+                continue  # same file matched twice
+            print('error: "{}" and "{}" would both write "{}"'.format(
+                planned[dest], src, dest), file=sys.stderr)
+            exit(1)
+        planned[dest] = src
+        if not args.force and is_up_to_date(dest, src):
+            print('skip:', dest)
+            continue
+        mask = src + '.mask' if src.endswith('.rgb') else None
+        if mask and not os.path.isfile(mask):
+            mask = None
+        jobs.append((src, dest, mask, args.raw))
+
+    if args.jobs == 1 or len(jobs) < 2:
+        results = map(_convert_job, jobs)  # type: Iterable[Optional[str]]
+        _print_convert_results(jobs, results)
+    else:
+        with ProcessPoolExecutor(args.jobs or None) as pool:
+            _print_convert_results(jobs, pool.map(_convert_job, jobs))
+
+
+def _print_convert_results(
+    jobs: List[Tuple[str, str, Optional[str], bool]],
+    results: Iterable[Optional[str]],
+) -> None:
+    failed = False
+    for (src, dest, _, _), err in zip(jobs, results):
+        if err:
+            failed = True
+            print('error: "{}": {}'.format(src, err), file=sys.stderr)
+        else:
+            print('{} -> {}'.format(src, dest))
+    if failed:
+        exit(1)
+
+
+def _convert_job(job: Tuple[str, str, Optional[str], bool]) -> Optional[str]:
+    ''' Worker process entry. Returns error message or None. '''
+    src, dest, mask, raw = job
+    try:
+        convert_image(src, dest, mask, raw=raw)
+    except Exception as e:
+        return str(e)
+    return None
 
+
+def convert_image(
+    source: str, dest: str, mask: Optional[str] = None, *, raw: bool = False,
+) -> bool:
+    '''
+    Convert single image. Image type is determined by extension of dest.
+    Returns False if extension is unknown.
+    '''
     ext = os.path.splitext(dest)[1]
+    if ext not in ['.png', '.argb', '.rgb']:
+        return False
+    img = ArgbImage(file=source)
+    if mask:
+        img.load_mask(file=mask)
+
     if ext == '.png':
         img.write_png(dest)
     elif ext == '.argb':
@@ -121,29 +376,108 @@ def cli_convert(args: ArgParams) -> None:
             fp.write(img.argb_data())
     elif ext == '.rgb':
         with open(dest, 'wb') as fp:
-            if not args.raw and img.size == (128, 128):
+            if not raw and img.size == (128, 128):
                 fp.write(b'\x00\x00\x00\x00')  # fix for it32
             fp.write(img.rgb_data())
         with open(dest + '.mask', 'wb') as fp:
             fp.write(img.mask_data())
-    else:
-        print('Could not determine target image-type for file "{}".'.format(
-            dest), file=sys.stderr)
+    return True
+
+
+def is_up_to_date(dest: str, source: str) -> bool:
+    ''' Returns True if dest exists and is newer than source. '''
+    try:
+        return os.stat(dest).st_mtime_ns > os.stat(source).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def cli_serve(args: ArgParams) -> None:
+    ''' Run conversion service (compose, extract, convert, info, verify). '''
+    from .server import serve
+    address = args.socket or (args.host, args.port)
+    print('Listening on', args.socket or 'http://{}:{}'.format(*address))
+    try:
+        serve(address, workers=args.jobs, cache_size=args.cache_size)
+    except OSError as e:
+        print('error:', e, file=sys.stderr)
         exit(1)
 
 
+def enum_images(file_arg: List[str]) -> Iterator[str]:
+    '''
+    Expand directories and glob patterns to convertable image files.
+    Alpha masks (.mask) are skipped, they are loaded along with their image.
+    '''
+    allowed_ext = ['png', 'argb', 'rgb', 'jp2', 'j2k', 'jpf']
+    for x in file_arg:
+        if os.path.isdir(x):
+            for fname in sorted(os.listdir(x)):
+                if os.path.splitext(fname)[1][1:].lower() in allowed_ext:
+                    yield os.path.join(x, fname)
+        elif os.path.exists(x):
+            if not x.endswith('.mask'):
+                yield x
+        else:
+            matches = sorted(glob(x))
+            if not matches:
+                print('No file matches "{}".'.format(x), file=sys.stderr)
+            for fname in matches:
+                if os.path.isfile(fname) and not fname.endswith('.mask'):
+                    yield fname
+
+
+def cli_build(args: ArgParams) -> None:
+    ''' Create multiple icns files as described in a manifest file. '''
+    failed = False
+    for manifest in args.manifest:
+        try:
+            outputs = Builder.load_manifest(manifest)
+        except Builder.BuildError as e:
+            print('error:', e, file=sys.stderr)
+            exit(1)
+        cache = Builder.BuildCache(args.cache) if args.cache else None
+        pool = Builder.SourcePool(cache)
+        for res in Builder.build(outputs, jobs=args.jobs, pool=pool):
+            failed |= res.error is not None
+            print(res, file=sys.stderr if res.error else sys.stdout)
+        if cache:
+            cache.save()
+    if failed:
+        exit(1)
+
+
+def cli_index(args: ArgParams) -> None:
+    ''' Add icns files to catalog database. Skip unchanged files. '''
+    with Catalog.Catalog(args.db) as catalog:
+        print(catalog.update(enum_with_stdin(args.path)))
+
+
+def cli_query(args: ArgParams) -> None:
+    ''' Run canned or ad-hoc SQL query on catalog database. '''
+    if not args.query:
+        for name, (desc, _) in sorted(Catalog.QUERIES.items()):
+            print('{:<12} {}'.format(name, desc))
+        return
+    try:
+        with Catalog.Catalog(args.db, readonly=True) as catalog:
+            columns, rows = catalog.query(args.query, args.param)
+    except (OSError, Catalog.sqlite3.Error) as e:
+        print('error:', e, file=sys.stderr)
+        exit(1)
+    if not args.quiet:
+        print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if x is None else str(x) for x in row))
+
+
 def enum_with_stdin(file_arg: List[str]) -> Iterator[str]:
     for x in file_arg:
         if x == '-':
             for line in sys.stdin.readlines():
                 yield line.strip()
-        elif x.lower().endswith('.iconset'):  # enum directory content
-            allowed_ext = IcnsType.supported_extensions()
-            for fname in os.listdir(x):
-                if os.path.splitext(fname)[1][1:].lower() in allowed_ext:
-                    yield os.path.join(x, fname)
         else:
-            yield x
+            yield from Builder.enum_sources([x])
 
 
 def main() -> None:
@@ -163,6 +497,12 @@ def main() -> None:
                 raise ArgumentTypeError('Does not exist "{}"'.format(path))
             return path
 
+    def job_count(val: str) -> int:
+        num = int(val)
+        if num < 0:
+            raise ArgumentTypeError('Must be 0 or greater "{}"'.format(val))
+        return num
+
     # Args Parser
     parser = ArgumentParser(description=__doc__)
     parser.set_defaults(func=lambda _: parser.print_help(sys.stdout))
@@ -192,6 +532,12 @@ def main() -> None:
                      help='convert ARGB and RGB images to PNG')
     cmd.add_argument('--png-only', action='store_true',
                      help='do not extract ARGB, binary, and meta files')
+    cmd.add_argument('-j', '--jobs', type=job_count, metavar='N', default=1,
+                     help='Worker processes for --convert (0: all cores)')
+    cmd.add_argument('--store', type=str, metavar='DIR', help='''
+        write each distinct file once (by content hash) and link exports''')
+    cmd.add_argument('--link', choices=['hard', 'sym'], default='hard',
+                     help='link type used with --store (default: hard)')
     cmd.add_argument('file', type=PathExist('f', stdin=True), nargs='+',
                      metavar='FILE', help='One or more .icns files')
 
@@ -202,6 +548,15 @@ def main() -> None:
     cmd.add_argument('--toc', action='store_true', help='''
         Write table of contents to file.
         TOC is optional and uses just a few bytes (8b per media entry).''')
+    cmd.add_argument('--layout', choices=IcnsFile.LAYOUTS, default='as-is',
+                     help='''Order of entries. Use small-first or tiles-first
+        for faster partial reads of small icons (default: as-is)''')
+    cmd.add_argument('--cache', type=str, metavar='DIR', help='''
+        Use build cache directory. Skip if no source has changed.''')
+    cmd.add_argument('-w', '--watch', action='store_true', help='''
+        Keep running and rebuild whenever a source file changes.''')
+    cmd.add_argument('--interval', type=float, default=0.5, metavar='SEC',
+                     help='Watch mode polling interval (default: 0.5)')
     cmd.add_argument('target', type=str, metavar='destination',
                      help='Output file for newly created icns file.')
     cmd.add_argument('source', type=PathExist('f|.iconset', stdin=True),
@@ -213,12 +568,25 @@ def main() -> None:
         If the suffix ends on one of these (template, selected, dark),
         the file is automatically assigned to an icns file field.''')
 
+    # Build
+    cmd = add_command('build', ['b'], cli_build)
+    cmd.add_argument('-j', '--jobs', type=job_count, metavar='N',
+                     help='Number of outputs built in parallel (0: all cores)')
+    cmd.add_argument('--cache', type=str, metavar='DIR',
+                     help='Use build cache directory. Skip unchanged outputs.')
+    cmd.add_argument('manifest', type=PathExist('f'), nargs='+',
+                     metavar='MANIFEST', help='''
+        JSON file with {"outputs": {"out.icns": {"sources": [...]}}}.
+        Optional keys per output: dark, selected, template, toc, layout.''')
+
     # Update
     cmd = add_command('update', ['u'], cli_update)
     cmd.add_argument('file', type=PathExist('f', stdin=True),
                      metavar='FILE', help='The icns file to be updated.')
     cmd.add_argument('-o', '--output', type=str, metavar='OUT_FILE',
                      help='Choose another destination, dont overwrite input.')
+    cmd.add_argument('--layout', choices=IcnsFile.LAYOUTS, default='as-is',
+                     help='Reorder entries (default: keep order)')
     grp = cmd.add_argument_group('action')
     grp.add_argument('-rm', type=str, nargs='+', metavar='KEY',
                      help='Remove media keys from icns file')
@@ -239,19 +607,106 @@ def main() -> None:
     cmd = add_command('test', ['t'], cli_verify)
     cmd.add_argument('-q', '--quiet', action='store_true',
                      help='do not print OK results')
+    cmd.add_argument('-j', '--jobs', type=job_count, metavar='N', default=1,
+                     help='Number of worker processes (0: all cores)')
+    cmd.add_argument('--cache', type=str, metavar='FILE', help='''
+        Store results in database. Unchanged files are not verified again.''')
+    cmd.add_argument('--max-age', type=float, metavar='DAYS',
+                     help='Remove cached results not used for DAYS')
+    cmd.add_argument('--max-entries', type=int, metavar='N',
+                     help='Keep only the N most recently used results')
     cmd.add_argument('file', type=PathExist('f', stdin=True), nargs='+',
                      metavar='FILE', help='One or more .icns files.')
 
+    # Diff
+    cmd = add_command('diff', [], cli_diff)
+    cmd.add_argument('--pixels', action='store_true',
+                     help='count differing pixels of changed RGB/ARGB/masks')
+    cmd.add_argument('-q', '--quiet', action='store_true',
+                     help='do not print changes, only set exit code')
+    cmd.add_argument('file_a', type=PathExist('f'), metavar='FILE_A')
+    cmd.add_argument('file_b', type=PathExist('f'), metavar='FILE_B')
+    cmd.epilog = '''Output: "-" removed, "+" added, "~" changed,
+        "@" same content at different offset.'''
+
+    # Index
+    cmd = add_command('index', [], cli_index)
+    cmd.add_argument('--db', type=str, required=True, metavar='FILE',
+                     help='SQLite catalog file (created if missing)')
+    cmd.add_argument('path', type=PathExist('any', stdin=True), nargs='+',
+                     metavar='PATH', help='''
+        Directories (searched recursively for .icns files) or icns files.''')
+
+    # Query
+    cmd = add_command('query', [], cli_query)
+    cmd.add_argument('--db', type=str, required=True, metavar='FILE',
+                     help='SQLite catalog file')
+    cmd.add_argument('-q', '--quiet', action='store_true',
+                     help='do not print column names')
+    cmd.add_argument('query', type=str, nargs='?', help='''
+        Name of canned query or SQL statement (read-only).
+        Lists all canned queries if omitted.''')
+    cmd.add_argument('param', type=str, nargs='*',
+                     help='Query parameters (replace "?" placeholders)')
+
+    # Ico
+    cmd = add_command('ico', [], cli_ico)
+    cmd.add_argument('-f', '--force', action='store_true',
+                     help='Force overwrite output file')
+    cmd.add_argument('--toc', action='store_true',
+                     help='Write table of contents (if target is icns file)')
+    cmd.add_argument('target', type=str, metavar='destination',
+                     help='Output file (.ico or .icns)')
+    cmd.add_argument('source', type=PathExist('f'), metavar='src', help='''
+        icns or ico file. PNG images are copied without re-encoding.''')
+
+    # Optimize
+    cmd = add_command('optimize', [], cli_optimize)
+    cmd.add_argument('--policy', choices=list(Optimizer.POLICIES),
+                     default='redundant',
+                     help='Which entries to remove (default: redundant)')
+    cmd.add_argument('--png', action='store_true', help='''
+        Store ic04, ic05, and icsb as ARGB or PNG, whichever is smaller''')
+    cmd.add_argument('-n', '--dry-run', action='store_true',
+                     help='Report savings but do not modify files')
+    cmd.add_argument('-j', '--jobs', type=job_count, metavar='N', default=1,
+                     help='Number of worker processes (0: all cores)')
+    cmd.add_argument('file', type=PathExist('f', stdin=True), nargs='+',
+                     metavar='FILE', help='One or more .icns files.')
+    cmd.epilog = 'Policies: ' + '; '.join(
+        '"{}" {}'.format(*x) for x in Optimizer.POLICIES.items()) + '.'
+
     # Convert
     cmd = add_command('convert', ['img'], cli_convert)
     cmd.add_argument('--raw', action='store_true',
                      help='no post-processing. Do not prepend it32 header.')
+    cmd.add_argument('-o', '--output-dir', type=PathExist('d'),
+                     metavar='DIR', help='''
+        Batch mode. Convert all sources into DIR.
+        Directories and glob patterns are expanded.''')
+    cmd.add_argument('-j', '--jobs', type=job_count, metavar='N', help='''
+        Batch mode. Number of worker processes (0: all cores).''')
+    cmd.add_argument('-f', '--force', action='store_true',
+                     help='Batch mode. Convert even if target is up-to-date.')
     cmd.add_argument('target', type=str, metavar='destination',
                      help='Image type determined by extension (png|argb|rgb)')
-    cmd.add_argument('source', type=PathExist('f'), metavar='src',
-                     help='Input image (png|argb|rgb|jp2)')
-    cmd.add_argument('mask', type=PathExist('f'), nargs='?',
-                     help='Alpha mask. If set, assume src is RGB image.')
+    cmd.add_argument('source', type=str, nargs='+', metavar='src', help='''
+        Input image (png|argb|rgb|jp2) and optional alpha mask.
+        If mask is set, assume src is RGB image.''')
+
+    # Serve
+    cmd = add_command('serve', [], cli_serve)
+    cmd.add_argument('--host', type=str, default='127.0.0.1',
+                     help='Bind address (default: 127.0.0.1)')
+    cmd.add_argument('-p', '--port', type=int, default=8080,
+                     help='TCP port (default: 8080)')
+    cmd.add_argument('--socket', type=str, metavar='PATH',
+                     help='Listen on unix socket instead of TCP port')
+    cmd.add_argument('-j', '--jobs', type=job_count, metavar='N',
+                     help='Max number of parallel workers (0: all cores)')
+    cmd.add_argument('--cache-size', type=int, default=128, metavar='N',
+                     help='Number of cached parse and conversion results')
+    cmd.epilog = 'Send requests as "POST /<command>" with JSON payload.'
 
     args = parser.parse_args()
     if args.command in ['p', 'print']:
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+'''
+Minimal PNG reader and writer (used if Pillow is not installed).
+Reads non-interlaced 8-bit and 16-bit images of any color type.
+Writes 8-bit RGBA.
+'''
+import struct  # pack, unpack
+import zlib  # compress, decompress, crc32
+from typing import List, Tuple
+from . import RawData
+from .ArgbImage import ArgbImage
+
+_MAGIC = b'\x89PNG\x0d\x0a\x1a\x0a'
+_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}  # by color type
+
+
+def read_png(fname: str) -> ArgbImage:
+    with open(fname, 'rb') as fp:
+        return decode_png(fp.read())
+
+
+def write_png(img: ArgbImage, fname: str) -> None:
+    with open(fname, 'wb') as fp:
+        fp.write(encode_png(img))
+
+
+def decode_png(data: bytes) -> ArgbImage:
+    if data[:8] != _MAGIC:
+        raise ValueError('Not a PNG file.')
+    chunks = list(_chunks(data))
+    w, h, depth, color, _, _, interlace = struct.unpack(
+        '>IIBBBBB', chunks[0][1])
+    if color not in _CHANNELS or depth not in (8, 16):
+        raise NotImplementedError('Unsupported PNG format: {} bit, type {}'
+                                  .format(depth, color))
+    if interlace:
+        raise NotImplementedError('Interlaced PNG is not supported.')
+    palette = b''.join(x for k, x in chunks if k == b'PLTE')
+    trns = b''.join(x for k, x in chunks if k == b'tRNS')
+    ch = _CHANNELS[color]
+    bpp = ch * depth // 8
+    size = h * (w * bpp + 1)  # +1 filter type per row
+    RawData.LIMITS.check('decoded_size', size, 'Decoded PNG size')
+    # stop inflating after expected size (compressed data may be a bomb)
+    raw = zlib.decompressobj().decompress(
+        b''.join(x for k, x in chunks if k == b'IDAT'), size)
+    if len(raw) < size:
+        raise ValueError('Truncated PNG data.')
+    pixels = _unfilter(raw, w * bpp, h, bpp)
+    if depth == 16:
+        pixels = pixels[::2]  # use most significant byte
+
+    n = w * h
+    if color == 0:
+        gray = list(pixels)
+        a = [255] * n
+        if len(trns) >= 2:
+            key = trns[1] if depth == 8 else trns[0]
+            a = [0 if x == key else 255 for x in gray]
+        return ArgbImage.from_planes((w, h), a, gray, gray, gray)
+    if color == 2:
+        r, g, b = list(pixels[0::3]), list(pixels[1::3]), list(pixels[2::3])
+        a = [255] * n
+        if len(trns) >= 6:
+            rgbkey = tuple(trns[i] for i in ((1, 3, 5) if depth == 8 else
+                                              (0, 2, 4)))
+            a = [0 if x == rgbkey else 255 for x in zip(r, g, b)]
+        return ArgbImage.from_planes((w, h), a, r, g, b)
+    if color == 3:
+        alpha = trns + b'\xFF' * (256 - len(trns))
+        return ArgbImage.from_planes(
+            (w, h), list(pixels.translate(alpha)),
+            *[list(pixels.translate(_palette_table(palette, i)))
+              for i in range(3)])
+    if color == 4:
+        gray = list(pixels[0::2])
+        return ArgbImage.from_planes((w, h), list(pixels[1::2]),
+                                     gray, gray, gray)
+    return ArgbImage.from_planes(
+        (w, h), list(pixels[3::4]),
+        list(pixels[0::4]), list(pixels[1::4]), list(pixels[2::4]))
+
+
+def encode_png(img: ArgbImage) -> bytes:
+    w, h = img.size
+    rgba = bytearray(w * h * 4)
+    for i, ch in enumerate((img.r, img.g, img.b, img.a)):
+        rgba[i::4] = bytes(ch)
+    stride = w * 4
+    raw = b''.join(b'\x00' + rgba[y * stride:(y + 1) * stride]
+                   for y in range(h))
+    return _MAGIC \
+        + _chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 6, 0, 0, 0)) \
+        + _chunk(b'IDAT', zlib.compress(raw, 9)) \
+        + _chunk(b'IEND', b'')
+
+
+def _chunks(data: bytes) -> List[Tuple[bytes, bytes]]:
+    ret = []
+    off = 8
+    while off + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[off:off + 8])
+        ret.append((kind, data[off + 8:off + 8 + length]))
+        off += length + 12  # +crc
+        if kind == b'IEND':
+            break
+    if not ret or ret[0][0] != b'IHDR':
+        raise ValueError('Missing IHDR chunk.')
+    return ret
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(kind + data) & 0xFFFFFFFF
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', crc)
+
+
+def _palette_table(palette: bytes, channel: int) -> bytes:
+    table = bytearray(256)
+    colors = palette[channel::3]
+    table[:len(colors)] = colors
+    return bytes(table)
+
+
+def _unfilter(raw: bytes, stride: int, height: int, bpp: int) -> bytes:
+    ret = bytearray(stride * height)
+    prev = bytearray(stride)
+    for y in range(height):
+        off = y * (stride + 1)
+        ftype = raw[off]
+        row = bytearray(raw[off + 1:off + 1 + stride])
+        if ftype == 1:  # Sub
+            for i in range(bpp, stride):
+                row[i] = (row[i] + row[i - bpp]) & 0xFF
+        elif ftype == 2:  # Up
+            row = bytearray((x + p) & 0xFF for x, p in zip(row, prev))
+        elif ftype == 3:  # Average
+            for i in range(stride):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xFF
+        elif ftype == 4:  # Paeth
+            for i in range(stride):
+                a = row[i - bpp] if i >= bpp else 0
+                b = prev[i]
+                c = prev[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    pred = a
+                elif pb <= pc:
+                    pred = b
+                else:
+                    pred = c
+                row[i] = (row[i] + pred) & 0xFF
+        elif ftype != 0:
+            raise ValueError('Invalid PNG filter type {}'.format(ftype))
+        ret[y * stride:(y + 1) * stride] = row
+        prev = row
+    return bytes(ret)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+'''
+Long-running conversion service with warm caches.
+
+Every operation is a `POST /<operation>` request with a JSON body.
+Binary payloads are transferred as base64 encoded strings.
+
+  info    {data, verbose?}           -> {info}
+  verify  {data}                     -> {issues}
+  extract {data, convert?}           -> {media: {key: data}}
+  convert {data, target, mask?, raw?} -> {data, mask?}
+  compose {files: [{data, name?, key?}], toc?, layout?} -> {data}
+'''
+import os  # path, remove, stat
+import json  # loads, dumps
+import socket  # AF_UNIX
+import stat  # S_ISSOCK
+import struct  # error
+import zlib  # error
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Lock
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+from . import IcnsType, RawData
+from .IcnsFile import IcnsFile
+from .ArgbImage import ArgbImage
+
+Payload = Dict[str, Any]
+
+
+class RequestError(Exception):
+    pass
+
+
+class LRUCache:
+    ''' Thread-safe least-recently-used cache with fixed capacity. '''
+    __slots__ = ['maxsize', 'hits', 'misses', '_data', '_lock']
+
+    def __init__(self, maxsize: int = 128) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # type: OrderedDict[Any, Any]
+        self._lock = Lock()
+
+    def get(self, key: Any, fn: Callable[[], Any]) -> Any:
+        ''' Return cached value or compute (and store) `fn()`. '''
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+        value = fn()  # compute outside of lock
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class IcnsService:
+    ''' Request processing, independent of the transport layer. '''
+
+    def __init__(self, *, cache_size: int = 128) -> None:
+        self.icns_cache = LRUCache(cache_size)  # parsed icns files
+        self.conv_cache = LRUCache(cache_size)  # recent conversions
+        self.operations = {
+            'info': self.op_info,
+            'verify': self.op_verify,
+            'extract': self.op_extract,
+            'convert': self.op_convert,
+            'compose': self.op_compose,
+        }  # type: Dict[str, Callable[[Payload], Payload]]
+
+    def process(self, operation: str, payload: Payload) -> Payload:
+        try:
+            fn = self.operations[operation]
+        except KeyError:
+            raise RequestError('Unknown operation "{}"'.format(operation))
+        try:
+            return fn(payload)
+        except RequestError:
+            raise
+        except (KeyError, ValueError, TypeError, AttributeError,
+                NotImplementedError, ImportError, IcnsType.CanNotDetermine,
+                RawData.ParserError, OSError, zlib.error, struct.error) as e:
+            # OSError includes Pillow's UnidentifiedImageError
+            raise RequestError('{}: {}'.format(type(e).__name__, e))
+
+    # Operations
+
+    def op_info(self, payload: Payload) -> Payload:
+        data = _decode(payload, 'data')
+        return {'info': IcnsFile.description(
+            data=data, verbose=bool(payload.get('verbose')))}
+
+    def op_verify(self, payload: Payload) -> Payload:
+        data = _decode(payload, 'data')
+        return {'issues': self.conv_cache.get(
+            ('verify', _digest(data)), lambda: list(IcnsFile.verify(
+                data=data)))}
+
+    def op_extract(self, payload: Payload) -> Payload:
+        icns = self.parsed(_decode(payload, 'data'))
+        media = dict(icns.media)
+        if payload.get('convert'):
+            pairs = list(IcnsType.enum_png_convertable(icns.media))
+            converted = set()
+            for imgk, maskk in pairs:
+                png = self._media_to_png(icns, imgk, maskk)
+                if png is None:
+                    continue
+                media[imgk] = png
+                converted.add(imgk)
+            for _, maskk in pairs:
+                if maskk and maskk not in converted:  # shared masks
+                    media.pop(maskk, None)
+        return {'media': {IcnsType.key_to_readable(k): _encode(v)
+                          for k, v in media.items()}}
+
+    def op_convert(self, payload: Payload) -> Payload:
+        data = _decode(payload, 'data')
+        mask = _decode(payload, 'mask') if payload.get('mask') else None
+        target = payload.get('target')
+        raw = bool(payload.get('raw'))
+        if target not in ['png', 'argb', 'rgb']:
+            raise RequestError('Unsupported target type "{}"'.format(target))
+        key = ('convert', _digest(data), mask and _digest(mask), target, raw)
+        data, mask = self.conv_cache.get(
+            key, lambda: _convert(data, mask, target, raw))
+        ret = {'data': _encode(data)}
+        if mask is not None:
+            ret['mask'] = _encode(mask)
+        return ret
+
+    def op_compose(self, payload: Payload) -> Payload:
+        icns = IcnsFile()
+        for entry in payload.get('files') or []:
+            # never use add_media(file=), name must not read local files
+            data = _decode(entry, 'data')
+            if not data:
+                raise RequestError('Empty field "data"')
+            name = entry.get('name')
+            if entry.get('key'):
+                key = IcnsType.key_from_readable(entry['key'])
+                is_icns = True  # we dont know, so we assume it is
+            else:
+                iType = IcnsType.guess(
+                    data, name if isinstance(name, str) else None)
+                key, is_icns = iType.key, iType.is_type('icns')
+            if key in icns.media:
+                raise RequestError('Duplicate key "{}"'.format(
+                    IcnsType.key_to_readable(key)))
+            if is_icns and data[:4] == b'icns':
+                data = data[8:]  # nested icns files omit the header
+            icns.media[key] = data
+        return {'data': _encode(icns.icns_data(
+            toc=bool(payload.get('toc')),
+            layout=payload.get('layout') or 'as-is'))}
+
+    # Helper
+
+    def parsed(self, data: bytes) -> IcnsFile:
+        ''' Cached icns index. Returned object must be treated read-only. '''
+        return self.icns_cache.get(  # type: ignore[no-any-return]
+            ('icns', _digest(data)), lambda: IcnsFile(data=data))
+
+    def _media_to_png(
+        self,
+        icns: IcnsFile,
+        img_key: IcnsType.Media.KeyT,
+        mask_key: Optional[IcnsType.Media.KeyT],
+    ) -> Optional[bytes]:
+        data = icns.media[img_key]
+        if RawData.determine_file_ext(data) not in ['argb', None]:
+            return None  # icp4 and icp5 can have png or jp2 data
+        mask = icns.media[mask_key] if mask_key else None
+        key = ('png', img_key, _digest(data), mask and _digest(mask))
+
+        def fn() -> bytes:
+            iType = IcnsType.get(img_key)
+            if iType.bits == 1:
+                return ArgbImage.from_mono(data, iType).png_data()
+            if iType.is_indexed():
+                return ArgbImage.from_indexed(data, iType, mask).png_data()
+            return ArgbImage(data=data, mask=mask).png_data()
+        return self.conv_cache.get(key, fn)  # type: ignore[no-any-return]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = 'icnsutil'
+
+    def do_POST(self) -> None:
+        srv = self.server  # type: Any
+        operation = self.path.strip('/')
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            # base64 and JSON overhead, checked before reading the body
+            RawData.LIMITS.check('file_size', length // 2, 'Request body')
+            try:
+                payload = json.loads(self.rfile.read(length).decode('utf8'))
+            except ValueError:
+                raise RequestError('Invalid JSON body')
+            if not isinstance(payload, dict):
+                raise RequestError('JSON body must be an object')
+            code, ret = 200, srv.pool.submit(
+                srv.service.process, operation, payload).result()
+        except RequestError as e:
+            code = 404 if str(e).startswith('Unknown operation') else 400
+            ret = {'error': str(e)}
+        except RawData.ParserError as e:  # request body too large
+            code, ret = 413, {'error': str(e)}
+        except Exception as e:  # always respond, never drop the connection
+            code, ret = 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+        self._respond(code, ret)
+
+    def _respond(self, code: int, obj: Payload) -> None:
+        body = json.dumps(obj).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if not getattr(self.server, 'quiet', False):
+            super().log_message(format, *args)
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self) -> Tuple[socket.socket, Any]:
+        request, _ = super().get_request()
+        return request, ('',)  # BaseHTTPRequestHandler expects a tuple
+
+
+def make_server(
+    address: Union[str, Tuple[str, int]],
+    *,
+    workers: Optional[int] = None,
+    cache_size: int = 128,
+    quiet: bool = False,
+) -> Union[_HTTPServer, _UnixHTTPServer]:
+    '''
+    Create (but do not start) a server.
+    - address : Either a (host, port) tuple or a unix socket path.
+    - workers : Max number of concurrently processed requests.
+    Raises FileExistsError if address is an existing file but not a socket.
+    '''
+    if isinstance(address, str):
+        if os.path.exists(address):
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                raise FileExistsError(
+                    'Refusing to replace non-socket file "{}"'.format(address))
+            os.remove(address)  # stale socket of previous run
+        srv = _UnixHTTPServer(address, RequestHandler)  # type: Any
+    else:
+        srv = _HTTPServer(address, RequestHandler)
+    srv.service = IcnsService(cache_size=cache_size)
+    srv.pool = ThreadPoolExecutor(workers or os.cpu_count() or 1)
+    srv.quiet = quiet
+    return srv  # type: ignore[no-any-return]
+
+
+def serve(
+    address: Union[str, Tuple[str, int]],
+    *,
+    workers: Optional[int] = None,
+    cache_size: int = 128,
+) -> None:
+    ''' Process requests until interrupted. '''
+    srv = make_server(address, workers=workers, cache_size=cache_size)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+        srv.pool.shutdown()  # type: ignore[union-attr]
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+
+
+def _convert(data: bytes, mask: Optional[bytes], target: str, raw: bool) \
+        -> Tuple[bytes, Optional[bytes]]:
+    img = ArgbImage(data=data, mask=mask)
+    if target == 'png':
+        return img.png_data(), None
+    if target == 'argb':
+        return img.argb_data(), None
+    rgb = img.rgb_data()
+    if not raw and img.size == (128, 128):
+        rgb = b'\x00\x00\x00\x00' + rgb  # fix for it32
+    return rgb, img.mask_data()
+
+
+def _decode(payload: Payload, field: str) -> bytes:
+    value = payload.get(field)
+    if not isinstance(value, str):
+        raise RequestError('Missing base64 field "{}"'.format(field))
+    try:
+        return b64decode(value.encode('ascii'), validate=True)
+    except ValueError:
+        raise RequestError('Invalid base64 in field "{}"'.format(field))
+
+
+def _encode(data: bytes) -> str:
+    return b64encode(data).decode('ascii')
+
+
+def _digest(data: bytes) -> bytes:
+    return sha1(data).digest()
@@ -21,6 +21,7 @@ setup(
     },
     extras_require={
         'convert': ['Pillow'],
+        'array': ['numpy'],
     },
     long_description_content_type="text/markdown",
     long_description=longdesc,
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+import unittest
+import shutil  # rmtree
+import os  # chdir, listdir, makedirs, path
+import io  # StringIO
+import time  # sleep
+from contextlib import redirect_stdout, redirect_stderr
+from threading import Lock
+if __name__ == '__main__':
+    import sys
+    sys.path[0] = os.path.dirname(sys.path[0])
+from unittest import mock
+import struct  # pack
+from icnsutil.autosize.ImageResizer import ImageResizer, probeImageSize
+from icnsutil import IcnsFile, ArgbImage, PIL_ENABLED
+from icnsutil.autosize.cli import downscale_images, downscale_to_memory
+from icnsutil.autosize.cli import build_icns
+from icnsutil.autosize import cli as autosize_cli
+from icnsutil import pngcodec
+from icnsutil.autosize import PixelResizer, helper
+from icnsutil.autosize.ImageResizer import SVGResizer
+
+
+def main():
+    # ensure working dir is correct
+    os.chdir(os.path.join(os.path.dirname(__file__), 'fixtures'))
+    unittest.main()
+    exit()
+
+
+class FakeResizer(ImageResizer):
+    ''' Records resize calls and writes empty files. '''
+    lock = Lock()
+    running = 0
+    max_running = 0
+
+    @staticmethod
+    def isSupported():
+        return True
+
+    def __init__(self, fname, preferred_size, *, actual=1024, delay=0.05):
+        super().__init__(fname, preferred_size)
+        self.actual = actual
+        self.delay = delay
+        self.calls = []
+
+    def calculateSize(self):
+        return self.actual, self.actual
+
+    def resizeData(self, size):
+        self.calls.append(size)
+        # PNG header is sufficient for type guessing
+        return b'\x89PNG\x0d\x0a\x1a\x0a\x00\x00\x00\x0dIHDR' \
+            + struct.pack('>II', size, size) + b'\x08\x06\x00\x00\x00'
+
+    def resize(self, size, fname_out):
+        cls = type(self)
+        with cls.lock:
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+        time.sleep(self.delay)
+        self.calls.append(size)
+        with open(fname_out, 'wb') as fp:
+            fp.write(str(size).encode('utf8'))
+        with cls.lock:
+            cls.running -= 1
+
+
+class TestDownscale(unittest.TestCase):
+    def setUp(self):
+        self.OUTDIR = 'tmp_autosize.iconset'
+        if os.path.isdir(self.OUTDIR):
+            shutil.rmtree(self.OUTDIR)
+        os.makedirs(self.OUTDIR, exist_ok=True)
+        FakeResizer.max_running = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.OUTDIR)
+
+    def downscale(self, images, jobs=None):
+        out, err = io.StringIO(), io.StringIO()
+        with redirect_stdout(out), redirect_stderr(err):
+            downscale_images(images, self.OUTDIR, jobs=jobs)
+        return out.getvalue(), err.getvalue()
+
+    def test_parallel(self):
+        img = FakeResizer('a.png', 512)
+        start = time.perf_counter()
+        out, _ = self.downscale([img], jobs=10)
+        duration = time.perf_counter() - start
+        self.assertEqual(len(os.listdir(self.OUTDIR)), 10)
+        self.assertEqual(sorted(img.calls), [
+            16, 32, 32, 64, 128, 256, 256, 512, 512, 1024])
+        self.assertTrue(FakeResizer.max_running > 1)
+        self.assertLess(duration, 10 * img.delay)
+        self.assertEqual(out, 'downscaling from 512@2x (FakeResizer): '
+                         '.......... done.\n')
+        with open(os.path.join(self.OUTDIR, 'icon_16x16@2x.png')) as fp:
+            self.assertEqual(fp.read(), '32')
+
+    def test_multiple_sources(self):
+        big = FakeResizer('big.png', 512, delay=0.1)
+        small = FakeResizer('small.png', 32, actual=64, delay=0)
+        out, _ = self.downscale([big, small], jobs=4)
+        self.assertEqual(sorted(big.calls), [128, 256, 256, 512, 512, 1024])
+        self.assertEqual(sorted(small.calls), [16, 32, 32, 64])
+        # output order is independent of execution order
+        self.assertEqual(out.splitlines(), [
+            'downscaling from 512@2x (FakeResizer): ...... done.',
+            'downscaling from 32@2x (FakeResizer): .... done.'])
+
+    def test_in_memory(self):
+        big = FakeResizer('big.png', 512)
+        small = FakeResizer('small.png', 32, actual=64)
+        with redirect_stdout(io.StringIO()):
+            pngs = downscale_to_memory([big, small])
+        self.assertEqual(len(pngs), 10)
+        self.assertEqual(sorted(small.calls), [16, 32, 32, 64])
+        self.assertEqual(os.listdir(self.OUTDIR), [])
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            icns = build_icns(pngs)
+        # fake PNG data cannot be converted to ARGB
+        self.assertEqual(sorted(icns.media.keys()), [
+            'ic07', 'ic08', 'ic09', 'ic10', 'ic11', 'ic12', 'ic13', 'ic14',
+            'icp4', 'icp5'])
+
+    def test_in_memory_argb(self):
+        with open('rgb.icns.png', 'rb') as fp:
+            png = fp.read()
+        for pil in sorted({PIL_ENABLED, False}):
+            with mock.patch.object(autosize_cli, 'PIL_ENABLED', pil):
+                with redirect_stdout(io.StringIO()):
+                    icns = build_icns({'icon_16x16.png': png})
+            self.assertEqual(list(icns.media.keys()), ['ic04'])
+            self.assertEqual(icns.media['ic04'],
+                             ArgbImage(file='rgb.icns.argb').argb_data())
+
+    def test_skip_larger_next(self):
+        first = FakeResizer('first.png', 128, actual=256)
+        second = FakeResizer('second.png', 128, actual=256)
+        out, err = self.downscale([first, second])
+        self.assertEqual(first.calls, [])
+        self.assertEqual(len(second.calls), 6)
+        self.assertTrue(err.startswith('SKIP: "first.png"'))
+
+
+class TestProbeSize(unittest.TestCase):
+    TMPFILE = 'tmp_autosize_probe.bin'
+
+    def tearDown(self):
+        if os.path.exists(self.TMPFILE):
+            os.remove(self.TMPFILE)
+
+    def probe(self, data):
+        with open(self.TMPFILE, 'wb') as fp:
+            fp.write(data)
+        return probeImageSize(self.TMPFILE)
+
+    def test_fixtures(self):
+        self.assertEqual(probeImageSize('rgb.icns.png'), (16, 16))
+        self.assertEqual(probeImageSize('256x256.jp2'), (256, 256))
+        self.assertEqual(probeImageSize('18x18.j2k'), (18, 18))
+        self.assertEqual(probeImageSize('32x32.jpf'), (32, 32))
+        self.assertEqual(probeImageSize('rgb.icns.argb'), None)
+
+    def test_gif(self):
+        self.assertEqual(self.probe(b'GIF89a\x20\x00\x10\x00'), (32, 16))
+
+    def test_bmp(self):
+        head = b'BM' + b'\x00' * 12 + struct.pack('<Iii', 40, 64, -48)
+        self.assertEqual(self.probe(head), (64, 48))
+        head = b'BM' + b'\x00' * 12 + struct.pack('<IHH', 12, 8, 9)
+        self.assertEqual(self.probe(head), (8, 9))
+
+    def test_tiff(self):
+        ifd = struct.pack('<H', 2) \
+            + struct.pack('<HHIHH', 256, 3, 1, 300, 0) \
+            + struct.pack('<HHII', 257, 4, 1, 200)
+        self.assertEqual(self.probe(b'II*\x00\x08\x00\x00\x00' + ifd),
+                         (300, 200))
+        ifd = struct.pack('>H', 1) + struct.pack('>HHII', 256, 4, 1, 7)
+        self.assertEqual(self.probe(b'MM\x00*\x00\x00\x00\x08' + ifd), None)
+
+    def test_jpeg(self):
+        app0 = b'\xFF\xE0' + struct.pack('>H', 6) + b'JFIF'
+        sof = b'\xFF\xC0' + struct.pack('>HBHH', 11, 8, 120, 160)
+        self.assertEqual(self.probe(b'\xFF\xD8' + app0 + sof), (160, 120))
+        self.assertEqual(self.probe(b'\xFF\xD8' + app0), None)
+
+    def test_fallback(self):
+        class Tool(ImageResizer):
+            calls = 0
+
+            def toolSize(self):
+                Tool.calls += 1
+                return 64, 64
+        self.assertEqual(Tool('rgb.icns.png', 512).size, 8)
+        self.assertEqual(Tool.calls, 0)
+        self.assertEqual(Tool('rgb.icns.argb', 512).size, 32)
+        self.assertEqual(Tool.calls, 1)
+
+
+class FakePixelResizer(PixelResizer.PixelResizer):
+    ''' Reads source, appends target size. '''
+    @staticmethod
+    def isSupported():
+        return True
+
+    def resize(self, size, fname_out):
+        with open(self.fname) as fp:
+            src = fp.read().strip()
+        with open(fname_out, 'w') as fp:
+            fp.write('{}>{}'.format(src, size))
+
+
+@unittest.skipIf(os.name == 'nt', 'requires shell script')
+class TestRenderOnceSVG(unittest.TestCase):
+    def setUp(self):
+        self.OUTDIR = os.path.abspath('tmp_autosize_svg.iconset')
+        if os.path.isdir(self.OUTDIR):
+            shutil.rmtree(self.OUTDIR)
+        bindir = os.path.join(self.OUTDIR, 'bin')
+        os.makedirs(bindir)
+        self.LOG = os.path.join(self.OUTDIR, 'resvg.log')
+        stub = os.path.join(bindir, 'resvg')
+        with open(stub, 'w') as fp:  # resvg -w SIZE in.svg out.png
+            fp.write('#!/bin/sh\necho "$2" >> "{}"\necho "$2" > "$4"\n'
+                     .format(self.LOG))
+        os.chmod(stub, 0o755)
+        self.SOURCE = os.path.join(self.OUTDIR, 'icon.svg')
+        with open(self.SOURCE, 'w') as fp:
+            fp.write('<svg/>')
+        self.env = mock.patch.dict(os.environ, {
+            'PATH': bindir + os.pathsep + os.environ.get('PATH', '')})
+        self.env.start()
+        self.patches = [
+            mock.patch.object(helper, 'PX_RESIZERS', [FakePixelResizer]),
+            mock.patch.object(helper, 'BEST_PX', None),
+            mock.patch.object(helper, 'BEST_SVG', None),
+        ]
+        for x in self.patches:
+            x.start()
+
+    def tearDown(self):
+        for x in self.patches:
+            x.stop()
+        self.env.stop()
+        SVGResizer.render_once = True
+        SVGResizer.vector_threshold = 0
+        shutil.rmtree(self.OUTDIR)
+
+    def run_autosize(self):
+        img = helper.bestImageResizer(self.SOURCE, 512)
+        with redirect_stdout(io.StringIO()):
+            downscale_images([img], self.OUTDIR, jobs=4)
+        with open(self.LOG) as fp:
+            renders = sorted(int(x) for x in fp.read().split())
+        return img, renders
+
+    def read(self, fname):
+        with open(os.path.join(self.OUTDIR, fname)) as fp:
+            return fp.read().strip()
+
+    def test_render_once(self):
+        img, renders = self.run_autosize()
+        self.assertEqual(renders, [1024])
+        self.assertEqual(self.read('icon_16x16.png'), '1024>16')
+        self.assertEqual(self.read('icon_512x512@2x.png'), '1024>1024')
+        self.assertEqual(img._tmpdir, None)  # cleanup after resize
+
+    def test_vector_threshold(self):
+        SVGResizer.vector_threshold = 64
+        _, renders = self.run_autosize()
+        self.assertEqual(renders, [16, 32, 32, 1024])
+        self.assertEqual(self.read('icon_16x16@2x.png'), '32')
+        self.assertEqual(self.read('icon_32x32@2x.png'), '1024>64')
+
+    def test_per_size(self):
+        SVGResizer.render_once = False
+        _, renders = self.run_autosize()
+        self.assertEqual(len(renders), 10)
+
+    def test_builtin_pixel_resizer_only(self):
+        with mock.patch.object(helper, 'PX_RESIZERS',
+                               [PixelResizer.ArgbResizer]):
+            img, renders = self.run_autosize()
+        self.assertEqual(len(renders), 10)  # fallback: render per size
+        self.assertEqual(self.read('icon_16x16.png'), '16')
+        self.assertEqual(img._tmpdir, None)
+
+
+@unittest.skipUnless(PixelResizer.PILLOW_ENABLED, 'PILLOW_ENABLED == False')
+class TestPillowPyramid(unittest.TestCase):
+    def setUp(self):
+        self.OUTDIR = 'tmp_autosize_pillow.iconset'
+        if os.path.isdir(self.OUTDIR):
+            shutil.rmtree(self.OUTDIR)
+        os.makedirs(self.OUTDIR, exist_ok=True)
+        self.SOURCE = os.path.join(self.OUTDIR, 'source.png')
+        img = PixelResizer.Image.new('RGBA', (1024, 1024), (255, 0, 0, 128))
+        img.save(self.SOURCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.OUTDIR)
+
+    def test_decode_once(self):
+        Image = PixelResizer.Image
+        with mock.patch.object(Image, 'open', wraps=Image.open) as fn:
+            img = PixelResizer.Pillow(self.SOURCE, 512)
+            with redirect_stdout(io.StringIO()):
+                downscale_images([img], self.OUTDIR, jobs=4)
+            self.assertEqual(fn.call_count, 1)
+        for s in (16, 32, 128, 256, 512):
+            base = os.path.join(self.OUTDIR, 'icon_{0}x{0}'.format(s))
+            with Image.open(base + '.png') as im:
+                self.assertEqual(im.size, (s, s))
+            with Image.open(base + '@2x.png') as im:
+                self.assertEqual(im.size, (s * 2,) * 2)
+        with Image.open(os.path.join(self.OUTDIR, 'icon_16x16.png')) as im:
+            self.assertEqual(im.getpixel((8, 8)), (255, 0, 0, 128))
+
+    def test_non_power_of_two(self):
+        img = PixelResizer.Pillow(self.SOURCE, 512)
+        self.assertEqual(img.image(48).size, (48, 48))
+        self.assertEqual(img.image(64).size, (64, 64))
+        self.assertEqual(sorted(img._pyramid), [48, 64, 128, 256, 512, 1024])
+
+
+class TestArgbResizer(unittest.TestCase):
+    def setUp(self):
+        self.OUTDIR = 'tmp_autosize_argb.iconset'
+        if os.path.isdir(self.OUTDIR):
+            shutil.rmtree(self.OUTDIR)
+        os.makedirs(self.OUTDIR, exist_ok=True)
+        self.SOURCE = os.path.join(self.OUTDIR, 'source.png')
+        pngcodec.write_png(ArgbImage.from_planes(
+            (64, 64), *[[x] * 64 * 64 for x in (128, 255, 0, 0)]),
+            self.SOURCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.OUTDIR)
+
+    def test_png_codec(self):
+        img = pngcodec.read_png(self.SOURCE)
+        self.assertEqual(img.size, (64, 64))
+        data = pngcodec.encode_png(img)
+        self.assertEqual(pngcodec.decode_png(data).argb_data(),
+                         img.argb_data())
+
+    def test_downscale(self):
+        img = PixelResizer.ArgbResizer(self.SOURCE, 32)
+        self.assertEqual(img.size, 32)
+        with redirect_stdout(io.StringIO()):
+            downscale_images([img], self.OUTDIR, jobs=4)
+        for s in (16, 32):
+            base = os.path.join(self.OUTDIR, 'icon_{0}x{0}'.format(s))
+            self.assertEqual(probeImageSize(base + '.png'), (s, s))
+            self.assertEqual(probeImageSize(base + '@2x.png'), (s * 2,) * 2)
+        res = pngcodec.read_png(os.path.join(self.OUTDIR, 'icon_16x16.png'))
+        self.assertEqual((set(res.a), set(res.r)), ({128}, {255}))
+        self.assertEqual(sorted(img._cache), [16, 32, 64])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,13 @@
 import unittest
 import shutil  # rmtree, copy
 import os  # chdir, listdir, makedirs, path, remove
+import json  # load
+from hashlib import sha256
 from subprocess import run, PIPE
 if __name__ == '__main__':
     import sys
     sys.path[0] = os.path.dirname(sys.path[0])
-from icnsutil import RawData, PIL_ENABLED, __version__
+from icnsutil import IcnsFile, RawData, PIL_ENABLED, __version__
 
 
 def main():
@@ -101,6 +103,43 @@ class TestCLI_export(unittest.TestCase):
     def test_extract_convert_w_pil(self):
         self.assert_files('icp4rgb.icns', ['-c'], ['16x16.png', '32x32.png'])
 
+    def test_extract_store(self):
+        store = os.path.join(self.OUTDIR, 'store')
+        r = run_cli(['e', '--store', store, '-o', self.OUTDIR,
+                     'rgb.icns', 'rgb.icns', 'selected.icns'])
+        self.assertEqual(r.returncode, 0)
+        self.assertTrue(b'8 deduplicated' in r.stdout)
+        objects = [x for _, _, files in os.walk(os.path.join(store, 'objects'))
+                   for x in files]
+        self.assertEqual(len(objects), 8 + 10)
+        for fname in ['16x16.rgb', '128x128-mask8b.bin']:
+            a = os.stat(os.path.join(self.OUTDIR, '0', fname))
+            b = os.stat(os.path.join(self.OUTDIR, '1', fname))
+            self.assertEqual(a.st_ino, b.st_ino)
+            self.assertEqual(a.st_nlink, 3)  # object + 2 exports
+        with open(os.path.join(store, 'manifest.json')) as fp:
+            manifest = json.load(fp)
+        self.assertEqual(len(manifest), 2)
+        entry = manifest[os.path.abspath('rgb.icns')]
+        self.assertEqual(sorted(entry), [
+            'ICN#', 'ics#', 'il32', 'is32', 'it32', 'l8mk', 's8mk', 't8mk'])
+        with open(os.path.join(self.OUTDIR, '0', '16x16.rgb'), 'rb') as fp:
+            self.assertEqual(sha256(fp.read()).hexdigest(), entry['is32'])
+
+    def test_extract_store_symlink(self):
+        store = os.path.join(self.OUTDIR, 'store')
+        r = run_cli(['e', '--store', store, '--link', 'sym', '-r',
+                     '-o', self.OUTDIR, 'selected.icns'])
+        self.assertEqual(r.returncode, 0)
+        fname = os.path.join(self.OUTDIR, '24x24.png')
+        self.assertTrue(os.path.islink(fname))
+        with open(fname, 'rb') as fp:
+            self.assertEqual(RawData.determine_file_ext(fp.read(8)), 'png')
+        with open(os.path.join(store, 'manifest.json')) as fp:
+            entry = json.load(fp)[os.path.abspath('selected.icns')]
+        self.assertIsInstance(entry['slct'], dict)  # nested icns
+        self.assertEqual(len(entry['slct']), 9)
+
 
 class TestCLI_compose(unittest.TestCase):
     def setUp(self):
@@ -127,6 +166,21 @@ class TestCLI_compose(unittest.TestCase):
         r = run_cli(args + ['-f'])
         self.assertEqual(r.returncode, 0)  # with force overwrite
 
+    def test_cache(self):
+        cache_dir = 'tmp_cli_compose_cache'
+        args = ['c', '--cache', cache_dir, self.OUTFILE, 'rgb.icns.png']
+        r = run_cli(args)
+        self.assertEqual(r.returncode, 0)
+        r = run_cli(args)
+        self.assertEqual(r.returncode, 0)  # unchanged, no force required
+        self.assertTrue(b'up-to-date' in r.stdout)
+        r = run_cli(args + ['18x18.j2k'])
+        self.assertEqual(r.returncode, 1)  # changed, force required
+        r = run_cli(args[:1] + ['-f'] + args[1:] + ['18x18.j2k'])
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(os.path.getsize(self.OUTFILE), 8 + 813 + 348 + 16)
+        shutil.rmtree(cache_dir)
+
     def assert_conv_file(self, fname, icns_key, arg=[]):
         run_cli(['c', self.OUTFILE, fname] + arg)
         s_orig = os.path.getsize(fname)
@@ -158,6 +212,139 @@ class TestCLI_compose(unittest.TestCase):
         self.assert_conv_file('rgb.icns.rgb', 'is32')
 
 
+class TestCLI_build(unittest.TestCase):
+    def setUp(self):
+        self.MANIFEST = 'tmp_cli_build.json'
+        self.OUTFILE = 'tmp_cli_out_build.icns'
+        with open(self.MANIFEST, 'w') as fp:
+            fp.write('{"outputs": {"%s": ["256x256.jp2"]}}' % self.OUTFILE)
+
+    def tearDown(self):
+        os.remove(self.MANIFEST)
+        if os.path.exists(self.OUTFILE):
+            os.remove(self.OUTFILE)
+
+    def test_build(self):
+        r = run_cli(['build', self.MANIFEST])
+        self.assertEqual(r.returncode, 0)
+        self.assertTrue(b'1 entries' in r.stdout)
+        self.assertEqual(os.path.getsize(self.OUTFILE), 4733 + 16)
+
+
+class TestCLI_diff(unittest.TestCase):
+    def test_equal(self):
+        ret = run_cli(['diff', 'rgb.icns', 'rgb.icns'])
+        self.assertEqual((ret.returncode, ret.stdout), (0, b''))
+
+    def test_diff(self):
+        ret = run_cli(['diff', '--pixels', 'rgb.icns', 'icp4rgb.icns'])
+        self.assertEqual(ret.returncode, 1)
+        lines = ret.stdout.decode('utf8').splitlines()
+        self.assertTrue('- il32: 2224 bytes' in lines)
+        self.assertTrue('+ icp4: 594 bytes' in lines)
+        self.assertTrue('~ s8mk: 256 -> 256 bytes, 122 pixels differ' in lines)
+        ret = run_cli(['diff', '-q', 'rgb.icns', 'icp4rgb.icns'])
+        self.assertEqual((ret.returncode, ret.stdout), (1, b''))
+
+    def test_invalid(self):
+        ret = run_cli(['diff', 'rgb.icns', '18x18.j2k'])
+        self.assertEqual(ret.returncode, 2)
+
+
+class TestCLI_ico(unittest.TestCase):
+    def tearDown(self):
+        for x in ['tmp_cli.ico', 'tmp_cli_ico.icns']:
+            if os.path.exists(x):
+                os.remove(x)
+
+    def test_roundtrip(self):
+        ret = run_cli(['ico', 'tmp_cli.ico', 'selected.icns'])
+        self.assertEqual(ret.returncode, 0)
+        with open('tmp_cli.ico', 'rb') as fp:
+            self.assertEqual(fp.read(6), b'\0\0\1\0\7\0')
+        ret = run_cli(['ico', 'tmp_cli.ico', 'selected.icns'])
+        self.assertEqual(ret.returncode, 1)  # exists
+        ret = run_cli(['ico', 'tmp_cli_ico.icns', 'tmp_cli.ico'])
+        self.assertEqual(ret.returncode, 0)
+        ret = run_cli(['test', '-q', 'tmp_cli_ico.icns'])
+        self.assertEqual((ret.returncode, ret.stdout), (0, b''))
+
+    def test_invalid(self):
+        ret = run_cli(['ico', 'tmp_cli_ico.icns', '18x18.j2k'])
+        self.assertEqual(ret.returncode, 1)
+        self.assertFalse(os.path.exists('tmp_cli_ico.icns'))
+
+
+class TestCLI_optimize(unittest.TestCase):
+    def setUp(self):
+        self.FILES = ['tmp_cli_opt_a.icns', 'tmp_cli_opt_b.icns']
+        for fname in self.FILES:
+            shutil.copy('rgb.icns', fname)
+
+    def tearDown(self):
+        for fname in self.FILES:
+            os.remove(fname)
+
+    def test_optimize(self):
+        ret = run_cli(['optimize', '-n', '--policy', 'legacy'] + self.FILES)
+        self.assertEqual(ret.returncode, 0)
+        self.assertEqual(ret.stdout.decode().splitlines(), [
+            'tmp_cli_opt_a.icns: 34990 -> 34654 bytes (336 saved), '
+            'removed: ICN#, ics#',
+            'tmp_cli_opt_b.icns: 34990 -> 34654 bytes (336 saved), '
+            'removed: ICN#, ics#',
+            'total: 69980 -> 69308 bytes (672 saved)'])
+        self.assertEqual(os.path.getsize(self.FILES[0]), 34990)  # dry run
+        ret = run_cli(['optimize', '-j', '2', '--policy', 'legacy']
+                      + self.FILES)
+        self.assertEqual(ret.returncode, 0)
+        for fname in self.FILES:
+            self.assertEqual(os.path.getsize(fname), 34654)
+        ret = run_cli(['test', '-q'] + self.FILES)
+        self.assertEqual((ret.returncode, ret.stdout), (0, b''))
+
+    def test_invalid(self):
+        ret = run_cli(['optimize', self.FILES[0], '18x18.j2k'])
+        self.assertEqual(ret.returncode, 1)
+        self.assertIn(b'error: 18x18.j2k', ret.stderr)
+        # corrupt PNG data must not abort the other jobs
+        with open('rgb.icns.png', 'rb') as fp:
+            png = bytearray(fp.read())
+        png[43:59] = b'\xff' * 16  # invalid IDAT (zlib) data
+        img = IcnsFile()
+        img.media['ic04'] = bytes(png)
+        img.write(self.FILES[1])
+        ret = run_cli(['optimize', '--png', '-j', '2'] + self.FILES)
+        self.assertEqual(ret.returncode, 0)
+        self.assertNotIn(b'Traceback', ret.stderr)
+        self.assertIn(b'total:', ret.stdout)
+
+
+class TestCLI_index(unittest.TestCase):
+    def setUp(self):
+        self.DB = 'tmp_cli_catalog.sqlite'
+
+    def tearDown(self):
+        if os.path.exists(self.DB):
+            os.remove(self.DB)
+
+    def test_index_query(self):
+        ret = run_cli(['index', '--db', self.DB, 'rgb.icns', 'selected.icns'])
+        self.assertTrue(ret.stdout.startswith(b'2 indexed, 0 unchanged'))
+        ret = run_cli(['index', '--db', self.DB, 'rgb.icns'])
+        self.assertTrue(ret.stdout.startswith(b'0 indexed, 1 unchanged'))
+        ret = run_cli(['query', '--db', self.DB, '-q', 'with', 'ic04'])
+        self.assertEqual(ret.stdout.strip(),
+                         os.path.abspath('selected.icns').encode('utf8'))
+        ret = run_cli(['query', '--db', self.DB, 'SELECT COUNT(*) AS n '
+                       'FROM entries WHERE ext = ?', 'rgb'])
+        self.assertEqual(ret.stdout.split(), [b'n', b'3'])
+        ret = run_cli(['query', '--db', self.DB, 'DROP TABLE files'])
+        self.assertEqual(ret.returncode, 1)
+        ret = run_cli(['query', '--db', self.DB])
+        self.assertTrue(b'summary' in ret.stdout)
+
+
 class TestCLI_update(unittest.TestCase):
     def setUp(self):
         self.OUTFILE = 'tmp_cli_out_update.icns'
@@ -179,6 +366,15 @@ class TestCLI_update(unittest.TestCase):
         self.assertEqual(s3, s1 + (8 + 4 * 8))
         os.remove(other_out)
 
+    def test_layout(self):
+        ret = run_cli(['u', '--layout', 'small-first', self.OUTFILE])
+        self.assertEqual(ret.returncode, 0)
+        with open(self.OUTFILE, 'rb') as fp:
+            index = [(k, n) for k, _, n in RawData.parse_icns_index(fp)]
+        keys, sizes = [x[0] for x in index], [x[1] for x in index]
+        self.assertEqual(sorted(keys), ['icp4', 'icp5', 'l8mk', 's8mk'])
+        self.assertEqual(sizes, sorted(sizes))
+
     def assertUpdate(self, args, expected_diff):
         s1 = os.path.getsize(self.OUTFILE)
         run_cli(['u', self.OUTFILE] + args)
@@ -246,6 +442,26 @@ class TestCLI_verify(unittest.TestCase):
         self.assertFalse(b'rgb.icns' in ret)
         self.assertFalse(b'OK' in ret)
 
+    def test_parallel(self):
+        args = ['t', '18x18.j2k', 'rgb.icns', 'icp4rgb.icns']
+        ret = run_cli(args[:1] + ['-j', '2'] + args[1:])
+        self.assertEqual(ret.stdout, run_cli(args).stdout)
+
+    def test_cache(self):
+        cache = 'tmp_cli_verify_cache.sqlite'
+        try:
+            args = ['t', '--cache', cache, '18x18.j2k', 'rgb.icns']
+            ret1 = run_cli(args).stdout
+            ret2 = run_cli(args).stdout  # replayed from cache
+            self.assertEqual(ret1, ret2)
+            self.assertTrue(b'Not an ICNS file' in ret2)
+            ret = run_cli(['t', '--cache', cache, '--max-entries', '1',
+                           'icp4rgb.icns']).stdout
+            self.assertTrue(b'OK' in ret)
+        finally:
+            if os.path.exists(cache):
+                os.remove(cache)
+
 
 @unittest.skipUnless(PIL_ENABLED, 'PIL_ENABLED == False')
 class TestCLI_convert(unittest.TestCase):
@@ -305,5 +521,74 @@ class TestCLI_convert(unittest.TestCase):
         os.remove(src + '.rgb.mask')
 
 
+class TestCLI_convert_batch(unittest.TestCase):
+    def setUp(self):
+        self.OUTDIR = 'tmp_cli_out_convert_batch'
+        if os.path.isdir(self.OUTDIR):
+            shutil.rmtree(self.OUTDIR)
+        os.makedirs(self.OUTDIR, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.OUTDIR)
+
+    def test_batch(self):
+        args = ['img', '-o', self.OUTDIR, '-j', '2', 'argb',
+                'rgb.icns.argb', 'rgb.icns.rgb']
+        r = run_cli(args)
+        self.assertEqual(r.returncode, 0)
+        files = sorted(os.listdir(self.OUTDIR))
+        self.assertListEqual(files, [
+            'rgb.icns.argb.argb', 'rgb.icns.rgb.argb'])
+        for x in files:
+            size = os.path.getsize(os.path.join(self.OUTDIR, x))
+            self.assertEqual(size, 713)
+        # second run should skip up-to-date targets
+        r = run_cli(args)
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(r.stdout.count(b'skip:'), 2)
+        r = run_cli(args + ['-f'])
+        self.assertEqual(r.stdout.count(b'skip:'), 0)
+
+    def test_all_cores(self):
+        r = run_cli(['img', '-o', self.OUTDIR, '-j', '0', 'argb',
+                     'rgb.icns.argb', 'rgb.icns.rgb'])
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(len(os.listdir(self.OUTDIR)), 2)
+        r = run_cli(['img', '-o', self.OUTDIR, '-j', '-1', 'argb',
+                     'rgb.icns.argb'])
+        self.assertEqual(r.returncode, 2)
+
+    def test_glob(self):
+        r = run_cli(['img', '-o', self.OUTDIR, 'rgb', 'rgb.icns.*rgb'])
+        self.assertEqual(r.returncode, 0)
+        self.assertListEqual(sorted(os.listdir(self.OUTDIR)), [
+            'rgb.icns.argb.rgb', 'rgb.icns.argb.rgb.mask',
+            'rgb.icns.rgb.rgb', 'rgb.icns.rgb.rgb.mask'])
+
+    def test_masks_and_collisions(self):
+        src = os.path.join(self.OUTDIR, 'src')
+        os.makedirs(os.path.join(src, 'sub'))
+        for dest in ['a.rgb', 'a.rgb.mask', 'sub/a.rgb']:
+            shutil.copy('rgb.icns.rgb', os.path.join(src, dest))
+        # glob matches the mask, which is not a source of its own
+        r = run_cli(['img', '-o', self.OUTDIR, 'argb',
+                     os.path.join(src, '*')])
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(r.stdout.count(b' -> '), 1)
+        # same basename in different directories
+        r = run_cli(['img', '-o', self.OUTDIR, '-f', 'argb',
+                     os.path.join(src, 'a.rgb'),
+                     os.path.join(src, 'sub', 'a.rgb')])
+        self.assertEqual(r.returncode, 1)
+        self.assertIn(b'would both write', r.stderr)
+        self.assertEqual(r.stdout, b'')  # nothing converted
+
+    def test_invalid_type(self):
+        r = run_cli(['img', '-o', self.OUTDIR, 'x.png', 'rgb.icns.argb'])
+        self.assertEqual(r.returncode, 1)
+        r = run_cli(['img', 'argb', 'rgb.icns.argb', 'rgb.icns.rgb', 'x'])
+        self.assertEqual(r.returncode, 1)
+
+
 if __name__ == '__main__':
     main()
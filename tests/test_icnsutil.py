@@ -2,6 +2,18 @@
 import unittest
 import shutil  # rmtree
 import os  # chdir, listdir, makedirs, path, remove
+import json  # dumps, loads
+import random  # Random
+import struct  # pack
+import tracemalloc  # start, stop, get_traced_memory
+import zlib  # crc32
+from base64 import b64decode, b64encode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import sha256
+from http.client import HTTPConnection
+from importlib import import_module
+from threading import Thread
+from unittest import mock
 from typing import Optional, Dict, Any
 if __name__ == '__main__':
     import sys
@@ -105,6 +117,107 @@ class TestArgbImage(unittest.TestCase):
                     self.assertEqual(fA.read(1), fB.read(1))
             os.remove('tmp_argb_to_png.png')
 
+    def test_from_indexed(self):
+        # 4-bit: high nibble first, index 0 = white, 15 = black
+        img = ArgbImage.from_indexed(b'\x0F' * 128, IcnsType.get('ics4'))
+        self.assertEqual(img.size, (16, 16))
+        self.assertEqual(img.a, [255] * 256)
+        self.assertEqual(img.r[:2], [255, 0])
+        self.assertEqual(img.b[:2], [255, 0])
+        # 8-bit: index 215 = red, 255 = black
+        img = ArgbImage.from_indexed(b'\xD7\xFF' * 128, IcnsType.get('ics8'))
+        self.assertEqual(list(zip(img.r, img.g, img.b))[:2],
+                         [(238, 0, 0), (0, 0, 0)])
+        # 1-bit mask (second half of ics#) and 8-bit mask
+        img = ArgbImage.from_indexed(b'\0' * 128, IcnsType.get('ics4'),
+                                     b'\0' * 32 + b'\x80' + b'\0' * 31)
+        self.assertEqual(img.a[:2], [255, 0])
+        self.assertEqual(sum(img.a), 255)
+        img = ArgbImage.from_indexed(b'\0' * 128, IcnsType.get('ics4'),
+                                     b'\x40' * 256)
+        self.assertEqual(img.a, [64] * 256)
+        with self.assertRaises(ValueError):
+            ArgbImage.from_indexed(b'\0' * 64, IcnsType.get('ics4'))
+        with self.assertRaises(ValueError):
+            ArgbImage.from_indexed(b'\0' * 128, IcnsType.get('ics4'), b'\0')
+
+    def test_resize(self):
+        img = ArgbImage(file='rgb.icns.argb')
+        for filter in ['area', 'lanczos']:
+            small = img.resize(8, filter)
+            self.assertEqual(small.size, (8, 8))
+            self.assertEqual(len(small.rgb_data(compress=False)), 8 * 8 * 3)
+        solid = ArgbImage.from_planes((6, 6), *[[x] * 36 for x in (
+            200, 10, 20, 30)])
+        for filter in ['area', 'lanczos']:
+            for size in [1, 4, 9]:
+                res = solid.resize(size, filter)
+                self.assertEqual(
+                    [set(x) for x in (res.a, res.r, res.g, res.b)],
+                    [{200}, {10}, {20}, {30}])
+        with self.assertRaises(NotImplementedError):
+            solid.resize(2, 'unknown')
+
+    def test_resize_premultiplied(self):
+        # one opaque red pixel, three transparent green pixels
+        img = ArgbImage.from_planes(
+            (2, 2), [255, 0, 0, 0], [255, 0, 0, 0], [0, 255, 255, 255],
+            [0, 0, 0, 0])
+        res = img.resize(1)
+        self.assertEqual((res.a, res.r, res.g, res.b), ([64], [255], [0], [0]))
+
+    def test_mipmaps(self):
+        img = ArgbImage(file='rgb.icns.argb')
+        sizes = [x.size for x in img.mipmaps([2, 8, 4, 8])]
+        self.assertEqual(sizes, [(8, 8), (4, 4), (2, 2)])
+
+    @unittest.skipUnless(import_module('icnsutil.ArgbImage').numpy_enabled(),
+                         'numpy_enabled() == False')
+    def test_array(self):
+        import numpy
+        img = ArgbImage(file='rgb.icns.argb')
+        arr = img.to_array()
+        self.assertEqual((arr.shape, arr.dtype), ((16, 16, 4), numpy.uint8))
+        self.assertEqual(arr[0, 1].tolist(),
+                         [img.r[1], img.g[1], img.b[1], img.a[1]])
+        self.assertTrue((numpy.asarray(img) == arr).all())
+        # zero copy and encoding of array-backed planes
+        back = ArgbImage.from_array(arr)
+        self.assertIs(back.to_array(), arr)
+        self.assertTrue(numpy.shares_memory(numpy.asarray(back), arr))
+        self.assertEqual(back.argb_data(), img.argb_data())
+        self.assertEqual(back.rgb_data(compress=False),
+                         img.rgb_data(compress=False))
+        self.assertEqual(back.mask_data(bits=1), img.mask_data(bits=1))
+        arr[0, 0, 3] = 7
+        self.assertEqual(back.a[0], 7)
+        back.a = list(back.a)  # replaced plane, no longer backed by array
+        self.assertIsNot(back.to_array(), arr)
+        # RGB array, opaque alpha
+        rgb = ArgbImage.from_array(arr[:, :, :3])
+        self.assertEqual(rgb.mask_data(), b'\xFF' * 256)
+        with self.assertRaises(ValueError):
+            ArgbImage.from_array(arr.astype(numpy.float32))
+
+    def test_array_without_numpy(self):
+        with mock.patch.object(import_module('icnsutil.ArgbImage'),
+                               'numpy_enabled', return_value=False):
+            with self.assertRaises(ImportError):
+                ArgbImage(file='rgb.icns.argb').to_array()
+
+    @unittest.skipUnless(import_module('icnsutil.ArgbImage').numpy_enabled(),
+                         'numpy_enabled() == False')
+    def test_resize_numpy(self):
+        img = ArgbImage(file='rgb.icns.argb')
+        for filter in ['area', 'lanczos']:
+            fast = img.resize(7, filter)
+            with mock.patch.object(import_module('icnsutil.ArgbImage'),
+                                   'numpy_enabled', return_value=False):
+                slow = img.resize(7, filter)
+            for a, b in zip([fast.a, fast.r, fast.g, fast.b],
+                            [slow.a, slow.r, slow.g, slow.b]):
+                self.assertLessEqual(max(abs(x - y) for x, y in zip(a, b)), 1)
+
 
 class TestIcnsFile(unittest.TestCase):
     def test_init(self):
@@ -229,12 +342,130 @@ class TestIcnsFile(unittest.TestCase):
         self.assertTrue(IcnsFile(fname_out).has_toc())
         os.remove(fname_out)
 
+    def test_layout(self):
+        img = IcnsFile(file='selected.icns')
+        img.add_media('icnV', data=b'\x42\x00\x00\x00')
+        for layout, expected in [
+            ('as-is', ['TOC ', 'info', 'ic12', 'icsb', 'sb24', 'ic04',
+                       'SB24', 'ic05', 'icsB', 'ic11', 'slct', 'icnV']),
+            ('small-first', ['TOC ', 'ic04', 'icsb', 'ic05', 'sb24', 'icsB',
+                             'ic11', 'SB24', 'ic12', 'slct', 'info', 'icnV']),
+            ('tiles-first', ['TOC ', 'ic04', 'icsb', 'sb24', 'ic05', 'ic11',
+                             'icsB', 'SB24', 'ic12', 'slct', 'info', 'icnV']),
+        ]:
+            data = img.icns_data(toc=True, layout=layout)
+            keys = [k for k, _ in RawData.parse_icns_data(data)]
+            self.assertEqual(keys, expected)
+            self.assertEqual(list(IcnsFile.verify(data=data)), [])
+        # masks follow their image
+        img = IcnsFile(file='rgb.icns')
+        self.assertEqual(list(img._layout_order('tiles-first')), [
+            'ics#', 'is32', 's8mk', 'ICN#', 'il32', 'l8mk', 'it32', 't8mk'])
+        with self.assertRaises(ValueError):
+            img.write('tmp_layout.icns', layout='large-first')
+        self.assertFalse(os.path.exists('tmp_layout.icns'))
+
+    def test_export_plan(self):
+        outdir = 'tmp_export_plan'
+        os.makedirs(outdir, exist_ok=True)
+        img = IcnsFile(file='selected.icns')
+        img.media['icp4'] = img.media['ic04'] = img.media['ic11']
+        try:
+            with mock.patch.dict(IcnsType._CASE_SENSITIVE, clear=True), \
+                    mock.patch.object(IcnsType.tempfile, 'mkstemp',
+                                      wraps=IcnsType.tempfile.mkstemp) as fn:
+                seq = img.export(outdir)
+                with ThreadPoolExecutor(4) as pool:
+                    par = img.export(outdir, io_executor=pool)
+                self.assertEqual(fn.call_count, 1)  # probed once per dir
+            self.assertEqual(seq, par)
+            self.assertEqual(os.path.basename(seq['ic04']), '16x16.png')
+            self.assertEqual(os.path.basename(seq['icp4']),
+                             '16x16-icp4.png')  # not overwritten
+            self.assertEqual(len(os.listdir(outdir)), 11)
+        finally:
+            shutil.rmtree(outdir)
+        # case insensitive file system
+        plan = import_module('icnsutil.IcnsFile')._ExportPlan('.')
+        plan.case_sensitive = False
+        self.assertEqual(plan.add('a.png', 'ic04'), os.path.join('.', 'a.png'))
+        self.assertEqual(plan.add('A.png', 'icp4'),
+                         os.path.join('.', 'A-icp4.png'))
+        self.assertEqual(plan.add('a.png', 'icp4'),
+                         os.path.join('.', 'a-icp4-2.png'))
+        self.assertEqual(plan.add('a.png', b'\xFD\xD9\x2F\xA8'),
+                         os.path.join('.', 'a-dark.png'))
+        self.assertEqual(IcnsType.get('icsb').filename(
+            key_only=True, case_sensitive=False), 'icsb-a')
+        self.assertEqual(IcnsType.get('icsb').filename(
+            key_only=True, case_sensitive=True), 'icsb')
+
     def test_verify(self):
         is_invalid = any(IcnsFile.verify('rgb.icns'))
         self.assertEqual(is_invalid, False)
         is_invalid = any(IcnsFile.verify('selected.icns'))
         self.assertEqual(is_invalid, False)
 
+    def test_in_memory(self):
+        with open('selected.icns', 'rb') as fp:
+            data = fp.read()
+        img = IcnsFile(data=data)
+        self.assertEqual(img.infile, None)
+        self.assertEqual(len(img.media), 10)
+        self.assertEqual(img.icns_data(), data)
+        self.assertEqual(list(IcnsFile.verify(data=data)), [])
+        self.assertEqual(IcnsFile.description(data=data),
+                         IcnsFile.description('selected.icns'))
+        issues = list(IcnsFile.verify(data=data[:-1]))
+        self.assertTrue(any('header file-size' in x for x in issues))
+
+    def test_nested_in_memory(self):
+        img = IcnsFile(file='selected.icns')
+        nested = IcnsFile(data=img.media['slct'])  # without icns header
+        self.assertEqual(len(nested.media), 9)
+        self.assertEqual(IcnsFile(data=memoryview(img.media['slct'])).media,
+                         nested.media)
+        with self.assertRaises(RawData.ParserError):
+            IcnsFile(data=b'\0' * 16)
+        # recursive export does not write and read back nested icns files
+        outdir = 'tmp_nested_in_memory'
+        os.makedirs(outdir, exist_ok=True)
+        try:
+            with mock.patch.object(RawData, 'parse_icns_file') as fn:
+                ret = img.export(outdir, allowed_ext='argb', recursive=True)
+                fn.assert_not_called()
+            self.assertEqual(sorted(os.listdir(outdir)), [
+                '16x16.argb', '18x18.argb', '32x32.argb',
+                'selected.icns.export'])
+            self.assertEqual(ret['slct']['ic04'], os.path.join(
+                outdir, 'selected.icns.export', '16x16.argb'))
+        finally:
+            shutil.rmtree(outdir)
+
+    def test_diff(self):
+        fname = 'tmp_diff.icns'
+        img = IcnsFile('rgb.icns')
+        img.remove_media('ICN#')
+        rgb = ArgbImage(data=img.media['is32'])
+        rgb.r[0] ^= 1
+        rgb.g[7] ^= 1
+        img.media['is32'] = rgb.rgb_data()
+        img.add_media('ic04', file='rgb.icns.argb')
+        img.write(fname, toc=False)
+        try:
+            self.assertEqual(list(IcnsFile.diff(fname, fname)), [])
+            lines = list(IcnsFile.diff('rgb.icns', fname, pixels=True))
+            self.assertEqual(lines[0], '- ICN#: 256 bytes')
+            self.assertEqual(lines[1], '@ il32: offset 280 -> 16')
+            self.assertTrue(lines[4].startswith('~ is32: 705 -> '))
+            self.assertTrue(lines[4].endswith(', 2 pixels differ'))
+            self.assertEqual(lines[-1], '+ ic04: 713 bytes')
+            self.assertEqual(len(lines), 9)
+        finally:
+            os.remove(fname)
+        with self.assertRaises(RawData.ParserError):
+            list(IcnsFile.diff('rgb.icns', '18x18.j2k'))
+
     def test_description(self):
         str = IcnsFile.description('rgb.icns', indent=0)
         self.assertEqual(str, '''
@@ -262,6 +493,56 @@ slct: 7660 bytes, offset: 7919, icns: selected
 '''.strip().replace('\n', os.linesep))
 
 
+class TestIcoFile(unittest.TestCase):
+    def test_from_icns(self):
+        icns = IcnsFile(file='selected.icns')
+        ico = IcoFile.from_icns(icns)
+        self.assertEqual([x for x, _ in ico.entries], [
+            (16, 16), (18, 18), (24, 24), (32, 32), (36, 36), (48, 48),
+            (64, 64)])  # ic04 + icsb as BMP, PNG up to 64x64 (ic12)
+        for size, data in ico.entries:
+            if size[0] > 18:
+                self.assertIn(data, icns.media.values())  # byte for byte
+        # read back
+        data = ico.ico_data()
+        self.assertEqual(data[:6], b'\0\0\1\0\7\0')
+        self.assertEqual(IcoFile(data=data).entries, ico.entries)
+
+    def test_bmp(self):
+        icns = IcnsFile(file='rgb.icns')
+        ico = IcoFile.from_icns(icns)
+        self.assertEqual([x for x, _ in ico.entries],
+                         [(16, 16), (32, 32), (128, 128)])
+        orig = ArgbImage(data=icns.media['is32'], mask=icns.media['s8mk'])
+        img = import_module('icnsutil.IcoFile').from_dib(ico.entries[0][1])
+        self.assertEqual((img.a, img.r, img.g, img.b),
+                         (orig.a, orig.r, orig.g, orig.b))
+        # 16px and 32px as ARGB, 128px as PNG (no 128px ARGB type)
+        back = ico.to_icns()
+        self.assertEqual(list(back.media.keys()), ['ic04', 'ic05', 'ic07'])
+        self.assertEqual(back.media['ic04'], orig.argb_data())
+
+    def test_to_icns(self):
+        ico = IcoFile.from_icns(IcnsFile(file='selected.icns'))
+        icns = ico.to_icns()
+        self.assertEqual(list(icns.media.keys()), [
+            'ic04', 'icsb', 'sb24', 'ic11', 'icsB', 'icp6', 'ic12'])
+        self.assertEqual(icns.media['ic11'], ico.entries[3][1])
+        self.assertEqual(list(IcnsFile.verify(data=icns.icns_data())), [])
+        # 4-bit BMP with palette and AND mask
+        head = b'\x28\0\0\0\x02\0\0\0\x04\0\0\0\1\0\4\0' + b'\0' * 24
+        palette = b'\xFF\xFF\xFF\0\0\0\xFF\0' + b'\0' * 56
+        bmp = head + palette + b'\x10\0\0\0' * 2 + b'\x40\0\0\0' * 2
+        img = import_module('icnsutil.IcoFile').from_dib(bmp)
+        self.assertEqual(img.a, [255, 0] * 2)  # 2nd pixel transparent
+        self.assertEqual(list(zip(img.r, img.g, img.b))[:2],
+                         [(255, 0, 0), (255, 255, 255)])  # index 1, 0
+        with self.assertRaises(ValueError):
+            IcoFile().add_image((512, 512), b'')
+        with self.assertRaises(RawData.ParserError):
+            IcoFile(data=b'icns\0\0\0\x08')
+
+
 class TestIcnsType(unittest.TestCase):
     def test_sizes(self):
         for key, ext, desc, size, total in [
@@ -332,7 +613,8 @@ class TestIcnsType(unittest.TestCase):
     def test_enum_png_convertable(self):
         gen = IcnsType.enum_png_convertable([
             'ICON', 'ICN#', 'icm#',  # test 1-bit mono icons
-            'icm4', 'icl4', 'ic07',  # test keys that should not be exported
+            'icm4', 'icl4',  # test if indexed are exported with 1-bit mask
+            'ic07',  # test keys that should not be exported
             'ic04', 'ic05',  # test if argb are exported without mask
             'icp5', 'l8mk',  # test if png+mask is exported (YES if icp4 icp5)
             'ih32', 'h8mk',  # test if 24-bit + mask is exported (YES)
@@ -343,7 +625,9 @@ class TestIcnsType(unittest.TestCase):
         self.assertEqual(next(gen), ('ICON', None))
         self.assertEqual(next(gen), ('ICN#', None))
         self.assertEqual(next(gen), ('icm#', None))
+        self.assertEqual(next(gen), ('icm4', 'icm#'))
         self.assertEqual(next(gen), ('is32', None))
+        self.assertEqual(next(gen), ('icl4', 'ICN#'))
         self.assertEqual(next(gen), ('ih32', 'h8mk'))
         self.assertEqual(next(gen), ('icp4', None))  # icp4 & icp5 can be RGB
         self.assertEqual(next(gen), ('icp5', 'l8mk'))
@@ -457,6 +741,197 @@ class TestRawData(unittest.TestCase):
         ):
             self.assertEqual(RawData.determine_file_ext(data), ext)
 
+    def test_reader_at(self):
+        with open('selected.icns', 'rb') as fp:
+            data = fp.read()
+        with RawData.FileReader('selected.icns') as reader:
+            self.assertEqual(reader.size(), len(data))
+            self.assertEqual(reader.read_at(4, 4), data[4:8])
+            self.assertEqual(list(RawData.parse_icns_reader(reader)),
+                             list(RawData.parse_icns_data(data)))
+            index = list(RawData.parse_icns_index(reader))
+        self.assertEqual(index, list(RawData.parse_icns_index(data)))
+        self.assertEqual(RawData.BytesReader(data).read_at(len(data), 8), b'')
+        for key, offset, length in index:
+            self.assertEqual(RawData.read_entry(data, key),
+                             data[offset:offset + length])
+        self.assertEqual(RawData.read_entry(data, 'ic07'), None)
+        # TOC is listed like any other entry
+        toc = IcnsFile(data=data).icns_data(toc=True)
+        reader = _CountingReader(toc)
+        self.assertEqual([x[0] for x in RawData.parse_icns_index(reader)],
+                         ['TOC '] + [x[0] for x in index])
+        self.assertEqual(reader.requests, 2 + len(index))  # icns + headers
+
+    def test_stale_toc(self):
+        img = IcnsFile()
+        img.add_media('ic04', data=b'ARGB' + b'\x00' * 20)
+        img.add_media('ic05', data=b'ARGB' + b'\x01' * 28)
+        data = img.icns_data(toc=True)
+        # swap TOC entries, sizes still add up to the file size
+        toc = data[16:32]
+        stale = data[:16] + toc[8:] + toc[:8] + data[32:]
+        self.assertEqual(len(stale), len(data))
+        for src in [data, stale]:
+            index = list(RawData.parse_icns_index(src))
+            self.assertEqual([x[0] for x in index], ['TOC ', 'ic04', 'ic05'])
+            self.assertEqual(RawData.read_entry(src, 'ic04'),
+                             b'ARGB' + b'\x00' * 20)
+            self.assertEqual(RawData.read_entry(src, 'ic05'),
+                             dict(RawData.parse_icns_data(src))['ic05'])
+
+    def test_cached_reader(self):
+        with open('selected.icns', 'rb') as fp:
+            data = fp.read()  # 15 KB, 10 entries
+        toc = IcnsFile(data=data).icns_data(toc=True)
+        for src, uncached, cached in [(data, 21, 2), (toc, 23, 2)]:
+            reader = _CountingReader(src)
+            info = IcnsFile.description(reader=reader)
+            self.assertEqual(reader.requests, uncached)
+            self.assertEqual(info, IcnsFile.description(data=src))
+            reader = _CountingReader(src)
+            cache = RawData.CachedReader(reader, min_read=4096)
+            self.assertEqual(IcnsFile.description(reader=cache), info)
+            self.assertEqual((reader.requests, cache.requests),
+                             (cached, cached))
+        # single key extraction (slct is the last entry)
+        for src, requests in [(data, 3), (toc, 3)]:
+            reader = _CountingReader(src)
+            cache = RawData.CachedReader(reader, min_read=4096)
+            self.assertEqual(RawData.read_entry(cache, 'slct')[:4], b'info')
+            self.assertEqual(reader.requests, requests)
+        # small reads are merged into a single range
+        reader = _CountingReader(bytes(range(256)) * 64)
+        cache = RawData.CachedReader(reader, min_read=16, max_gap=64)
+        self.assertEqual(cache.read_at(0, 4), b'\x00\x01\x02\x03')
+        self.assertEqual(cache.read_at(60, 4), b'\x3C\x3D\x3E\x3F')
+        self.assertEqual(cache.read_at(8, 50), bytes(range(8, 58)))  # hit
+        self.assertEqual(cache.read_at(1000, 4), bytes(range(232, 236)))
+        self.assertEqual(reader.requests, 3)
+        self.assertEqual(len(cache._ranges), 2)
+        self.assertEqual(cache.read_at(16380, 100), b'\xFC\xFD\xFE\xFF')
+
+
+def _nested_icns(depth, payload=b'ARGB\0\0\0\0'):
+    data = b'ic04' + struct.pack('>I', len(payload) + 8) + payload
+    for _ in range(depth):
+        data = b'slct' + struct.pack('>I', len(data) + 16) + b'icns' + \
+            struct.pack('>I', len(data) + 8) + data
+    return b'icns' + struct.pack('>I', len(data) + 8) + data
+
+
+class TestLimits(unittest.TestCase):
+    def setUp(self):
+        self.limits = mock.patch.object(RawData, 'LIMITS', RawData.Limits())
+        self.limits.start()
+
+    def tearDown(self):
+        self.limits.stop()
+
+    def test_entry_size(self):
+        data = b'icns\0\0\0\x18is32\xff\xff\xff\xff' + b'\x02abc' * 2
+        with self.assertRaises(RawData.ParserError):
+            IcnsFile(data=data)
+        with self.assertRaises(RawData.ParserError):
+            list(RawData.parse_icns_index(data))
+        RawData.LIMITS.max_entry_size = None
+        img = IcnsFile(data=data)  # truncated, not allocated
+        self.assertEqual(img.media['is32'], b'\x02abc' * 2)
+        RawData.LIMITS.max_file_size = 16
+        with self.assertRaises(RawData.ParserError):
+            IcnsFile(data=data)
+
+    def test_decoded_size(self):
+        bomb = b'\xff\0' * 1000  # 130 bytes each
+        with self.assertRaises(RawData.ParserError):
+            IcnsType.get('is32').decompress(bomb)
+        issues = list(IcnsFile.verify(data=_nested_icns(0, b'ARGB' + bomb)))
+        self.assertEqual(issues, ['Invalid data length for ic04: Decoded '
+                                  'size exceeds expected size: 130000 > 1024'])
+        with self.assertRaises(RawData.ParserError):  # > 4096 (ic05)
+            ArgbImage(data=b'ARGB' + bomb)
+        with self.assertRaises(RawData.ParserError):  # > 49152 (it32)
+            ArgbImage(data=b'\0' * 4 + bomb)
+        RawData.LIMITS.max_decoded_size = 100000
+        with self.assertRaises(RawData.ParserError):
+            ArgbImage(data=b'ARGB' + bomb)
+        pngcodec = import_module('icnsutil.pngcodec')
+        with self.assertRaises(RawData.ParserError):  # PNG 10000x10000
+            pngcodec.decode_png(pngcodec._MAGIC + b'\0\0\0\x0dIHDR' +
+                                struct.pack('>IIBBBBB', 10000, 10000, 8, 6,
+                                            0, 0, 0) + b'\0' * 4)
+
+    def test_depth(self):
+        IcnsFile(data=_nested_icns(4))
+        with self.assertRaises(RawData.ParserError):
+            IcnsFile(data=_nested_icns(5))
+        RawData.LIMITS.max_depth = None
+        IcnsFile(data=_nested_icns(50))
+
+    def test_fuzz(self):
+        # adversarial lengths and PackBytes streams must not allocate much
+        rnd = random.Random(0)
+        RawData.LIMITS.max_entry_size = 1 << 20
+        RawData.LIMITS.max_decoded_size = 1 << 20
+        files = []
+        for fname in ['rgb.icns', 'selected.icns', 'icp4rgb.icns']:
+            with open(fname, 'rb') as fp:
+                files.append(fp.read())
+        tracemalloc.start()
+        try:
+            for _ in range(100):
+                data = bytearray(rnd.choice(files))
+                for _ in range(rnd.randint(1, 4)):
+                    i = rnd.randrange(len(data) - 4)
+                    data[i:i + 4] = rnd.choice([
+                        b'\xff\xff\xff\xff', b'\x7f\xff\xff\xf0',
+                        b'\xff\x00\xff\x00', bytes(rnd.randrange(256)
+                                                for _ in range(4))])
+                self._parse_all(bytes(data))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 32 << 20)
+
+    def _parse_all(self, data):
+        try:
+            with mock.patch.object(import_module('icnsutil.IcnsFile'),
+                                   'stderr'):  # unknown media type
+                img = IcnsFile(data=data)
+        except RawData.ParserError:
+            return
+        list(IcnsFile.verify(data=data))
+        for key, media in img.media.items():
+            if RawData.determine_file_ext(media) in ['png', 'jp2', 'icns']:
+                continue
+            try:
+                IcnsType.get(key).decompress(media)
+                ArgbImage(data=media)
+            except (RawData.ParserError, NotImplementedError):
+                pass
+
+
+def _corrupt_png(size):
+    ''' 8-bit RGBA PNG with invalid IDAT (zlib) data. '''
+    def chunk(typ, data):
+        return struct.pack('>I', len(data)) + typ + data + \
+            struct.pack('>I', zlib.crc32(typ + data))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', size, size, 8, 6, 0, 0, 0)) + \
+        chunk(b'IDAT', b'\x78\x9c' + b'\xff' * 64) + chunk(b'IEND', b'')
+
+
+class _CountingReader(RawData.BytesReader):
+    ''' Fake remote reader, count requests. '''
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.requests = 0
+
+    def read_at(self, offset, n):
+        self.requests += 1
+        return super().read_at(offset, n)
+
 
 #######################
 #  Integration tests  #
@@ -705,5 +1180,516 @@ class TestIcp4RGB_toPNG(TestExport):
         self.assertExportCount(2)
 
 
+@unittest.skipUnless(PIL_ENABLED, 'PIL_ENABLED == False')
+class TestIndexed_toPNG(unittest.TestCase):
+    def test_export(self):
+        outdir = 'tmp_indexed_to_png'
+        os.makedirs(outdir, exist_ok=True)
+        try:
+            img = IcnsFile()
+            img.add_media('ICN#', data=b'\0' * 128 + b'\xFF' * 128)
+            img.add_media('icl4', data=b'\xF0' * 512)
+            img.add_media('icl8', data=b'\xD7' * 1024)
+            outfiles = img.export(outdir, convert_png=True)
+            self.assertEqual(sorted(os.listdir(outdir)), [
+                '32x32-4bit.png', '32x32-8bit.png', '32x32-mono.png'])
+            self.assertTrue(outfiles['ICN#'].endswith('32x32-mono.png'))
+            png = ArgbImage(file=outfiles['icl4'])
+            self.assertEqual(png.r[:2], [0, 255])
+            png = ArgbImage(file=outfiles['icl8'])
+            self.assertEqual((png.r[0], png.g[0], png.a[0]), (238, 0, 255))
+        finally:
+            shutil.rmtree(outdir)
+
+
+class TestBuilder(unittest.TestCase):
+    def setUp(self):
+        self.OUTDIR = 'tmp_builder'
+        if os.path.isdir(self.OUTDIR):
+            shutil.rmtree(self.OUTDIR)
+        os.makedirs(self.OUTDIR, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.OUTDIR)
+
+    def test_concurrent_write(self):
+        fname = os.path.join(self.OUTDIR, 'entry')
+        with ThreadPoolExecutor(8) as pool:
+            for x in [pool.submit(Builder._atomic_write, fname, b'x' * 4096)
+                      for _ in range(200)]:
+                x.result()  # re-raise FileNotFoundError of os.replace
+        self.assertEqual(os.listdir(self.OUTDIR), ['entry'])
+
+    def test_build(self):
+        manifest = os.path.join(self.OUTDIR, 'manifest.json')
+        with open(manifest, 'w') as fp:
+            json.dump({'outputs': {
+                'a.icns': {'sources': ['../rgb.icns.argb', '../18x18.j2k'],
+                           'toc': True, 'layout': 'small-first'},
+                'b.icns': {'sources': ['../rgb.icns.argb'],
+                           'dark': ['../rgb.icns.argb', '../256x256.jp2']},
+                'c/c.icns': ['../256x256.jp2'],
+                'd.icns': {'dark': ['../rgb.icns.argb', '../256x256.jp2']},
+                'e.icns': ['../rgb.icns.argb', '../rgb.icns.argb'],
+            }}, fp)
+        pool = Builder.SourcePool()
+        outputs = Builder.load_manifest(manifest)
+        res = {os.path.relpath(x.target, self.OUTDIR): x
+               for x in Builder.build(outputs, jobs=4, pool=pool)}
+        self.assertEqual(pool.loaded, 3)  # each distinct source once
+        self.assertEqual(res['a.icns'].keys, ['ic04', 'icsb', 'TOC '])
+        self.assertEqual([k for k, _ in RawData.parse_icns_file(
+            res['a.icns'].target)], ['TOC ', 'icsb', 'ic04'])
+        self.assertEqual(res['b.icns'].keys, ['ic04', b'\xFD\xD9\x2F\xA8'])
+        self.assertEqual(res['c/c.icns'].keys, ['ic08'])
+        self.assertTrue('identical key' in res['e.icns'].error)
+        for x in ['a.icns', 'b.icns', 'c/c.icns', 'd.icns']:
+            self.assertEqual(res[x].error, None)
+            self.assertEqual(list(IcnsFile.verify(res[x].target)), [])
+        self.assertFalse(os.path.exists(os.path.join(self.OUTDIR, 'e.icns')))
+        # nested dark icns is shared between outputs
+        b = IcnsFile(os.path.join(self.OUTDIR, 'b.icns'))
+        d = IcnsFile(os.path.join(self.OUTDIR, 'd.icns'))
+        dark = IcnsType.key_from_readable('dark')
+        self.assertEqual(b.media[dark], d.media[dark])
+        self.assertEqual(IcnsFile(data=b'icns\0\0\0\0' + b.media[dark])
+                         .media.keys(), {'ic04', 'ic08'})
+
+    def test_cache(self):
+        src = os.path.join(self.OUTDIR, 'src.jp2')
+        shutil.copy('32x32.jpf', src)
+        cache_dir = os.path.join(self.OUTDIR, 'cache')
+        outputs = {os.path.join(self.OUTDIR, 'out.icns'): {
+            'sources': [src, 'rgb.icns.argb'], 'toc': False}}
+
+        def run():
+            with Builder.BuildCache(cache_dir) as cache:
+                pool = Builder.SourcePool(cache)
+                res = Builder.build(outputs, pool=pool)[0]
+                return res, pool, cache
+        res, pool, cache = run()
+        self.assertEqual((res.skipped, pool.loaded, cache.misses), (0, 2, 2))
+        res, pool, cache = run()  # nothing changed
+        self.assertEqual((res.skipped, pool.loaded, cache.hits), (1, 0, 0))
+        shutil.copy('18x18.j2k', src)  # change content
+        res, pool, cache = run()
+        self.assertEqual(res.skipped, False)
+        self.assertEqual((pool.loaded, cache.hits, cache.misses), (1, 1, 1))
+
+    def test_watcher(self):
+        iconset = os.path.join(self.OUTDIR, 'icon.iconset')
+        os.makedirs(iconset)
+        target = os.path.join(self.OUTDIR, 'out.icns')
+        shutil.copy('rgb.icns.argb', os.path.join(iconset, 'a.argb'))
+        watcher = Builder.Watcher(target, [iconset, '256x256.jp2'])
+        self.assertEqual(len(watcher.poll()), 2)
+        self.assertEqual(IcnsFile(target).media.keys(), {'ic04', 'ic08'})
+        self.assertEqual(watcher.poll(), [])  # nothing changed
+        # add file
+        new_file = os.path.join(iconset, 'b.jp2')
+        shutil.copy('18x18.j2k', new_file)
+        self.assertEqual(watcher.poll(), [new_file])
+        self.assertEqual(IcnsFile(target).media.keys(),
+                         {'ic04', 'ic08', 'icsb'})
+        # modify file (different key)
+        shutil.copy('32x32.jpf', new_file)
+        os.utime(new_file, ns=(0, 42))
+        self.assertEqual(watcher.poll(), [new_file])
+        self.assertEqual(IcnsFile(target).media.keys(),
+                         {'ic04', 'ic08', 'icp5'})
+        # duplicate key does not modify media
+        dup_file = os.path.join(iconset, 'c.jp2')
+        shutil.copy('32x32.jpf', dup_file)
+        with self.assertRaises(Builder.BuildError):
+            watcher.poll()
+        os.remove(dup_file)
+        self.assertEqual(watcher.poll(), [])
+        # remove file
+        os.remove(new_file)
+        self.assertEqual(watcher.poll(), [new_file])
+        self.assertEqual(IcnsFile(target).media.keys(), {'ic04', 'ic08'})
+        self.assertEqual(list(IcnsFile.verify(target)), [])
+
+    def test_invalid_manifest(self):
+        manifest = os.path.join(self.OUTDIR, 'manifest.json')
+        with open(manifest, 'w') as fp:
+            fp.write('{"something": 1}')
+        with self.assertRaises(Builder.BuildError):
+            Builder.load_manifest(manifest)
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.OUTDIR = 'tmp_catalog'
+        if os.path.isdir(self.OUTDIR):
+            shutil.rmtree(self.OUTDIR)
+        os.makedirs(os.path.join(self.OUTDIR, 'corpus', 'sub'))
+        for src, dest in [('rgb.icns', 'a.icns'),
+                          ('selected.icns', 'sub/b.icns'),
+                          ('rgb.icns.png', 'c.icns')]:
+            shutil.copy(src, os.path.join(self.OUTDIR, 'corpus', dest))
+        self.DB = os.path.join(self.OUTDIR, 'catalog.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.OUTDIR)
+
+    def test_update(self):
+        corpus = os.path.join(self.OUTDIR, 'corpus')
+        with Catalog.Catalog(self.DB) as catalog:
+            res = catalog.update([corpus])
+            self.assertEqual((res.indexed, res.failed), (2, 1))
+            res = catalog.update([corpus])
+            self.assertEqual((res.indexed, res.unchanged), (0, 3))
+            os.remove(os.path.join(corpus, 'c.icns'))
+            shutil.copy('icp4rgb.icns', os.path.join(corpus, 'a.icns'))
+            res = catalog.update([corpus])
+            self.assertEqual((res.indexed, res.unchanged, res.removed),
+                             (1, 1, 1))
+            _, rows = catalog.query('summary')
+            self.assertEqual(rows, [(2, 14, os.path.getsize(os.path.join(
+                corpus, 'sub', 'b.icns')) + os.path.getsize('icp4rgb.icns')
+                - 8 * 16)])  # -8 for each header (icns + 13 entries)
+
+    def test_update_vanished(self):
+        corpus = os.path.join(self.OUTDIR, 'corpus')
+        files = [os.path.join(corpus, 'gone.icns'),
+                 os.path.join(corpus, 'a.icns')]
+        with mock.patch.object(Catalog, 'enum_icns_files',
+                               return_value=files):
+            with Catalog.Catalog(self.DB) as catalog:
+                res = catalog.update([corpus], prune=False)
+        self.assertEqual((res.indexed, res.failed), (1, 1))
+
+    def test_entries(self):
+        with Catalog.Catalog(self.DB) as catalog:
+            catalog.update([os.path.join(self.OUTDIR, 'corpus')])
+            _, rows = catalog.query(
+                'SELECT key, offset, length, ext, width, height FROM entries '
+                'WHERE path LIKE ? ORDER BY idx', ['%b.icns'])
+            self.assertEqual(rows[:3], [('info', 16, 314, 'plist', None, None),
+                                        ('ic12', 338, 1863, 'png', 64, 64),
+                                        ('icsb', 2209, 271, 'argb', 18, 18)])
+            self.assertEqual(rows[-1][3], 'icns')  # nested slct
+            _, rows = catalog.query('missing', ['ic04'])
+            self.assertEqual([os.path.basename(x) for x, in rows], ['a.icns'])
+            _, rows = catalog.query('errors')
+            self.assertEqual(len(rows), 1)
+            self.assertTrue('icns' in rows[0][1])
+            # content hash equals hash of payload
+            _, rows = catalog.query(
+                "SELECT sha256 FROM entries WHERE key = 'is32'")
+            icns = IcnsFile('rgb.icns')
+            self.assertEqual(rows[0][0],
+                             sha256(icns.media['is32']).hexdigest())
+        with Catalog.Catalog(self.DB, readonly=True) as catalog:
+            with self.assertRaises(Catalog.sqlite3.Error):
+                catalog.query('DELETE FROM files')
+
+
+class TestVerifyCache(unittest.TestCase):
+    def setUp(self):
+        self.OUTDIR = 'tmp_verify_cache'
+        if os.path.isdir(self.OUTDIR):
+            shutil.rmtree(self.OUTDIR)
+        os.makedirs(self.OUTDIR)
+        self.DB = os.path.join(self.OUTDIR, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.OUTDIR)
+
+    def test_verify(self):
+        copy = os.path.join(self.OUTDIR, 'copy.icns')
+        shutil.copy('rgb.icns', copy)
+        expected = {x: list(IcnsFile.verify(x)) for x in [
+            'rgb.icns', 'selected.icns', '18x18.j2k']}
+        with VerifyCache.VerifyCache(self.DB) as cache:
+            for fname, issues in expected.items():
+                self.assertEqual(cache.verify(fname), issues)
+            self.assertEqual((cache.hits, cache.misses), (0, 3))
+            self.assertEqual(cache.verify(copy), [])  # same content
+            self.assertEqual((cache.hits, cache.misses), (1, 3))
+        with VerifyCache.VerifyCache(self.DB) as cache:
+            with mock.patch.object(IcnsFile, 'verify') as fn:
+                for fname, issues in expected.items():
+                    self.assertEqual(cache.verify(fname), issues)
+                fn.assert_not_called()
+            self.assertEqual((cache.hits, cache.misses), (3, 0))
+            # file changed
+            shutil.copy('18x18.j2k', copy)
+            self.assertEqual(cache.verify(copy), expected['18x18.j2k'])
+            self.assertEqual(len(cache), 4)
+
+    def test_evict(self):
+        with VerifyCache.VerifyCache(self.DB) as cache:
+            for fname in ['rgb.icns', 'selected.icns', 'icp4rgb.icns']:
+                cache.verify(fname)
+            cache.db.execute('UPDATE results SET used = 0 WHERE path = ?',
+                             (os.path.abspath('rgb.icns'),))
+            self.assertEqual(cache.evict(max_age=3600), 1)
+            self.assertEqual(cache.evict(max_entries=1), 1)
+            self.assertEqual(len(cache), 1)
+            cache.db.execute("UPDATE results SET version = '0.0'")
+            self.assertEqual(cache.evict(), 1)
+
+
+def _literal_pack(data):  # worst case PackBytes encoding (no runs)
+    return b''.join(bytes([len(data[i:i + 128]) - 1]) + data[i:i + 128]
+                    for i in range(0, len(data), 128))
+
+
+class TestOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.OUTDIR = 'tmp_optimizer'
+        if os.path.isdir(self.OUTDIR):
+            shutil.rmtree(self.OUTDIR)
+        os.makedirs(self.OUTDIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.OUTDIR)
+
+    def test_policy(self):
+        img = IcnsFile(file='rgb.icns')
+        img.media['icp4'] = img.media['is32']
+        keys = list(img.media.keys())
+        self.assertEqual(Optimizer.optimize(img, policy='none'), [])
+        self.assertEqual(list(img.media.keys()), keys)
+        self.assertEqual(Optimizer.optimize(img), ['icp4'])
+        self.assertEqual(Optimizer.optimize(img, policy='legacy'),
+                         ['ICN#', 'ics#'])
+        self.assertEqual(list(img.media.keys()),
+                         ['il32', 'l8mk', 'is32', 's8mk', 'it32', 't8mk'])
+        with self.assertRaises(ValueError):
+            Optimizer.optimize(img, policy='all')
+        # mask is removed together with its image
+        img = IcnsFile(file='icp4rgb.icns')
+        self.assertEqual(Optimizer.optimize(img), [])
+        img.media['ic04'] = IcnsFile(file='selected.icns').media['ic04']
+        self.assertEqual(Optimizer.optimize(img), ['icp4', 's8mk'])
+
+    def test_repack(self):
+        src = IcnsFile(file='rgb.icns')
+        orig = ArgbImage(data=src.media['is32'])
+        img = IcnsFile()
+        img.media['is32'] = _literal_pack(orig.rgb_data(compress=False))
+        img.media['ic04'] = b'ARGB' + _literal_pack(
+            orig.argb_data(compress=False)[4:])
+        img.media['it32'] = src.media['it32']
+        Optimizer.optimize(img)
+        self.assertEqual(img.media['is32'], orig.rgb_data())
+        self.assertEqual(img.media['ic04'], orig.argb_data())
+        self.assertEqual(img.media['it32'], src.media['it32'])  # not larger
+        # ARGB or PNG
+        img = IcnsFile()
+        img.media['ic05'] = IcnsFile(file='selected.icns').media['ic11']
+        Optimizer.optimize(img, argb_png=True)
+        self.assertEqual(RawData.determine_file_ext(img.media['ic05']),
+                         'argb')  # 1056 bytes PNG vs. 696 bytes ARGB
+        self.assertEqual(list(IcnsFile.verify(data=img.icns_data())), [])
+        # 32x32 PNG stored as ic04 (16x16) must not become an ARGB entry
+        img = IcnsFile()
+        img.media['ic04'] = IcnsFile(file='selected.icns').media['ic11']
+        before = img.media['ic04']
+        Optimizer.optimize(img, argb_png=True)
+        self.assertEqual(img.media['ic04'], before)
+
+    def test_corrupt_png(self):
+        img = IcnsFile()
+        img.media['ic04'] = _corrupt_png(16)
+        self.assertEqual(Optimizer.optimize(img, argb_png=True), [])
+        self.assertEqual(img.media['ic04'], _corrupt_png(16))  # unchanged
+        fname = os.path.join(self.OUTDIR, 'bad.icns')
+        img.write(fname)
+        with mock.patch.object(Optimizer, '_smallest',
+                               side_effect=RuntimeError('boom')):
+            res = Optimizer.optimize_file(fname, argb_png=True)
+        self.assertEqual(res.error, 'boom')
+
+    def test_optimize_file(self):
+        fname = os.path.join(self.OUTDIR, 'a.icns')
+        img = IcnsFile(file='selected.icns')
+        img.media['icp4'] = img.media['ic11']
+        img.write(fname, toc=True)
+        size = os.path.getsize(fname)
+        res = Optimizer.optimize_file(fname, dry_run=True)
+        self.assertEqual((res.before, res.removed), (size, ['icp4']))
+        self.assertEqual(os.path.getsize(fname), size)
+        res = Optimizer.optimize_file(fname)
+        self.assertEqual(res.saved, 1056 + 8 + 8)  # data, header, TOC
+        self.assertEqual(os.path.getsize(fname), res.after)
+        self.assertEqual(os.listdir(self.OUTDIR), ['a.icns'])  # no tmp file
+        self.assertTrue(IcnsFile(file=fname).has_toc())
+        self.assertEqual(str(Optimizer.optimize_file(fname)), fname +
+                         ': 15675 -> 15675 bytes (0 saved)')
+        res = Optimizer.optimize_file('18x18.j2k')
+        self.assertEqual((res.error is not None, res.saved), (True, 0))
+
+
+def _shared_len(desc):  # worker process
+    return len(SharedPayload.load(desc)), SharedPayload.load(desc)[:4]
+
+
+class TestSharedPayload(unittest.TestCase):
+    def test_transport(self):
+        payloads = {'a': b'icns' * 1000, 'b': b'', ('c', 1): b'ARGB1234'}
+        with ProcessPoolExecutor(2) as pool:
+            with SharedPayload.SharedPayloads(payloads) as shm:
+                res = {k: pool.submit(_shared_len, shm[k]).result()
+                       for k in payloads}
+                self.assertEqual(SharedPayload.load(shm['a']), payloads['a'])
+        self.assertEqual(res, {'a': (4000, b'icns'), 'b': (0, b''),
+                               ('c', 1): (8, b'ARGB')})
+        if SharedPayload.SHM_ENABLED:
+            self.assertIsInstance(shm['a'], tuple)  # descriptor only
+            with self.assertRaises(FileNotFoundError):  # removed
+                SharedPayload.load(shm['a'])
+
+    def test_fallback(self):
+        with mock.patch.object(SharedPayload, 'SHM_ENABLED', False):
+            with SharedPayload.SharedPayloads({'a': b'1234'}) as shm:
+                self.assertEqual(shm['a'], b'1234')
+                self.assertEqual(SharedPayload.load(shm['a']), b'1234')
+
+    @unittest.skipUnless(PIL_ENABLED, 'PIL_ENABLED == False')
+    def test_parallel_export(self):
+        outdir = 'tmp_shared_export'
+        for x in ['seq', 'par']:
+            os.makedirs(os.path.join(outdir, x), exist_ok=True)
+        try:
+            img = IcnsFile('rgb.icns')
+            seq = img.export(os.path.join(outdir, 'seq'), convert_png=True)
+            with ProcessPoolExecutor(2) as pool:
+                par = img.export(os.path.join(outdir, 'par'),
+                                 convert_png=True, executor=pool)
+            self.assertEqual(len(par), len(seq))
+            for key, fname in seq.items():
+                if key == '_':
+                    continue
+                with open(fname, 'rb') as fA, open(par[key], 'rb') as fB:
+                    self.assertEqual(fA.read(), fB.read())
+        finally:
+            shutil.rmtree(outdir)
+
+
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from icnsutil.server import make_server
+        cls.srv = make_server(('127.0.0.1', 0), workers=2, quiet=True)
+        cls.port = cls.srv.server_address[1]
+        cls.thread = Thread(target=cls.srv.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.srv.shutdown()
+        cls.srv.server_close()
+        cls.srv.pool.shutdown()
+
+    def request(self, operation, **payload):
+        conn = HTTPConnection('127.0.0.1', self.port)
+        conn.request('POST', '/' + operation, body=json.dumps(payload))
+        res = conn.getresponse()
+        ret = json.loads(res.read().decode('utf8'))
+        conn.close()
+        return res.status, ret
+
+    def load(self, fname):
+        with open(fname, 'rb') as fp:
+            return b64encode(fp.read()).decode('ascii')
+
+    def test_info(self):
+        code, ret = self.request('info', data=self.load('rgb.icns'))
+        self.assertEqual(code, 200)
+        self.assertEqual(ret['info'], IcnsFile.description('rgb.icns'))
+
+    def test_verify(self):
+        code, ret = self.request('verify', data=self.load('rgb.icns'))
+        self.assertEqual(ret['issues'], [])
+        code, ret = self.request('verify', data=self.load('18x18.j2k'))
+        self.assertTrue('Not an ICNS file' in ret['issues'][0])
+
+    def test_extract(self):
+        code, ret = self.request('extract', data=self.load('selected.icns'))
+        self.assertEqual(code, 200)
+        self.assertEqual(len(ret['media']), 10)
+        self.assertEqual(len(b64decode(ret['media']['icsb'])), 271)
+        # second request hits the warm cache
+        hits = self.srv.service.icns_cache.hits
+        self.request('extract', data=self.load('selected.icns'))
+        self.assertEqual(self.srv.service.icns_cache.hits, hits + 1)
+
+    def test_convert(self):
+        code, ret = self.request(
+            'convert', data=self.load('rgb.icns.rgb'), target='argb')
+        self.assertEqual(code, 200)
+        self.assertEqual(len(b64decode(ret['data'])), 713)
+        code, ret = self.request(
+            'convert', data=self.load('rgb.icns.argb'), target='rgb')
+        self.assertEqual(len(b64decode(ret['data'])), 705)
+        self.assertEqual(len(b64decode(ret['mask'])), 256)
+
+    def test_compose(self):
+        code, ret = self.request('compose', toc=True, files=[
+            {'name': 'rgb.icns.argb', 'data': self.load('rgb.icns.argb')},
+            {'key': 'selected', 'data': self.load('selected.icns')},
+        ])
+        self.assertEqual(code, 200)
+        img = IcnsFile(data=b64decode(ret['data']))
+        self.assertEqual(list(img.media.keys()), ['TOC ', 'ic04', 'slct'])
+
+    def test_errors(self):
+        code, ret = self.request('unknown')
+        self.assertEqual(code, 404)
+        code, ret = self.request('info')
+        self.assertEqual(code, 400)
+        code, ret = self.request('convert', data='AAAA', target='gif')
+        self.assertEqual(code, 400)
+        code, ret = self.request('compose', files=[{'data': 'AAAA'}])
+        self.assertEqual(code, 400)
+        self.assertTrue('error' in ret)
+        with mock.patch.object(RawData.LIMITS, 'max_file_size', 1000):
+            code, ret = self.request('info', data=self.load('rgb.icns'))
+        self.assertEqual(code, 413)
+
+    def test_compose_no_local_files(self):
+        from icnsutil.server import IcnsService, RequestError
+        with self.assertRaises(RequestError):
+            IcnsService().process('compose', {'files': [
+                {'data': '', 'name': 'rgb.icns.png', 'key': 'info'}]})
+        code, ret = self.request('compose', files=[
+            {'data': '', 'name': os.path.abspath('rgb.icns.png')}])
+        self.assertEqual(code, 400)
+        # name is used for type guessing only
+        code, ret = self.request('compose', files=[
+            {'data': self.load('rgb.icns.png'), 'name': 'ic11.png'}])
+        self.assertEqual(code, 200)
+        img = IcnsFile(data=b64decode(ret['data']))
+        self.assertEqual(list(img.media.keys()), ['ic11'])
+
+    def test_decode_errors(self):
+        corrupt = b64encode(b'\x89PNG\r\n\x1a\n' + b'\x00' * 40)
+        code, ret = self.request(
+            'convert', data=corrupt.decode('ascii'), target='argb')
+        self.assertEqual(code, 400)
+        self.assertTrue('error' in ret)
+        with mock.patch.object(self.srv.service, 'process',
+                               side_effect=RuntimeError('boom')):
+            code, ret = self.request('info', data=self.load('rgb.icns'))
+        self.assertEqual(code, 500)
+        self.assertEqual(ret['error'], 'RuntimeError: boom')
+
+    def test_socket_path(self):
+        from icnsutil.server import make_server
+        fname = 'tmp_server_not_a_socket'
+        with open(fname, 'w') as fp:
+            fp.write('keep')
+        try:
+            with self.assertRaises(FileExistsError):
+                make_server(fname)
+            self.assertTrue(os.path.isfile(fname))
+        finally:
+            os.remove(fname)
+
+
 if __name__ == '__main__':
     main()